@@ -62,6 +62,11 @@ else:
     KILL_SIGNALS = [getattr(signal, sig) for sig in ('SIGTERM', 'SIGQUIT', 'SIGKILL') if hasattr(signal, sig)]
     from subprocess import Popen, PIPE
 
+try:
+    from subprocess import DEVNULL
+except ImportError:
+    DEVNULL = -3
+
 from threading import Thread
 try:
     from Queue import Queue, Empty
@@ -77,23 +82,32 @@ else:
     from inspect import getargspec
 
 import ast
+import binascii
 import codecs
+import copy
 import datetime
 import email
 import errno
+import hashlib
+import heapq
+import io
+import json
 import locale
 import logging
+import mmap
 import os
+import pickle
 import re
 import shlex
 import smtplib
 import socket
+import tempfile
 import textwrap
 import threading
 import time
 import traceback
 from aenum import Enum, IntEnum, Flag, export
-from collections import OrderedDict
+from collections import OrderedDict, deque, namedtuple
 from math import floor
 from sys import stdin, stdout, stderr
 from types import GeneratorType
@@ -153,9 +167,9 @@ def _input(*args, **kwds):
 # __all__ includes the common elements that might be used frequently in scripts
 __all__ = (
     'Alias', 'Command', 'Script', 'Main', 'Run', 'Spec',
-    'Bool','InputFile', 'OutputFile', 'IniError', 'IniFile', 'OrmError', 'OrmFile', 'NameSpace', 'OrmSection',
+    'Bool','InputFile', 'OutputFile', 'IniError', 'IniFile', 'OrmError', 'OrmFile', 'MappedOrmFile', 'NameSpace', 'OrmSection',
     'FLAG', 'OPTION', 'MULTI', 'MULTIREQ', 'REQUIRED',
-    'ScriptionError', 'ExecuteError', 'FailedPassword', 'TimeoutError', 'Execute', 'Job', 'ProgressView', 'ViewProgress',
+    'ScriptionError', 'ExecuteError', 'FailedPassword', 'TimeoutError', 'Environment', 'Execute', 'Job', 'JobEvent', 'JobPool', 'JobResult', 'JobTrace', 'Pipeline', 'ShellSession', 'DEVNULL', 'ProgressView', 'ViewProgress',
     'abort', 'echo', 'error', 'get_response', 'help', 'input', 'raw_input', 'mail', 'user_ids', 'print', 'box', 'table_display',
     'stdout', 'stderr', 'wait_and_check', 'b', 'bytes', 'str', 'u', 'unicode', 'ColorTemplate', 'Color',
     'basestring', 'integer', 'number', 'raise_with_traceback',
@@ -1700,26 +1714,400 @@ def Run():
         sys.exit(Exit.UserCancelled)
 
 ## optional
-def Execute(args, cwd=None, password=None, password_timeout=None, input=None, input_delay=2.5, timeout=None, pty=None, interactive=None, env=None, **new_env_vars):
+_clock = getattr(time, 'monotonic', time.time)
+
+class _ScheduledCall(object):
+
+    __slots__ = 'when', 'func', 'args', 'scheduler', 'cancelled', 'done'
+
+    def __init__(self, scheduler, when, func, args):
+        self.scheduler = scheduler
+        self.when = when
+        self.func = func
+        self.args = args
+        self.cancelled = False
+        self.done = False
+
+    def cancel(self):
+        self.scheduler._cancel(self)
+
+
+class _Scheduler(object):
+    """
+    runs callbacks at their scheduled times from a single thread shared by all
+    jobs; once no calls are pending the thread waits idle_timeout seconds for
+    more before exiting
+    """
+
+    idle_timeout = 10.0
+
+    def __init__(self):
+        self._condition = threading.Condition()
+        self._heap = []
+        self._sequence = 0
+        self._pending = 0
+        self._thread = None
+        # threads told to exit, which may still be running their last call
+        self._retiring = []
+
+    def _cancel(self, call):
+        with self._condition:
+            if call.cancelled or call.done:
+                return
+            call.cancelled = True
+            self._pending -= 1
+            if self._pending:
+                # lazily removed from heap when it reaches the top
+                return
+            # nothing left to wait for, so the thread goes idle
+            del self._heap[:]
+            self._condition.notify_all()
+
+    def _retire(self):
+        # lock must be held
+        self._retiring = [t for t in self._retiring if t.is_alive()]
+        if self._thread is not None:
+            self._retiring.append(self._thread)
+        self._thread = None
+        self._condition.notify_all()
+
+    def _run(self):
+        me = threading.current_thread()
+        heap = self._heap
+        while True:
+            with self._condition:
+                idle_until = None
+                while True:
+                    if self._thread is not me:
+                        return
+                    while heap and heap[0][2].cancelled:
+                        heapq.heappop(heap)
+                    if not heap:
+                        # kept for a while, so a series of jobs shares one thread
+                        if idle_until is None:
+                            idle_until = _clock() + self.idle_timeout
+                        wait = idle_until - _clock()
+                        if wait <= 0:
+                            self._retire()
+                            return
+                        self._condition.wait(wait)
+                        continue
+                    idle_until = None
+                    wait = heap[0][0] - _clock()
+                    if wait <= 0:
+                        call = heapq.heappop(heap)[2]
+                        call.done = True
+                        self._pending -= 1
+                        break
+                    self._condition.wait(wait)
+            try:
+                call.func(*call.args)
+            except Exception:
+                logger.exception('scheduled call %r failed' % (call.func, ))
+
+    def join_idle(self):
+        "stop the scheduler thread if no calls are pending, and wait for stopped threads to finish"
+        me = threading.current_thread()
+        with self._condition:
+            if not self._pending:
+                self._retire()
+            retiring = [t for t in self._retiring if t is not me]
+        for thread in retiring:
+            thread.join()
+
+    def schedule(self, delay, func, *args):
+        "call func(*args) in delay seconds; returns object with a cancel() method"
+        with self._condition:
+            call = _ScheduledCall(self, _clock() + delay, func, args)
+            self._sequence += 1
+            heapq.heappush(self._heap, (call.when, self._sequence, call))
+            self._pending += 1
+            if self._thread is None:
+                self._thread = Thread(target=self._run, name='scheduler')
+                self._thread.daemon = True
+                self._thread.start()
+            elif self._heap[0][2] is call:
+                self._condition.notify_all()
+        return call
+
+_scheduler = _Scheduler()
+
+def _close_fds(lowest):
+    '''
+    close all file descriptors from lowest up (child method)
+
+    only the descriptors actually open are closed, instead of trying every
+    possible one up to RLIMIT_NOFILE (which can be a million or more)
+    '''
+    try:
+        fds = [int(fd) for fd in os.listdir('/proc/self/fd')]
+    except OSError:
+        # no /proc -- let the OS do the work
+        os.closerange(lowest, resource.getrlimit(resource.RLIMIT_NOFILE)[1])
+        return
+    for fd in fds:
+        if fd >= lowest:
+            try:
+                os.close(fd)
+            except OSError:
+                # the descriptor used by listdir is already gone
+                pass
+
+def Execute(args, cwd=None, password=None, password_timeout=None, input=None, input_delay=2.5, timeout=None, pty=None, interactive=None, env=None, encoding='utf-8', stdout=None, stderr=None, tee=False, cache=None, **new_env_vars):
+    # cache -> True = reuse the result of an identical earlier command, a number
+    #          = reuse it if it is no more than that many seconds old; the result
+    #          is a JobResult (see Execute.cache)
+    if cache:
+        if password or stdout is not None or stderr is not None:
+            raise ValueError('cache cannot be used with password, stdout, or stderr')
+        key = Execute.cache.key(args, cwd, env, pty, input, encoding, new_env_vars)
+        result = Execute.cache.get(key, cache)
+        if result is not None:
+            scription_debug('returning cached result')
+            return result
     scription_debug('creating job:', args)
-    job = Job(args, cwd=cwd, pty=pty, env=env, **new_env_vars)
+    job = Job(args, cwd=cwd, pty=pty, env=env, stdout=stdout, stderr=stderr, tee=tee, **new_env_vars)
     try:
         scription_debug('communicating')
-        job.communicate(timeout=timeout, interactive=interactive, password=password, password_timeout=password_timeout, input=input, input_delay=input_delay)
+        job.communicate(timeout=timeout, interactive=interactive, password=password, password_timeout=password_timeout, input=input, input_delay=input_delay, encoding=encoding)
     except BaseException as exc:
         if getattr(exc, 'process', None) is None:
             exc.process = job
         if interactive is None:
-            echo(job.stdout)
-            echo(job.stderr)
+            _echo_output(job.stdout)
+            _echo_output(job.stderr)
             echo()
         scription_debug(exc)
         raise
     finally:
         job.close()
     scription_debug('returning')
+    if cache:
+        result = JobResult(job.args, job.returncode, job.stdout, job.stderr, job.signal)
+        if not job.returncode:
+            Execute.cache.put(key, result)
+        return result
     return job
 
+def _process_table():
+    "return {pid: (state, parent pid, group id, session id, start time)} for all processes, from /proc"
+    table = {}
+    try:
+        pids = [p for p in os.listdir('/proc') if p.isdigit()]
+    except OSError:
+        return table
+    for pid in pids:
+        try:
+            with open('/proc/%s/stat' % pid, 'rb') as f:
+                stat = f.read()
+        except (IOError, OSError):
+            # already gone
+            continue
+        # the command name is in parentheses and may contain anything
+        fields = stat[stat.rindex(b')') + 2:].split()
+        table[int(pid)] = fields[0], int(fields[1]), int(fields[2]), int(fields[3]), int(fields[19])
+    return table
+
+def _atomic_write(path, data, private=False):
+    """
+    write data (bytes) to path so readers only ever see the old file or the
+    new one: a uniquely named temporary file next to it is written, synced,
+    and renamed over it
+
+    the new file is 0600 if private; otherwise it gets the permissions of the
+    one it replaces, if any, or those open() would have given it
+    """
+    directory = os.path.dirname(os.path.abspath(path))
+    fd, temp = tempfile.mkstemp(prefix='.%s.' % os.path.basename(path), suffix='.tmp', dir=directory)
+    try:
+        with os.fdopen(fd, 'wb') as f:
+            f.write(data)
+            f.flush()
+            os.fsync(f.fileno())
+        if private:
+            # as made by mkstemp
+            pass
+        elif os.path.exists(path):
+            os.chmod(temp, os.stat(path).st_mode & 0o7777)
+        else:
+            # mkstemp ignores the umask, so see what it would allow
+            probe = temp + '.mode'
+            os.close(os.open(probe, os.O_WRONLY | os.O_CREAT | os.O_EXCL, 0o666))
+            try:
+                os.chmod(temp, os.stat(probe).st_mode & 0o7777)
+            finally:
+                os.remove(probe)
+        getattr(os, 'replace', os.rename)(temp, path)
+    except Exception:
+        try:
+            os.remove(temp)
+        except OSError:
+            pass
+        raise
+    if not is_win:
+        # make the rename itself durable
+        try:
+            fd = os.open(directory, os.O_RDONLY)
+            try:
+                os.fsync(fd)
+            finally:
+                os.close(fd)
+        except OSError:
+            pass
+
+def _environ_data():
+    "the mapping behind os.environ (compared to notice changes to it)"
+    return getattr(os.environ, '_data', getattr(os.environ, 'data', os.environ))
+
+class Environment(object):
+    """
+    environment for child processes: a base (os.environ unless given) plus
+    overrides, built once and rebuilt only when the base changes
+
+    Jobs created without an env use Environment.default (or an overlay of it
+    for their environment variable keywords), so thousands of jobs with the
+    same overrides share one mapping instead of each copying os.environ
+    """
+
+    max_overlays = 64
+
+    def __init__(self, base=None, **overrides):
+        # base      -> mapping to start from (default: os.environ, including
+        #              later changes to it)
+        # overrides -> variables to add or replace
+        self._base = base
+        self._overrides = overrides
+        self._snapshot = None
+        self._mapping = None
+        self._overlays = OrderedDict()
+        self._lock = threading.Lock()
+
+    def __repr__(self):
+        return '%s(%s%s)' % (
+                self.__class__.__name__,
+                ('', 'base=<%d variables>' % len(self._base or ()))[self._base is not None],
+                ''.join(', %s=%r' % (k, v) for k, v in sorted(self._overrides.items())),
+                )
+
+    def mapping(self):
+        "the complete environment as a dict; shared, so do not change it"
+        data = _environ_data() if self._base is None else self._base
+        mapping = self._mapping
+        if mapping is None or data != self._snapshot:
+            scription_debug('building environment', verbose=2)
+            snapshot = dict(data)
+            mapping = dict(os.environ if self._base is None else self._base)
+            mapping.update(self._overrides)
+            self._snapshot, self._mapping = snapshot, mapping
+        return mapping
+
+    def overlay(self, **overrides):
+        "return an Environment of this one plus overrides (cached)"
+        if not overrides:
+            return self
+        key = frozenset(overrides.items())
+        with self._lock:
+            overlay = self._overlays.pop(key, None)
+            if overlay is None:
+                combined = self._overrides.copy()
+                combined.update(overrides)
+                overlay = self.__class__(self._base, **combined)
+                if len(self._overlays) >= self.max_overlays:
+                    self._overlays.popitem(last=False)
+            self._overlays[key] = overlay
+        return overlay
+
+    def _child_env(self):
+        "env for Popen/exec: None when the child can simply inherit ours"
+        if self._base is None and not self._overrides:
+            return None
+        return self.mapping()
+
+Environment.default = Environment()
+
+class JobEvent(namedtuple('JobEvent', 'name time stdout stderr stdin value')):
+    """
+    something that happened to a Job: name is one of spawned, first-stdout-byte,
+    stdin-written, password-sent, echo-off, timeout-fired, signal-sent, exited,
+    or closed; time is from a monotonic clock; stdout, stderr, and stdin are the
+    bytes moved so far; value is the bytes written, passwords sent, timeout,
+    signal, or returncode, as appropriate
+    """
+    __slots__ = ()
+
+class JobTrace(object):
+    """
+    records the events of all Jobs while installed, for export as a Chrome trace
+    (load it at chrome://tracing or ui.perfetto.dev)
+
+        with JobTrace() as trace:
+            deploy()
+        trace.save('deploy-trace.json')
+    """
+
+    def __init__(self):
+        self.events = []
+        self._lock = threading.Lock()
+
+    def __call__(self, job, event):
+        with self._lock:
+            self.events.append((job.pid, ' '.join(job.args), event))
+
+    def __enter__(self):
+        return self.install()
+
+    def __exit__(self, *args):
+        self.uninstall()
+
+    def install(self):
+        "start recording events"
+        if self not in Job.event_hooks:
+            Job.event_hooks.append(self)
+        return self
+
+    def uninstall(self):
+        "stop recording events"
+        if self in Job.event_hooks:
+            Job.event_hooks.remove(self)
+
+    def chrome_trace(self):
+        "the events in Trace Event Format, with one row per job"
+        with self._lock:
+            events = list(self.events)
+        if not events:
+            return {'traceEvents': []}
+        origin = min(event.time for _, _, event in events)
+        microseconds = lambda t: int((t - origin) * 1000000)
+        trace = []
+        spans = OrderedDict()
+        for pid, command, event in events:
+            span = spans.setdefault(pid, [command, event.time, event.time])
+            span[1] = min(span[1], event.time)
+            span[2] = max(span[2], event.time)
+            trace.append({
+                    'name': event.name, 'ph': 'i', 's': 't', 'pid': 1, 'tid': pid,
+                    'ts': microseconds(event.time),
+                    'args': {
+                        'stdout': event.stdout, 'stderr': event.stderr,
+                        'stdin': event.stdin, 'value': event.value,
+                        },
+                    })
+        for pid, (command, start, end) in spans.items():
+            trace.append({
+                    'name': command, 'ph': 'X', 'pid': 1, 'tid': pid,
+                    'ts': microseconds(start), 'dur': microseconds(end) - microseconds(start),
+                    })
+            trace.append({
+                    'name': 'thread_name', 'ph': 'M', 'pid': 1, 'tid': pid,
+                    'args': {'name': '%s [%d]' % (command[:60], pid)},
+                    })
+        return {'traceEvents': trace}
+
+    def save(self, filename):
+        "write chrome_trace() to filename as JSON"
+        with open(filename, 'w') as trace:
+            json.dump(self.chrome_trace(), trace)
+
 class Job(object):
     """
     if pty is True runs command in a forked process, otherwise runs in a subprocess
@@ -1731,6 +2119,17 @@ class Job(object):
     returncode = None
     # if killed by a signal, record it
     signal = None
+    # resource usage of the finished child (from wait4), if available
+    rusage = None
+    # time.time() when child was started, first produced output, and exited
+    started = None
+    first_output = None
+    ended = None
+    # callables run with each Job when its child exits, e.g. to aggregate
+    # rusage across all the jobs in a script
+    exit_hooks = []
+    # callables run with each Job and JobEvent as things happen (see JobTrace)
+    event_hooks = []
     # if job is no longer alive
     terminated = False
     # if job has been closed
@@ -1742,32 +2141,121 @@ class Job(object):
     exceptions = None
     # emergency abort
     abort = False
+    # encoding used for stdout and stderr (None means keep as bytes)
+    encoding = 'utf-8'
+    # read sizes grow (and shrink) between these bounds as output arrives
+    min_read_size = 4096
+    max_read_size = 1024 * 1024
+    # seconds allowed for the child to die after each of kill_signals
+    kill_interval = 0.5
+    # start the child in its own session (pty children always are), so kill()
+    # and timeouts signal its whole process group -- grandchildren still
+    # holding our pipes open included
+    new_session = True
+    # also signal descendants that left the process group, found by walking
+    # /proc (Linux only)
+    kill_tree = False
+    # expect() keeps at most max_expect_buffer characters of unread stdout, and
+    # rescans the last expect_window already-searched characters when new data
+    # arrives so matches can span chunk boundaries
+    max_expect_buffer = 64 * 1024
+    expect_window = 1024
+    # results of the last successful expect(): the match object, and the
+    # unread output that preceded it
+    match = None
+    before = None
+
+    # environment given to the child: the shared Environment mapping until
+    # someone asks for it, then a copy of its own
+    _env = None
+    _env_shared = False
 
-    def __init__(self, args, cwd=None, pty=None, env=None, **new_env_vars):
+    @property
+    def env(self):
+        if self._env_shared:
+            self._env = dict(self._env)
+            self._env_shared = False
+        return self._env
+
+    @env.setter
+    def env(self, env):
+        self._env = env
+        self._env_shared = False
+
+    def __init__(self, args, cwd=None, pty=None, env=None, stdin=None, stdout=None, stderr=None, tee=False, **new_env_vars):
         # args        -> command to run
         # cwd         -> directory to run in
         # pty         -> False = subprocess, True = fork
+        # stdin       -> file descriptor to use as child's stdin instead of a pipe
+        # stdout      -> file name, file object, file descriptor, or DEVNULL to
+        #                send child's stdout to instead of capturing it
+        # stderr      -> same, for child's stderr
+        # tee         -> True = send output to stdout/stderr targets and capture it
         self.exceptions = []
         self._process_thread = None
-        env = self.env = (env or os.environ).copy()
-        if new_env_vars:
+        # notified by communicate()'s output thread whenever the child writes
+        self._output_arrived = threading.Condition()
+        self._decoders = {}
+        self._threads = []
+        self._writer = None
+        self._reap_lock = threading.Lock()
+        self._kill_timer = None
+        # process group to signal (None to signal just the child), and the
+        # (pid, start time) of descendants seen by kill_tree
+        self._pgid = None
+        self._tree = set()
+        # bytes moved so far, for JobEvents
+        self._byte_counts = {'stdout': 0, 'stderr': 0, 'stdin': 0}
+        if not env or isinstance(env, Environment):
+            # an empty env means ours, as always
+            environment = (env or Environment.default).overlay(**new_env_vars)
+            env = environment._child_env()
+            self._env = environment.mapping()
+            self._env_shared = True
+        else:
+            env = self.env = env.copy()
             env.update(new_env_vars)
         if pty and is_win:
             raise OSError("pty support for Job not currently implemented for Windows")
+        if pty and stdin is not None:
+            raise ValueError("stdin redirection is not supported with pty")
         self.kill_signals = list(KILL_SIGNALS)
         if isinstance(args, basestring):
             args = shlex.split(args)
         else:
             args = list(args)
+        self.args = args
         self.name = args[0]
+        self.started = time.time()
+        # files we opened for the child, and targets we copy output to
+        self._owned_fds = []
+        self._tee = {}
+        stdout = self._target_fd('stdout', stdout, tee)
+        stderr = self._target_fd('stderr', stderr, tee)
         if not pty:
             # use subprocess
             scription_debug('subprocess args:', args)
+            session = {}
+            if self.new_session and not is_win:
+                if PY2:
+                    session['preexec_fn'] = os.setsid
+                else:
+                    session['start_new_session'] = True
             try:
-                self.process = process = Popen(args, stdin=PIPE, stdout=PIPE, stderr=PIPE, cwd=cwd, env=env)
+                self.process = process = Popen(
+                        args,
+                        stdin=PIPE if stdin is None else stdin,
+                        stdout=PIPE if stdout is None else stdout,
+                        stderr=PIPE if stderr is None else stderr,
+                        cwd=cwd,
+                        env=env,
+                        close_fds=not is_win,
+                        **session
+                        )
             except OSError as exc:
                 scription_debug('subprocess cwd:', cwd)
                 scription_debug('subprocess env:', env)
+                self._close_owned_fds()
                 if exc.errno == 2:
                     self.pid = -1
                     self.closed = True
@@ -1780,16 +2268,20 @@ class Job(object):
                         return
                 raise
             self.pid = process.pid
+            if session:
+                self._pgid = process.pid
+            self._event('spawned')
             self.child_fd_out = process.stdout
             self.child_fd_in = process.stdin
             self.child_fd_err = process.stderr
             self.poll = self._log_wrap(process.poll, 'polling')
             self.terminate = self._log_wrap(process.terminate, 'terminating')
-            self.kill = self._log_wrap(process.kill, 'killing')
             self.send_signal = self._log_wrap(process.send_signal, 'sending signal')
         else:
             error_read, error_write = os.pipe()
             self.pid, self.child_fd = fork()
+            # fork() makes the child a session leader
+            self._pgid = self.pid
             if self.pid == 0: # child process
                 os.close(error_read)
                 self.child_fd_out = sys.stdout.fileno()
@@ -1797,16 +2289,15 @@ class Job(object):
                 os.close(error_write)
                 self.error_pipe = 2
                 try:
-                    max_fd = resource.getrlimit(resource.RLIMIT_NOFILE)[1]
-                    for fd in range(3, max_fd):
-                        try:
-                            os.close(fd)
-                        except OSError:
-                            pass
+                    if stdout is not None:
+                        os.dup2(stdout, 1)
+                    if stderr is not None:
+                        os.dup2(stderr, 2)
+                    _close_fds(3)
                     if cwd:
                         os.chdir(cwd)
-                    if self.env:
-                        os.execvpe(args[0], args, self.env)
+                    if env is not None:
+                        os.execvpe(args[0], args, env)
                     else:
                         os.execvp(args[0], args)
                 except Exception:
@@ -1814,10 +2305,14 @@ class Job(object):
                     self.write_error("EXCEPTION: %s --> %s(%s)" % (args[0], exc.__class__.__name__, ', '.join([repr(a) for a in exc.args])))
                     os._exit(Exit.UnknownError)
             # parent process
+            self._event('spawned')
             os.close(error_write)
             self.child_fd_out = self.child_fd
             self.child_fd_in = self.child_fd
             self.child_fd_err = error_read
+        if not self._tee:
+            # the child has its own copies now
+            self._close_owned_fds()
         # start reading output
         self._all_output = Queue()
         self._all_input = Queue()
@@ -1825,19 +2320,44 @@ class Job(object):
         self._stderr = []
         self._stdout_history = []
         self._stderr_history = []
+        # stdout collected by read()/expect() but not yet returned by them
+        self._unread = ''
+        self._expect_scanned = 0
+        # streams whose reader thread has finished
+        self._eof = set()
         def read_comm(name, channel, q):
             try:
-                if isinstance(channel, int):
-                    read = lambda size: os.read(channel, size)
-                else:
-                    read = channel.read
+                if not isinstance(channel, int):
+                    channel = channel.fileno()
+                reader = io.FileIO(channel, 'rb', closefd=False)
+                size = self.min_read_size
+                buffer = bytearray(size)
+                tee_fd = self._tee.get(name)
                 while not self.abort:
                     scription_debug('reading', name)
-                    data = read(1024)
+                    count = reader.readinto(memoryview(buffer)[:size])
+                    if count:
+                        if self.first_output is None:
+                            self.first_output = time.time()
+                        self._byte_counts[name] += count
+                        if name == 'stdout' and self._byte_counts[name] == count:
+                            self._event('first-stdout-byte')
+                        data = memoryview(buffer)[:count].tobytes()
+                        if tee_fd is not None:
+                            written = 0
+                            while written < count:
+                                written += os.write(tee_fd, memoryview(buffer)[written:count])
+                        if count == size and size < self.max_read_size:
+                            # child is producing faster than we read -- grow
+                            size = min(size * 2, self.max_read_size)
+                            if size > len(buffer):
+                                buffer = bytearray(size)
+                        elif count < size // 4 and size > self.min_read_size:
+                            size = max(size // 2, self.min_read_size)
+                    else:
+                        data = None
                     with io_lock:
-                        scription_debug('putting %s %r (%d bytes)' % (name, data, len(data)))
-                        if not data:
-                            data = None
+                        scription_debug('putting %s %r (%d bytes)' % (name, data, count or 0), verbose=2)
                         q.put((name, data))
                         if data is None:
                             break
@@ -1862,14 +2382,20 @@ class Job(object):
                 while not self.abort:
                     scription_debug('stdin waiting')
                     data = q.get()
-                    with io_lock:
-                        if data is None:
-                            scription_debug('dying stdin')
-                            break
-                        scription_debug('stdin writing', repr(data))
-                        write(data)
-                        scription_debug('   done writing', repr(data))
-                        flush()
+                    try:
+                        with io_lock:
+                            if data is None:
+                                scription_debug('dying stdin')
+                                break
+                            scription_debug('stdin writing', repr(data))
+                            write(data)
+                            scription_debug('   done writing', repr(data))
+                            flush()
+                            self._byte_counts['stdin'] += len(data)
+                        # hooks may use jobs (and io_lock) themselves
+                        self._event('stdin-written', len(data))
+                    finally:
+                        q.task_done()
                 else:
                     scription_debug('write_comm dying from self.abort')
             except Exception:
@@ -1878,24 +2404,299 @@ class Job(object):
                     pass
                 else:
                     raise self._set_exc(exc, traceback=tb)
-        t = Thread(target=read_comm, name='stdout', args=('stdout', self.child_fd_out, self._all_output))
-        t.daemon = True
-        t.start()
-        t = Thread(target=read_comm, name='stderr', args=('stderr', self.child_fd_err, self._all_output))
-        t.daemon = True
-        t.start()
-        t = Thread(target=write_comm, name='stdin', args=(self.child_fd_in, self._all_input))
-        t.daemon = True
-        t.start()
+        # redirected streams (child_fd_* is None) are not handled by us
+        self._active_readers = 0
+        for name, channel in (('stdout', self.child_fd_out), ('stderr', self.child_fd_err)):
+            if channel is not None:
+                t = Thread(target=read_comm, name=name, args=(name, channel, self._all_output))
+                t.daemon = True
+                t.start()
+                self._threads.append(t)
+                self._active_readers += 1
+        if self.child_fd_in is not None:
+            t = self._writer = Thread(target=write_comm, name='stdin', args=(self.child_fd_in, self._all_input))
+            t.daemon = True
+            t.start()
+            self._threads.append(t)
         # do not add the stdin thread to the list of threads that automatically die if the job dies, as
         # it has to be manually ended
 
+    def _add_stderr(self, message):
+        "add a scription-generated message to stderr (io_lock must be held)"
+        if self.encoding is None:
+            message = message.encode('utf-8')
+        self._stderr.append(message)
+
+    def _close_owned_fds(self):
+        for fd in self._owned_fds:
+            os.close(fd)
+        self._owned_fds = []
+
+    def _target_fd(self, stream, target, tee):
+        '''
+        return file descriptor to give the child for stream, or None if we read it
+
+        target can be a file name, file object, file descriptor, or DEVNULL
+        '''
+        if target is None:
+            return None
+        if target == DEVNULL:
+            fd = os.open(os.devnull, os.O_WRONLY)
+            self._owned_fds.append(fd)
+        elif isinstance(target, integer):
+            fd = target
+        elif isinstance(target, basestring) or hasattr(target, '__fspath__'):
+            fd = os.open(target, os.O_WRONLY | os.O_CREAT | os.O_TRUNC, 0o666)
+            self._owned_fds.append(fd)
+        else:
+            target.flush()
+            fd = target.fileno()
+        if tee:
+            self._tee[stream] = fd
+            return None
+        return fd
+
+    def _decode(self, stream, data, encoding, final=False):
+        "decode data from stream, keeping partial characters for the next chunk"
+        if encoding is None:
+            return data
+        decoder = self._decoders.get(stream)
+        if decoder is None:
+            decoder = self._decoders[stream] = codecs.getincrementaldecoder(encoding)()
+        return decoder.decode(data or b'', final)
+
     def _log_wrap(self, func, msg):
         def wrapper(*args, **kwds):
             scription_debug(msg, args, kwds)
             return func(*args, **kwds)
         return wrapper
 
+    def _wait_until(self, done, timeout):
+        """
+        wait at most timeout seconds for done() to be true, and return it
+
+        done() is checked each time the child produces output (if communicate()
+        is collecting it), and otherwise after waits growing from 1ms to 100ms
+        as things like echo changes and exits produce no output
+
+        parent method"""
+        deadline = _clock() + timeout
+        delay = 0.001
+        while not done():
+            remaining = deadline - _clock()
+            if remaining <= 0:
+                return False
+            with self._output_arrived:
+                self._output_arrived.wait(min(delay, remaining))
+            delay = min(delay * 2, 0.1)
+        return True
+
+    def _escalate(self, signals=None):
+        '''
+        send kill_signals, one every kill_interval seconds (using the scheduler),
+        until the child and its process group are gone; does not wait
+
+        parent method'''
+        if signals is None:
+            signals = list(self.kill_signals)
+        if self._gone():
+            return
+        if not signals:
+            # unable to kill job
+            self.abort = True
+            scription_debug('abort switch set')
+            self._set_exc(UnableToKillJob, 'Signals %s failed' % ', '.join(str(s) for s in self.kill_signals))
+            return
+        sig = signals.pop(0)
+        try:
+            self._signal(sig)
+        except OSError:
+            _, exc, tb = sys.exc_info()
+            if exc.errno not in (errno.ESRCH, errno.ECHILD):
+                self._set_exc(exc, traceback=tb)
+            return
+        self._kill_timer = _scheduler.schedule(self.kill_interval, self._escalate, signals)
+        if self._gone():
+            # died (and was reaped) before the timer was set
+            self._kill_timer.cancel()
+
+    def _reap(self, block=True):
+        '''
+        collect exit status and resource usage of child; returns True if child is
+        no longer running
+
+        parent method'''
+        if self.terminated:
+            return True
+        if not self._reap_lock.acquire(block):
+            # another thread is already waiting for the child
+            return False
+        try:
+            if self.terminated:
+                return True
+            reaped = self._reap_child(block)
+        finally:
+            self._reap_lock.release()
+        if reaped:
+            # outside the lock, so hooks can use the job
+            self._exited()
+        return reaped
+
+    def _reap_child(self, block):
+        if is_win:
+            if block:
+                self.process.wait()
+            elif self.process.poll() is None:
+                return False
+            self._set_exit(self.process.returncode, None)
+            return True
+        try:
+            pid, status, rusage = os.wait4(self.pid, 0 if block else os.WNOHANG)
+        except OSError:
+            _, exc, tb = sys.exc_info()
+            if exc.errno != errno.ECHILD:
+                raise self._set_exc(ExecuteError, str(exc), traceback=tb)
+            # already reaped (e.g. by Popen.poll) -- use its returncode, if any
+            scription_debug('child is dead', verbose=2)
+            returncode = None
+            if self.process is not None:
+                returncode = self.process.returncode
+            self._set_exit(returncode, None)
+            return True
+        if pid == 0:
+            return False
+        if os.WIFSIGNALED(status):
+            returncode = -os.WTERMSIG(status)
+        else:
+            returncode = os.WEXITSTATUS(status)
+        self._set_exit(returncode, rusage)
+        return True
+
+    def _set_exit(self, returncode, rusage):
+        self.ended = time.time()
+        self.terminated = True
+        self.rusage = rusage
+        if self._kill_timer is not None and self._group_gone():
+            self._kill_timer.cancel()
+        if returncode is not None:
+            self.returncode = returncode
+            self.signal = max(0, -returncode)
+            if self.process is not None:
+                # keep Popen from trying to reap (or signal) a reused pid
+                self.process.returncode = returncode
+        scription_debug('returncode:', self.returncode)
+
+    def _exited(self):
+        "run the hooks for a child that has just been reaped"
+        self._event('exited', self.returncode)
+        for hook in self.exit_hooks:
+            try:
+                hook(self)
+            except Exception:
+                logger.exception('Job exit hook %r failed' % (hook, ))
+
+    def _signal(self, sig):
+        """
+        send sig to child (unless it has already been reaped) or its process
+        group, and to any descendants found by kill_tree
+
+        raises ESRCH if there was nothing to signal
+        """
+        scription_debug('sending signal:', sig)
+        self._event('signal-sent', sig)
+        if self.kill_tree:
+            for pid in self._descendants():
+                try:
+                    os.kill(pid, sig)
+                except OSError:
+                    pass
+        if self._pgid is not None:
+            # the group outlives the child if grandchildren are still running
+            try:
+                os.killpg(self._pgid, sig)
+                return
+            except OSError:
+                # a just-forked pty child may not have called setsid() yet
+                _, exc, tb = sys.exc_info()
+                if exc.errno != errno.ESRCH or self.terminated:
+                    raise
+        if not self.terminated:
+            os.kill(self.pid, sig)
+
+    def _descendants(self):
+        """
+        return pids of the child's running descendants: those that have it (or
+        another descendant) as parent, are in its session, or were seen before
+
+        parent method"""
+        table = _process_table()
+        family = set([self.pid])
+        family.update(pid for pid, start in self._tree if pid in table and table[pid][4] == start)
+        found = True
+        while found:
+            found = False
+            for pid, (state, ppid, group, session, start) in table.items():
+                if pid not in family and (ppid in family or session == self.pid):
+                    family.add(pid)
+                    found = True
+        family.difference_update((self.pid, os.getpid()))
+        self._tree = set((pid, table[pid][4]) for pid in family if pid in table)
+        return [pid for pid, start in self._tree]
+
+    def _event(self, name, value=None):
+        "report a JobEvent to event_hooks"
+        if not self.event_hooks:
+            return
+        counts = self._byte_counts
+        event = JobEvent(name, _clock(), counts['stdout'], counts['stderr'], counts['stdin'], value)
+        for hook in list(self.event_hooks):
+            try:
+                hook(self, event)
+            except Exception:
+                logger.exception('Job event hook %r failed' % (hook, ))
+
+    def _gone(self):
+        """
+        return True if the child has exited, and nothing is left in its process
+        group
+
+        parent method"""
+        return self._reap(block=False) and self._group_gone()
+
+    def _group_gone(self):
+        "return True if nothing is left in the child's process group (or there isn't one)"
+        if self._pgid is None:
+            return True
+        try:
+            os.killpg(self._pgid, 0)
+        except OSError:
+            _, exc, tb = sys.exc_info()
+            return exc.errno == errno.ESRCH
+        # zombies count as gone (orphans are not always reaped promptly, e.g.
+        # in containers); without /proc we can't tell, so assume the worst
+        table = _process_table()
+        if not table:
+            return False
+        return not [
+                pid for pid, (state, ppid, group, session, start) in table.items()
+                if group == self._pgid and state != b'Z'
+                ]
+
+    def _wait(self, timeout):
+        '''
+        wait up to timeout seconds for child to exit; returns True if it did
+
+        parent method'''
+        deadline = _clock() + timeout
+        delay = 0.001
+        while not self._reap(block=False):
+            remaining = deadline - _clock()
+            if remaining <= 0:
+                return False
+            time.sleep(min(delay, remaining))
+            delay = min(delay * 2, 0.05)
+        return True
+
     def _set_exc(self, exc, message=None, traceback=None):
         'sets self.exceptions if not already set, or unsets if exc is None'
         scription_debug('setting exception to: %r' % (exc,))
@@ -1912,7 +2713,9 @@ class Job(object):
         # password_timeout  -> time allowed for successful password transmission
         # timeout           -> time allowed for successful completion of job
         # interactive       -> False = record only, 'echo' = echo output as we get it
+        # encoding          -> decode output with encoding, or None to keep raw bytes
         self.raise_if_exceptions()
+        self.encoding = encoding
         try:
             deadman_switch = None
             scription_debug('timeout: %r, password_timeout: %r' % (timeout, password_timeout))
@@ -1928,40 +2731,48 @@ class Job(object):
             if timeout is not None:
                 def prejudice():
                     scription_debug('timed out')
+                    self._event('timeout-fired', timeout)
                     message = '\nTIMEOUT: process failed to complete in %s seconds\n' % timeout
                     with io_lock:
-                        self._stderr.append(message)
+                        self._add_stderr(message)
                     self._set_exc(TimeoutError, message.strip())
-                    self.kill()
-                deadman_switch = threading.Timer(timeout, prejudice)
-                deadman_switch.name = 'deadman'
-                deadman_switch.start()
+                    self._escalate()
+                deadman_switch = _scheduler.schedule(timeout, prejudice)
             if self._process_thread is None:
                 def process_comm():
-                    active = 2
+                    # read()/expect() may have already seen some readers finish
+                    active = self._active_readers - len(self._eof)
                     while active and not self.abort:
                         # check if any threads still alive
                         try:
                             stream, data = self._all_output.get(timeout=1)
                         except Empty:
                             continue
+                        # the child has done something, wake up anyone waiting on it
+                        with self._output_arrived:
+                            self._output_arrived.notify_all()
                         with io_lock:
                             if data is None:
                                 active -= 1
                                 scription_debug('dead thread:', stream)
-                                continue
-                            if encoding is not None:
-                                data = data.decode(encoding)
+                                data = self._decode(stream, data, encoding, final=True)
+                                if not data:
+                                    continue
+                            else:
+                                data = self._decode(stream, data, encoding)
+                                if not data:
+                                    # only part of a character so far
+                                    continue
                             scription_debug('adding %r to %s' % (data, stream))
                             if stream == 'stdout':
                                 self._stdout.append(data)
                                 if interactive == 'echo':
-                                    echo(data, end='')
+                                    _echo_output(data, end='')
                                     sys.stdout.flush()
                             elif stream == 'stderr':
                                 self._stderr.append(data)
                                 if interactive == 'echo':
-                                    echo(data, end='', file=stderr)
+                                    _echo_output(data, end='', file=stderr)
                                     sys.stderr.flush()
                             else:
                                 self._set_exc(Exception, 'unknown stream: %r' % stream)
@@ -1993,13 +2804,15 @@ class Job(object):
             if passwords:
                 while passwords:
                     if self.process:
-                        # feed all passwords at once, after a short delay
-                        time.sleep(0.1)
+                        # feed all passwords at once, after the first output
+                        # (presumably a prompt) or a short delay
+                        self._wait_until(lambda: self.first_output is not None, 0.1)
                         pwd = passwords[0]
                         for next_pwd in passwords[1:]:
                             pwd += next_pwd
                         try:
                             self.write(pwd, )
+                            self._event('password-sent', len(passwords))
                         except IOError:
                             # ignore write errors (probably due to password not needed and job finishing)
                             self._set_exc(None)
@@ -2007,11 +2820,8 @@ class Job(object):
                     else:
                         try:
                             # pty -- look for echo off first
-                            remaining_timeout = password_timeout
-                            while remaining_timeout > 0 and self.get_echo() and self.is_alive():
-                                scription_debug('[echo: %s] waiting for echo off (%s remaining)' % (self.get_echo(), remaining_timeout))
-                                remaining_timeout -= 0.1
-                                time.sleep(0.1)
+                            scription_debug('waiting at most %s seconds for echo off' % (password_timeout, ))
+                            self._wait_until(lambda: not self.get_echo() or not self.is_alive(), password_timeout)
                             if not self.is_alive():
                                 # job died
                                 try:
@@ -2029,24 +2839,20 @@ class Job(object):
                                     self._set_exc(exc, traceback=tb)
                                     self.kill()
                                     raise exc
+                            self._event('echo-off')
                             pw, passwords = passwords[0], passwords[1:]
                             scription_debug('[echo: %s] writing password %r' % (self.get_echo(), pw))
                             self.write(pw, )
+                            self._event('password-sent', 1)
                         except IOError:
                             # ignore get_echo and write errors (probably due to password not needed and job finishing)
                             self._set_exc(None)
                             break
                 else:
                     # wait a moment for any passwords to be sent
-                    scription_debug('[echo: %s] sleeping at most 5 seconds so passwords can be sent and response read' % (self.get_echo(), ))
-                    waiting_time = 5.0
-                    while waiting_time > 0.05:
-                        if self.get_echo():
-                            scription_debug('[echo: %s] password entry finished' % (self.get_echo(), ))
-                            break
-                        scription_debug('[echo: %s]      quick sleep (%s remaning)' % (self.get_echo(), waiting_time))
-                        waiting_time -= 0.1
-                        time.sleep(0.1)
+                    scription_debug('[echo: %s] waiting at most 5 seconds so passwords can be sent and response read' % (self.get_echo(), ))
+                    if self._wait_until(lambda: self.get_echo() or not self.is_alive(), 5.0):
+                        scription_debug('[echo: %s] password entry finished' % (self.get_echo(), ))
                     else:
                         if not self.get_echo():
                             # host still wants a password -- not good
@@ -2054,7 +2860,7 @@ class Job(object):
                                 if self.is_alive():
                                     scription_debug('[echo: %s] PASSWORD FAILURE:  invalid passwords or none given' % (self.get_echo(), ))
                                     with io_lock:
-                                        self._stderr.append('Invalid/too few passwords\n')
+                                        self._add_stderr('Invalid/too few passwords\n')
                                     e = self._set_exc(FailedPassword)
                                     self.kill()
                                     raise e
@@ -2073,39 +2879,34 @@ class Job(object):
         finally:
             if self.process:
                 if not self.abort:
-                    self.returncode = self.process.wait()
+                    self._reap()
                 self.terminated = True
             if deadman_switch is not None:
                 scription_debug('cancelling deadman switch')
                 deadman_switch.cancel()
-                deadman_switch.join()
             scription_debug('closing job')
             self.close()
 
     def close(self, timeout=0):
-        'parent method - timeout=0 means terminate immediately'
+        'parent method - timeout=0 means terminate immediately (after a 0.1 second grace period)'
         if not self.closed:
             try:
-                if not self.abort:
-                    while self.is_alive() and timeout > 0:
-                        timeout -= 0.1
-                        time.sleep(0.1)
-                    if self.is_alive():
-                        self.terminate()
-                        time.sleep(0.1)
-                        if self.is_alive():
-                            self.kill(error='ignore')
-                            time.sleep(0.1)
+                if not self.abort and not self._wait(max(timeout, 0.1)):
+                    self._escalate()
+                    self._wait(self.kill_interval * (len(self.kill_signals) + 1))
                 # shutdown stdin thread
                 self._all_input.put(None)
                 # close handles and pipes
                 if self.process is not None:
-                    if not isinstance(self.child_fd_in, int):
-                        self.child_fd_in.close()
-                    if not isinstance(self.child_fd_out, int):
-                        self.child_fd_out.close()
-                    if not isinstance(self.child_fd_err, int):
-                        self.child_fd_err.close()
+                    for channel in (self.child_fd_in, self.child_fd_out, self.child_fd_err):
+                        if channel is not None and not isinstance(channel, int):
+                            try:
+                                channel.close()
+                            except (IOError, OSError):
+                                # unflushed input for a child that is gone
+                                exc_type, exc, tb = sys.exc_info()
+                                if exc.errno != errno.EPIPE:
+                                    raise
                 else:
                     for fd in (self.child_fd, self.child_fd_err):
                         try:
@@ -2120,17 +2921,29 @@ class Job(object):
                 self.child_fd_in = -1
                 self.child_fd_out = -1
                 self.child_fd_err = -1
-                time.sleep(0.1)
+                # give the i/o threads a moment to finish
+                for t in self._threads:
+                    t.join(0.1)
+                # output targets for tee
+                self._close_owned_fds()
                 self.closed = True
+                self._event('closed')
             except Exception:
                 exc_type, exc, tb = sys.exc_info()
                 self._set_exc(exc, traceback=tb)
             finally:
                 with io_lock:
-                    scription_debug('saving stdout')
-                    self.stdout = ''.join(self._stdout).replace('\r\n', '\n')
-                    scription_debug('saving stderr')
-                    self.stderr = ''.join(self._stderr).replace('\r\n', '\n')
+                    if self.encoding is None:
+                        # raw bytes are kept as-is
+                        scription_debug('saving stdout')
+                        self.stdout = b''.join(self._stdout)
+                        scription_debug('saving stderr')
+                        self.stderr = b''.join(self._stderr)
+                    else:
+                        scription_debug('saving stdout')
+                        self.stdout = ''.join(self._stdout).replace('\r\n', '\n')
+                        scription_debug('saving stderr')
+                        self.stderr = ''.join(self._stderr).replace('\r\n', '\n')
                 self.raise_if_exceptions()
 
     def fileno(self):
@@ -2160,32 +2973,11 @@ class Job(object):
     def is_alive(self):
         'parent method'
         scription_debug("checking for life")
-        time.sleep(0.1)
         if self.terminated:
             scription_debug("already terminated", verbose=2)
             return False
-        try:
-            scription_debug("asking O/S", verbose=2)
-            pid, status = os.waitpid(self.pid, os.WNOHANG)
-        except Exception:
-            _, exc, tb = sys.exc_info()
-            scription_debug('exc: %s' % (exc, ), verbose=2)
-            if isinstance(exc, OSError) and exc.errno == errno.ECHILD:
-                scription_debug('child is dead', verbose=2)
-                return False
-            scription_debug('recording exception', verbose=2)
-            raise self._set_exc(ExecuteError, str(exc), traceback=tb)
-        if pid != 0:
-            scription_debug('child dead, status available', verbose=2)
-            self.signal = status % 256
-            if self.signal:
-                self.returncode = -self.signal
-            else:
-                self.returncode = status >> 8
-            self.terminated = True
-            scription_debug('returncode:', self.returncode)
-            return False
-        return True
+        scription_debug("asking O/S", verbose=2)
+        return not self._reap(block=False)
 
     def kill(self, error='raise'):
         '''kills child job, or raises UnableToKillJob
@@ -2195,9 +2987,9 @@ class Job(object):
         for s in self.kill_signals:
             try:
                 scription_debug('killing with', s)
-                self.send_signal(s)
-                scription_debug('checking job for life')
-                if not self.is_alive():
+                self._signal(s)
+                scription_debug('waiting for job to die')
+                if self._wait_until(self._gone, self.kill_interval):
                     scription_debug('dead, exiting')
                     return
             except Exception:
@@ -2231,9 +3023,12 @@ class Job(object):
         "raise if any stored exceptions"
         scription_debug('saved exceptions: %r' % (self.exceptions, ))
         scription_debug('stderr: %r' % (self.stderr, ))
-        if self.stderr and len(self.stderr.split('\n')) == 1 and self.stderr.startswith('EXCEPTION: '):
+        stderr = self.stderr
+        if isinstance(stderr, bytes):
+            stderr = stderr.decode('utf-8', 'replace')
+        if stderr and len(stderr.split('\n')) == 1 and stderr.startswith('EXCEPTION: '):
             # report the exception raised when trying to start the child
-            msg = self.stderr[11:]
+            msg = stderr[11:]
             raise ExecuteError(msg, process=self)
         if not self.exceptions:
             return
@@ -2261,39 +3056,123 @@ class Job(object):
         final_exc = final_exc.__class__(error_text)
         raise_with_traceback(final_exc, None)
 
+    def _fetch(self, timeout=None):
+        """
+        move one chunk of output from the reader threads into stdout/stderr (and
+        stdout into the unread buffer); returns False if nothing arrived within
+        timeout seconds (None waits forever)
+
+        parent method"""
+        if self._process_thread is not None:
+            raise ExecuteError('output of %r is being collected by communicate()' % (self.name, ), process=self)
+        try:
+            stream, data = self._all_output.get(timeout=timeout)
+        except Empty:
+            return False
+        final = data is None
+        if final:
+            self._eof.add(stream)
+        data = self._decode(stream, data, self.encoding, final)
+        if data:
+            with io_lock:
+                if stream == 'stdout':
+                    self._stdout.append(data)
+                    self._unread = self._unread + data if self._unread else data
+                else:
+                    self._stderr.append(data)
+        return True
+
+    def _stdout_done(self):
+        "True if stdout has ended (or was never ours to read)"
+        return 'stdout' in self._eof or self.child_fd_out is None
+
     def read(self, max_size, block=True, encoding='utf-8'):
         # if block is False, return None if no data ready
         # otherwise, encode to string with encoding, or raw if
-        # encoding is None
+        # encoding is None; returns an empty string once stdout
+        # has ended
         #
-        # check for any unread data
-        while "looking for data":
-            while self._all_output.qsize() or block:
-                stream, data = self._all_output.get()
-                if encoding is not None:
-                    data = data.decode(encoding)
-                if stream == 'stdout':
-                    self._stdout.append(data)
-                elif stream == 'stderr':
-                    self._stderr.append(data)
-                else:
-                    try:
-                        raise Exception('unknown stream: %r' % stream)
-                    except Exception:
-                        _, exc, tb = sys.exc_info()
-                        raise self._set_exc(exc, traceback=tb)
-                if self._stdout:
-                    break
-            if self._stdout:
-                # TODO: make test case to expose below bug (self.pop)
-                data = self.pop(0)
-                if len(data) > max_size:
-                    # trim
-                    self._stdout.insert(0, data[max_size:])
-                self._stdout_history.append(data)
-                return data
-            elif not block:
+        # all data read is also kept in stdout
+        self.encoding = encoding
+        while not self._unread:
+            if self._stdout_done():
+                return b'' if encoding is None else ''
+            if not self._fetch(None if block else 0) and not block:
                 return None
+        data, self._unread = self._unread[:max_size], self._unread[max_size:]
+        self._expect_scanned = max(0, self._expect_scanned - len(data))
+        self._stdout_history.append(data)
+        return data
+
+    def expect(self, patterns, timeout=None, encoding='utf-8'):
+        """
+        wait for stdout to match one of patterns (a regex string or compiled
+        regex, or a list of them)
+
+        the earliest match in the output is returned (match.re tells which
+        pattern it was), and also saved as self.match; the unread output before
+        it is saved as self.before, and output after it is left for the next
+        read() or expect()
+
+        raises TimeoutError if no match within timeout seconds, and ExecuteError
+        if stdout ends first; only max_expect_buffer characters of unread output
+        are searched, but everything is still kept in stdout
+
+        parent method"""
+        if isinstance(patterns, (basestring, bytes)) or hasattr(patterns, 'search'):
+            patterns = [patterns]
+        patterns = [
+                p if hasattr(p, 'search') else re.compile(p)
+                for p in patterns
+                ]
+        self.encoding = encoding
+        if timeout is not None:
+            deadline = _clock() + timeout
+        while True:
+            buffer = self._unread
+            start = max(0, self._expect_scanned - self.expect_window)
+            found = None
+            for pattern in patterns:
+                match = pattern.search(buffer, start)
+                if match is not None and (found is None or match.start() < found.start()):
+                    found = match
+            if found is not None:
+                self.match = found
+                self.before = buffer[:found.start()]
+                self._stdout_history.append(buffer[:found.end()])
+                self._unread = buffer[found.end():]
+                self._expect_scanned = 0
+                return found
+            self._expect_scanned = len(buffer)
+            # these are for the caller to handle, so are not added to self.exceptions
+            if self._stdout_done():
+                raise ExecuteError(
+                        '%r: output ended before matching %s'
+                            % (self.name, ', '.join(repr(p.pattern) for p in patterns)),
+                        process=self,
+                        )
+            remaining = None
+            if timeout is not None:
+                remaining = deadline - _clock()
+                if remaining <= 0:
+                    raise TimeoutError(
+                            '%r: no match for %s after %r seconds'
+                                % (self.name, ', '.join(repr(p.pattern) for p in patterns), timeout),
+                            process=self,
+                            )
+            self._fetch(remaining)
+            # keep the buffer bounded; dropped output is still in stdout
+            excess = len(self._unread) - self.max_expect_buffer
+            if excess > 0:
+                self._stdout_history.append(self._unread[:excess])
+                self._unread = self._unread[excess:]
+                self._expect_scanned = max(0, self._expect_scanned - excess)
+
+    def sendline(self, line='', block=True):
+        'parent method'
+        if isinstance(line, bytes):
+            return self.write(line + b'\n', block=block)
+        return self.write(line + '\n', block=block)
 
     def send_signal(self, signal):
         "parent method"
@@ -2316,7 +3195,13 @@ class Job(object):
     def write(self, data, block=True):
         'parent method'
         scription_debug('writing %r' % data, verbose=2)
-        if not self.is_alive():
+        if self.child_fd_in is None:
+            try:
+                raise ExecuteError('stdin of %r is not connected to this job' % (self.name, ), process=self)
+            except ExecuteError:
+                _, exc, tb = sys.exc_info()
+                raise self._set_exc(exc, traceback=tb)
+        if self.terminated or self._reap(block=False):
             try:
                 raise OSError(errno.ECHILD, "No child processes")
             except Exception:
@@ -2324,10 +3209,14 @@ class Job(object):
                 raise self._set_exc(exc, traceback=tb)
         if not isinstance(data, bytes):
             data = data.encode('utf-8')
-        self._all_input.put(data)
+        q = self._all_input
+        q.put(data)
         if block:
-            while not self._all_input.empty():
-                time.sleep(0.1)
+            # woken by task_done() in the stdin thread; stop waiting if that
+            # thread has died (e.g. the child closed its stdin)
+            with q.all_tasks_done:
+                while q.unfinished_tasks and self._writer.is_alive():
+                    q.all_tasks_done.wait(0.1)
         return len(data)
 
     def write_error(self, data):
@@ -2336,26 +3225,673 @@ class Job(object):
             data = data.encode('utf-8')
         os.write(self.error_pipe, data)
 
-class ormclassmethod(object):
+class Pipeline(object):
+    """
+    runs commands with the stdout of each connected directly (via os.pipe) to
+    the stdin of the next -- no data passes through this process
+    """
 
-    def __init__(self, func):
-        self.func = func
+    # list of Jobs, one per command
+    stages = None
+    # stdout of the last stage
+    stdout = None
+    # stderr of all stages, combined and individually
+    stderr = None
+    stderrs = None
+    # returncode of the last stage, and of all stages
+    returncode = None
+    returncodes = None
+    # if pipeline has been closed
+    closed = False
 
-    def __get__(self, instance, owner):
-        if instance:
-            raise AttributeError('%r instance has no attribute %r' % (owner.__name__, self.func.__name__))
-        return self.func
+    def __init__(self, commands, cwd=None, env=None, **new_env_vars):
+        # commands    -> sequence of commands to run
+        # cwd         -> directory to run in
+        commands = list(commands)
+        if not commands:
+            raise ValueError('Pipeline needs at least one command')
+        self.stages = []
+        self._timeout_message = None
+        # the first command reads from a pipe we feed (and close) in communicate()
+        stdin, self._input_fd = os.pipe()
+        try:
+            for i, args in enumerate(commands):
+                read_fd = stdout = None
+                if i < len(commands) - 1:
+                    read_fd, stdout = os.pipe()
+                try:
+                    self.stages.append(Job(args, cwd=cwd, env=env, stdin=stdin, stdout=stdout, **new_env_vars))
+                finally:
+                    # the children have their own copies now
+                    for fd in (stdin, stdout):
+                        if fd is not None:
+                            os.close(fd)
+                    stdin = read_fd
+        except BaseException:
+            for fd in (stdin, self._input_fd):
+                if fd is not None:
+                    os.close(fd)
+            self._input_fd = None
+            self._kill_all()
+            raise
 
+    def __repr__(self):
+        return '%s(%r)' % (self.__class__.__name__, [job.name for job in self.stages])
+
+    def _collect(self):
+        self.returncodes = [job.returncode for job in self.stages]
+        self.returncode = self.returncodes[-1]
+        self.stdout = self.stages[-1].stdout
+        self.stderrs = [job.stderr for job in self.stages]
+        if self._timeout_message is not None:
+            self.stderrs[-1] += self._timeout_message
+        if None not in self.stderrs:
+            self.stderr = self.stderrs[0][:0].join(self.stderrs)
+
+    def _kill_all(self):
+        for job in self.stages:
+            job._escalate()
+
+    def communicate(self, input=None, timeout=None, interactive=None, encoding='utf-8'):
+        # input             -> data for the first command
+        # timeout           -> time allowed for successful completion of all commands
+        # interactive       -> False = record only, 'echo' = echo output as we get it
+        # encoding          -> decode output with encoding, or None to keep raw bytes
+        deadman_switch = None
+        errors = []
+        def run(job, kwds):
+            try:
+                job.communicate(**kwds)
+            except Exception:
+                errors.append(sys.exc_info()[1])
+        def feed(fd, data):
+            try:
+                while data:
+                    data = data[os.write(fd, data):]
+            except OSError:
+                exc = sys.exc_info()[1]
+                if exc.errno != errno.EPIPE:
+                    errors.append(exc)
+            finally:
+                os.close(fd)
+        if isinstance(input, unicode):
+            input = input.encode('utf-8')
+        try:
+            if timeout is not None:
+                def prejudice():
+                    scription_debug('pipeline timed out')
+                    message = '\nTIMEOUT: process failed to complete in %s seconds\n' % timeout
+                    if encoding is None:
+                        message = message.encode('utf-8')
+                    self._timeout_message = message
+                    self._kill_all()
+                deadman_switch = _scheduler.schedule(timeout, prejudice)
+            threads = []
+            fd, self._input_fd = self._input_fd, None
+            t = Thread(target=feed, name='pipeline-stdin', args=(fd, input))
+            t.start()
+            threads.append(t)
+            for i, job in enumerate(self.stages):
+                kwds = dict(interactive=interactive, encoding=encoding)
+                t = Thread(target=run, name='pipeline-%d' % i, args=(job, kwds))
+                t.start()
+                threads.append(t)
+            for t in threads:
+                t.join()
+        finally:
+            if deadman_switch is not None:
+                deadman_switch.cancel()
+            self.close()
+        if self._timeout_message is not None:
+            raise TimeoutError(self._timeout_message.strip(), process=self)
+        if errors:
+            raise errors[0]
 
-class OrmSection(NameSpace):
+    def close(self):
+        if not self.closed:
+            try:
+                if self._input_fd is not None:
+                    os.close(self._input_fd)
+                    self._input_fd = None
+                for job in self.stages:
+                    try:
+                        job.close()
+                    except Exception:
+                        # recorded in job.exceptions
+                        pass
+                self.closed = True
+            finally:
+                self._collect()
 
-    __slots__ = '_OrmSection__name_', '_OrmSection__order_', '_OrmSection__comment_'
+def _execute_pipe(*commands, **kwds):
+    """
+    run commands as a Pipeline, e.g. Execute.pipe(['zcat', f], ['grep', 'foo'], ['sort'])
 
-    def __init__(self, comment='', name=None):
-        super(OrmSection, self).__init__()
-        self.__order_ = []
-        self.__name_ = name
-        self.__comment_ = None
+    cwd, env, input, timeout, interactive, encoding, and environment variables
+    are accepted as for Execute
+    """
+    cwd = kwds.pop('cwd', None)
+    env = kwds.pop('env', None)
+    input = kwds.pop('input', None)
+    timeout = kwds.pop('timeout', None)
+    interactive = kwds.pop('interactive', None)
+    encoding = kwds.pop('encoding', 'utf-8')
+    scription_debug('creating pipeline:', commands)
+    pipeline = Pipeline(commands, cwd=cwd, env=env, **kwds)
+    try:
+        scription_debug('communicating')
+        pipeline.communicate(input=input, timeout=timeout, interactive=interactive, encoding=encoding)
+    except BaseException as exc:
+        if getattr(exc, 'process', None) is None:
+            exc.process = pipeline
+        if interactive is None:
+            _echo_output(pipeline.stdout)
+            _echo_output(pipeline.stderr)
+            echo()
+        scription_debug(exc)
+        raise
+    finally:
+        pipeline.close()
+    scription_debug('returning')
+    return pipeline
+Execute.pipe = _execute_pipe
+
+class JobResult(object):
+    """
+    read-only record of a finished command
+    """
+
+    __slots__ = 'args', 'name', 'returncode', 'signal', 'stdout', 'stderr'
+
+    def __init__(self, args, returncode, stdout, stderr, signal=None):
+        for name, value in (
+                ('args', args), ('name', args[0]), ('returncode', returncode),
+                ('signal', signal), ('stdout', stdout), ('stderr', stderr),
+            ):
+            object.__setattr__(self, name, value)
+
+    def __repr__(self):
+        return '%s(%r, returncode=%r)' % (self.__class__.__name__, self.args, self.returncode)
+
+    def __setattr__(self, name, value):
+        raise AttributeError('%s is read-only' % (self.__class__.__name__, ))
+
+    __delattr__ = __setattr__
+
+
+class ShellSession(object):
+    """
+    runs commands through one long-lived shell, so each command costs a write
+    to the shell instead of a fork/exec and new threads
+
+        with ShellSession() as sh:
+            result = sh.run('stat -c %s some_file')
+
+    the shell's state (current directory, variables) carries over between
+    commands; each command's stdin is /dev/null
+    """
+
+    def __init__(self, shell='/bin/sh', cwd=None, env=None, encoding='utf-8', **new_env_vars):
+        # shell       -> shell to run commands with
+        # cwd         -> directory to start in
+        # encoding    -> decode output with encoding, or None to keep raw bytes
+        self.encoding = encoding
+        self.job = Job([shell], cwd=cwd, env=env, **new_env_vars)
+        self.job.raise_if_exceptions()
+        marker = 'scription-%s' % binascii.hexlify(os.urandom(8)).decode('ascii')
+        # each command is followed by a newline, the marker, and (on stdout) the
+        # exit code; the newline keeps output without one unambiguous
+        self._command = (
+                '{ %%s\n} </dev/null\n'
+                'scription_rc=$?\n'
+                "printf '\\n%s %%%%d\\n' $scription_rc\n"
+                "printf '\\n%s\\n' >&2\n"
+                % (marker, marker)
+                )
+        if encoding is None:
+            marker = marker.encode('ascii')
+            self._stdout_end = re.compile(b'\n' + marker + b' (\\d+)\n')
+            self._stderr_end = re.compile(b'\n' + marker + b'\n')
+            self._empty = b''
+        else:
+            self._stdout_end = re.compile('\n' + marker + ' (\\d+)\n')
+            self._stderr_end = re.compile('\n' + marker + '\n')
+            self._empty = ''
+        self._pending = {'stdout': self._empty, 'stderr': self._empty}
+        self.closed = False
+
+    def __enter__(self):
+        return self
+
+    def __exit__(self, *args):
+        self.close()
+
+    def __repr__(self):
+        return '%s(%r)' % (self.__class__.__name__, self.job.name)
+
+    def _abandon(self):
+        "kill the shell -- it is no longer usable"
+        self.closed = True
+        self.job._escalate()
+        self.job.close()
+
+    def close(self, timeout=5):
+        "exit the shell (killing it if it does not exit within timeout seconds)"
+        if not self.closed:
+            self.closed = True
+            self.job._all_input.put(b'exit\n')
+            self.job.close(timeout=timeout)
+
+    def run(self, command, timeout=None):
+        '''
+        run command in the shell, returning a JobResult
+
+        if timeout expires the shell is killed and TimeoutError raised
+        '''
+        if self.closed:
+            raise ExecuteError('%r is closed' % (self, ), process=self.job)
+        script = self._command % command
+        scription_debug('session running:', command)
+        self.job._all_input.put(script.encode(self.encoding or 'utf-8'))
+        deadline = None
+        if timeout is not None:
+            deadline = _clock() + timeout
+        output = {}
+        ends = {'stdout': self._stdout_end, 'stderr': self._stderr_end}
+        queue = self.job._all_output
+        while len(output) < 2:
+            try:
+                if deadline is None:
+                    stream, data = queue.get()
+                else:
+                    stream, data = queue.get(timeout=max(0, deadline - _clock()))
+            except Empty:
+                self._abandon()
+                raise TimeoutError('TIMEOUT: %r failed to complete in %s seconds' % (command, timeout), process=self.job)
+            if data is None:
+                self._abandon()
+                raise ExecuteError('shell exited while running %r' % (command, ), process=self.job)
+            pending = self._pending[stream] + self.job._decode(stream, data, self.encoding)
+            match = ends[stream].search(pending, max(0, len(self._pending[stream]) - 64))
+            if match is None:
+                self._pending[stream] = pending
+                continue
+            output[stream] = pending[:match.start()], match
+            self._pending[stream] = pending[match.end():]
+        (stdout, match), (stderr, _) = output['stdout'], output['stderr']
+        return JobResult([command], int(match.group(1)), stdout, stderr)
+
+
+class _ExecuteCache(object):
+    """
+    results of Execute(..., cache=...) calls; kept in memory, and also on disk
+    (so they survive between runs) if `directory` is set -- it defaults to the
+    SCRIPTION_CACHE_DIR environment variable
+
+    only commands that succeed (returncode of 0) are cached
+    """
+
+    def __init__(self):
+        self.directory = os.environ.get('SCRIPTION_CACHE_DIR') or None
+        self.hits = 0
+        self.misses = 0
+        self._results = {}
+        self._lock = threading.Lock()
+
+    def __len__(self):
+        return len(self._results)
+
+    def __repr__(self):
+        return '<Execute.cache: %d hits, %d misses, %d results>' % (self.hits, self.misses, len(self))
+
+    def _path(self, key):
+        return os.path.join(self.directory, key + '.json')
+
+    def get(self, key, ttl):
+        "return cached JobResult for key, or None if missing or older than ttl seconds"
+        with self._lock:
+            entry = self._results.get(key)
+        if entry is None and self.directory:
+            entry = self._load(key)
+        if entry is not None:
+            created, result = entry
+            if ttl is True or time.time() - created <= ttl:
+                with self._lock:
+                    self.hits += 1
+                return result
+        with self._lock:
+            self.misses += 1
+        return None
+
+    def invalidate(self, args=None, cwd=None, env=None, pty=None, input=None, encoding='utf-8', **new_env_vars):
+        "forget the cached result for a command, or all results if no command given"
+        with self._lock:
+            if args is None:
+                keys = list(self._results)
+                self._results.clear()
+                if self.directory and os.path.isdir(self.directory):
+                    keys = [n[:-5] for n in os.listdir(self.directory) if n.endswith('.json')]
+            else:
+                keys = [self.key(args, cwd, env, pty, input, encoding, new_env_vars)]
+                self._results.pop(keys[0], None)
+            if self.directory:
+                for key in keys:
+                    try:
+                        os.remove(self._path(key))
+                    except OSError:
+                        pass
+
+    def key(self, args, cwd, env, pty, input, encoding, new_env_vars):
+        "identify a command by everything that can change its output"
+        if isinstance(args, basestring):
+            args = shlex.split(args)
+        if isinstance(env, Environment):
+            env = env.mapping()
+        if not env:
+            # the child gets ours
+            env = None
+            path = os.environ.get('PATH')
+        else:
+            path = env.get('PATH')
+            env = sorted(env.items())
+        key = repr((
+                list(args), os.path.abspath(cwd or os.curdir), path, env,
+                sorted(new_env_vars.items()), bool(pty), input, encoding,
+                ))
+        return hashlib.sha1(key.encode('utf-8')).hexdigest()
+
+    def _load(self, key):
+        try:
+            with open(self._path(key)) as f:
+                data = json.load(f)
+        except (IOError, OSError, ValueError):
+            return None
+        stdout, stderr = data['stdout'], data['stderr']
+        if data['raw']:
+            stdout = binascii.a2b_base64(stdout)
+            stderr = binascii.a2b_base64(stderr)
+        entry = data['created'], JobResult(data['args'], data['returncode'], stdout, stderr)
+        with self._lock:
+            self._results[key] = entry
+        return entry
+
+    def put(self, key, result):
+        created = time.time()
+        with self._lock:
+            self._results[key] = created, result
+        if not self.directory:
+            return
+        stdout, stderr = result.stdout, result.stderr
+        raw = isinstance(stdout, bytes)
+        if raw:
+            stdout = binascii.b2a_base64(stdout).decode('ascii')
+            stderr = binascii.b2a_base64(stderr).decode('ascii')
+        data = dict(
+                created=created, args=result.args, returncode=result.returncode,
+                stdout=stdout, stderr=stderr, raw=raw,
+                )
+        if not os.path.isdir(self.directory):
+            try:
+                os.makedirs(self.directory)
+            except OSError:
+                # another thread or process got there first
+                if not os.path.isdir(self.directory):
+                    raise
+        # readers never see a partial entry
+        _atomic_write(self._path(key), json.dumps(data).encode('utf-8'), private=True)
+
+Execute.cache = _ExecuteCache()
+
+
+class JobPool(object):
+    """
+    runs commands as Jobs, at most max_workers at a time; iterating over the
+    pool yields each Job as it finishes
+
+    if fail_fast is True, the first failure (exception or non-zero returncode)
+    kills the remaining jobs and is raised; otherwise failed jobs are yielded
+    like any other and also collected in `failures` -- commands that could not
+    be started at all as a JobResult with a returncode of None and the error
+    as its stderr
+    """
+
+    # arguments for Job.communicate (everything else goes to Job)
+    _communicate_args = 'input', 'input_delay', 'password', 'password_timeout', 'timeout', 'encoding'
+
+    def __init__(self, max_workers=None, timeout=None, fail_fast=False, interactive=None):
+        # max_workers       -> number of jobs to run at once
+        # timeout           -> time allowed for all submitted jobs to complete
+        # fail_fast         -> True = stop everything at first failure
+        # interactive       -> None/False = record only, 'echo' = echo each job's
+        #                      output, prefixed by its name, as it finishes
+        self.max_workers = max_workers or 8
+        self.timeout = timeout
+        self.fail_fast = fail_fast
+        self.interactive = interactive
+        self.failures = []
+        self._lock = threading.Lock()
+        self._pending = deque()
+        self._finished = Queue()
+        self._running = set()
+        self._workers = 0
+        self._submitted = 0
+        self._yielded = 0
+        self._deadline = None
+        self._shutdown = False
+
+    def __iter__(self):
+        while self._yielded < self._submitted:
+            name, job, exc = self._next_finished()
+            self._yielded += 1
+            if self.interactive == 'echo':
+                self._echo(name, job)
+            if exc is not None or job.returncode:
+                self.failures.append(job)
+                if self.fail_fast:
+                    self.shutdown()
+                    if exc is None:
+                        exc = ExecuteError('%s: returned %s' % (name, job.returncode), process=job)
+                    raise exc
+            yield job
+
+    def __len__(self):
+        return self._submitted
+
+    def __repr__(self):
+        return '%s(max_workers=%r)' % (self.__class__.__name__, self.max_workers)
+
+    def _echo(self, name, job):
+        with print_lock:
+            for output, file in ((job.stdout, stdout), (job.stderr, stderr)):
+                if isinstance(output, bytes):
+                    output = output.decode('utf-8', 'replace')
+                for line in (output or '').splitlines():
+                    echo('%s: %s' % (name, line), file=file)
+
+    def _next_finished(self):
+        if self._deadline is None:
+            return self._finished.get()
+        try:
+            return self._finished.get(timeout=max(0, self._deadline - time.time()))
+        except Empty:
+            self.shutdown()
+            raise TimeoutError('TIMEOUT: jobs failed to complete in %s seconds' % self.timeout)
+
+    def _run(self, name, args, kwds):
+        communicate_kwds = dict(
+                (k, kwds.pop(k))
+                for k in self._communicate_args
+                if k in kwds
+                )
+        job = exc = None
+        try:
+            job = Job(args, **kwds)
+            with self._lock:
+                self._running.add(job)
+                cancelled = self._shutdown
+            try:
+                if cancelled:
+                    job._escalate()
+                job.communicate(interactive=False, **communicate_kwds)
+            finally:
+                with self._lock:
+                    self._running.discard(job)
+        except Exception:
+            exc = sys.exc_info()[1]
+            if job is None:
+                job = getattr(exc, 'process', None)
+        if job is None:
+            # unable to even create the Job
+            if isinstance(args, basestring):
+                args = shlex.split(args)
+            stderr = '%s\n' % (exc, )
+            if communicate_kwds.get('encoding', 'utf-8') is None:
+                job = JobResult(list(args), None, b'', stderr.encode('utf-8'))
+            else:
+                job = JobResult(list(args), None, '', stderr)
+        self._finished.put((name, job, exc))
+
+    def _work(self):
+        while True:
+            with self._lock:
+                if self._shutdown or not self._pending:
+                    self._workers -= 1
+                    return
+                name, args, kwds = self._pending.popleft()
+            self._run(name, args, kwds)
+
+    def shutdown(self):
+        "cancel pending jobs and kill running ones"
+        with self._lock:
+            self._shutdown = True
+            self._pending.clear()
+            running = list(self._running)
+        for job in running:
+            job._escalate()
+
+    def submit(self, args, name=None, **kwds):
+        '''
+        add command to the pool; keywords are as for Execute
+
+        name is used to prefix echoed output, and defaults to the command line
+        '''
+        if name is None:
+            if isinstance(args, basestring):
+                name = args
+            else:
+                name = ' '.join(args)
+        with self._lock:
+            if self._shutdown:
+                raise ExecuteError('JobPool has been shut down')
+            if self._deadline is None and self.timeout is not None:
+                self._deadline = time.time() + self.timeout
+            self._pending.append((name, args, kwds))
+            self._submitted += 1
+            if self._workers < self.max_workers:
+                self._workers += 1
+                t = Thread(target=self._work, name='job-pool')
+                t.daemon = True
+                t.start()
+
+def _execute_map(commands, jobs=None, fail_fast=False, total_timeout=None, interactive=None, **kwds):
+    """
+    run commands, at most `jobs` at a time, and return a JobPool that yields each
+    Job as it finishes
+
+    other keywords are as for Execute (timeout is per command; total_timeout is
+    for all of them)
+    """
+    pool = JobPool(jobs, timeout=total_timeout, fail_fast=fail_fast, interactive=interactive)
+    for args in commands:
+        pool.submit(args, **kwds)
+    return pool
+Execute.map = _execute_map
+
+# one entry per setting, section header, or other non-comment line
+# (name, value, header, other); unmatched groups are empty
+_orm_lines = re.compile(r"""
+        ^[ \t]*
+        (?:
+            ([^\s=\[#;][^=\n]*) = ([^\n]*)
+          | \[ ([^\n]*) \] [ \t\r]*$
+          | ([^\s#;][^\n]*)
+        )
+        """, re.MULTILINE | re.VERBOSE).findall
+_orm_name = re.compile(r'\w*\Z', re.UNICODE).match
+_orm_has_digit = re.compile(r'\d', re.UNICODE).search
+# bytes version of _orm_lines, for finding where values are
+_orm_byte_lines = re.compile(br"""
+        ^[ \t]*
+        (?:
+            ([^\s=\[#;][^=\n]*) = ([^\n]*)
+          | \[ ([^\n]*) \] [ \t\r]*$
+          | ([^\s#;][^\n]*)
+        )
+        """, re.MULTILINE | re.VERBOSE).finditer
+# start of each section header
+_orm_headers = re.compile(br'^[ \t]*\[([^\n]*)\][ \t\r]*$', re.MULTILINE).finditer
+# change when cached OrmFile settings can no longer be used
+_orm_cache_version = 1
+# converted values of these types can be shared between settings
+_orm_immutable_types = set([
+        bool, int, float, type(None), unicode, str,
+        datetime.date, datetime.time, datetime.datetime,
+        ])
+if PY2:
+    _orm_immutable_types.add(long)
+# held while OrmSection settings change and while snapshots are taken
+_orm_lock = threading.Lock()
+# counts changes to OrmSection settings, so unchanged settings are cheap to snapshot
+_orm_changes = [0]
+# the settings of the most recently used layered files, by file, file stamp,
+# and how they were read
+_orm_parse_cache = OrderedDict()
+_orm_parse_cache_size = 32
+_orm_parse_lock = threading.Lock()
+
+class ormclassmethod(object):
+
+    def __init__(self, func):
+        self.func = func
+
+    def __get__(self, instance, owner):
+        if instance:
+            raise AttributeError('%r instance has no attribute %r' % (owner.__name__, self.func.__name__))
+        return self.func
+
+
+class OrmSection(NameSpace):
+    """
+    settings of one section
+
+    names not set in the section itself are looked up in its parent sections
+    (the last of which holds the defaults); section values are not inherited
+
+    values read lazily are kept as text until first used; names assigned to
+    since the section was read or saved are kept track of, as are copies of
+    mutable values (to notice changes made to them in place) and the
+    section's last snapshot
+    """
+
+    __slots__ = (
+            '_OrmSection__name_', '_OrmSection__order_', '_OrmSection__comment_',
+            '_OrmSection__parent_', '_OrmSection__raw_', '_OrmSection__convert_',
+            '_OrmSection__inheritable_', '_OrmSection__changed_', '_OrmSection__frozen_',
+            '_OrmSection__mutable_',
+            )
+
+    def __init__(self, comment='', name=None):
+        super(OrmSection, self).__init__()
+        self.__order_ = []
+        self.__name_ = name
+        self.__comment_ = None
+        self.__parent_ = None
+        self.__raw_ = None
+        self.__convert_ = None
+        self.__inheritable_ = None
+        self.__changed_ = None
+        self.__frozen_ = None
+        self.__mutable_ = None
         if comment:
             self.__comment_ = '; ' + comment.replace('\n','\n; ')
 
@@ -2364,34 +3900,246 @@ class OrmSection(NameSpace):
             raise TypeError('nameless OrmSection is not hashable')
         return hash(self.__name_)
 
+    def __eq__(self, other):
+        if not isinstance(other, self.__class__):
+            return NotImplemented
+        return dict(self.__items()) == dict(other.__items())
+
+    def __ne__(self, other):
+        if not isinstance(other, self.__class__):
+            return NotImplemented
+        return dict(self.__items()) != dict(other.__items())
+
+    def __contains__(self, name):
+        try:
+            self[name]
+            return True
+        except ScriptionError:
+            return False
+
     def __iter__(self):
-        for key in self.__order_:
-            yield key, self[key]
+        for item in self.__items().items():
+            yield item
+
+    def __getattr__(self, name):
+        # only called when name has not been set or converted in this section
+        if name[:1] != '_':
+            try:
+                return self.__own(name)
+            except KeyError:
+                pass
+            try:
+                return self.__inherited(name)
+            except KeyError:
+                pass
+        raise AttributeError('%r object has no attribute %r' % (self.__class__.__name__, name))
+
+    def __getitem__(self, name):
+        try:
+            return self.__own(name)
+        except KeyError:
+            pass
+        try:
+            return self.__inherited(name)
+        except KeyError:
+            raise ScriptionError("namespace object has nothing named %r" % name)
+
+    def __own(self, name):
+        "value of name from this section, converting it on first use"
+        values = self.__dict__
+        if name in values:
+            return values[name]
+        raw = self.__raw_
+        if not raw or name not in raw:
+            raise KeyError(name)
+        key = [name]
+        section = self
+        while section.__parent_ is not None:
+            key.insert(0, section.__name_)
+            section = section.__parent_
+        value = values.setdefault(name, self.__convert_('.'.join(key), raw[name]))
+        if self.__remember(name, value):
+            # snapshots have its text, but this copy can be changed in place
+            with _orm_lock:
+                self.__invalidate()
+        return value
+
+    def __remember(self, name, value):
+        """
+        keep a copy of value if it is mutable, so changes made to it in place
+        can be noticed; returns True if it is
+        """
+        if type(value) in _orm_immutable_types or isinstance(value, OrmSection):
+            if self.__mutable_:
+                self.__mutable_.pop(name, None)
+            return False
+        if self.__mutable_ is None:
+            self.__mutable_ = {}
+        self.__mutable_[name] = copy.deepcopy(value)
+        return True
+
+    def __notice(self):
+        "mark mutable values changed in place as assigned to (_orm_lock must be held)"
+        values = self.__dict__
+        for name, saved in list(self.__mutable_.items()):
+            value = values.get(name)
+            if type(value) is not type(saved) or value != saved:
+                self.__mutable_[name] = copy.deepcopy(value)
+                self.__assigned(name)
+
+    def __assigned(self, name):
+        "keep track of a change to name (_orm_lock must be held)"
+        self.__inheritable_ = None
+        self.__invalidate()
+        if self.__changed_ is None:
+            self.__changed_ = set()
+        self.__changed_.add(name)
+
+    def __invalidate(self):
+        "drop the last snapshot of this section and its parents (_orm_lock must be held)"
+        section = self
+        while section is not None and section.__frozen_ is not None:
+            section.__frozen_ = None
+            section = section.__parent_
+        _orm_changes[0] += 1
+
+    def __inherited(self, name):
+        "value of name from the nearest parent section that has it"
+        parent = self.__parent_
+        while parent is not None:
+            try:
+                value = parent.__own(name)
+            except KeyError:
+                parent = parent.__parent_
+                continue
+            if isinstance(value, OrmSection):
+                break
+            return value
+        raise KeyError(name)
+
+    def __items(self):
+        "inherited and own settings, in order"
+        if self.__parent_ is None:
+            return OrderedDict((name, self.__own(name)) for name in self.__order_)
+        chain = []
+        section = self
+        while section is not None:
+            chain.append(section)
+            section = section.__parent_
+        items = OrderedDict()
+        for section in reversed(chain[1:]):
+            values = section.__dict__
+            for name in list(items):
+                if isinstance(values.get(name), OrmSection):
+                    del items[name]
+            items.update(section.__inheritable())
+        for name in self.__order_:
+            items[name] = self.__own(name)
+        return items
+
+    def __inheritable(self):
+        "settings (not sections) of this section, in order"
+        inheritable = self.__inheritable_
+        if inheritable is None:
+            inheritable = OrderedDict()
+            for name in self.__order_:
+                value = self.__own(name)
+                if not isinstance(value, OrmSection):
+                    inheritable[name] = value
+            self.__inheritable_ = inheritable
+        return inheritable
 
     def __setattr__(self, name, value):
+        if name in self.__slots__:
+            return object.__setattr__(self, name, value)
         if isinstance(value, OrmSection) and value._OrmSection__name_ is None:
             value._OrmSection__name_ = name
-        res = super(OrmSection, self).__setattr__(name, value)
-        if name not in self.__slots__ and name not in self.__order_:
-            self.__order_.append(name)
-        return res
+        with _orm_lock:
+            if name not in self.__dict__ and not (self.__raw_ and name in self.__raw_):
+                self.__order_.append(name)
+            super(OrmSection, self).__setattr__(name, value)
+            self.__remember(name, value)
+            self.__assigned(name)
 
     def __setitem__(self, name, value):
+        if name in self.__slots__:
+            return super(OrmSection, self).__setitem__(name, value)
         if isinstance(value, OrmSection) and value._OrmSection__name_ is None:
             value._OrmSection__name_ = name
-        res = super(OrmSection, self).__setitem__(name, value)
-        if name not in self.__slots__ and name not in self.__order_:
-            self.__order_.append(name)
-        return res
+        with _orm_lock:
+            if name not in self.__dict__ and not (self.__raw_ and name in self.__raw_):
+                self.__order_.append(name)
+            super(OrmSection, self).__setitem__(name, value)
+            self.__remember(name, value)
+            self.__assigned(name)
 
     def __repr__(self):
-        return '%r' % (tuple(self.__dict__.items()), )
+        return '%r' % (tuple(self), )
+
+    def __getstate__(self):
+        # the converter belongs to the OrmFile that read the section
+        return self.__dict__, self.__name_, self.__order_, self.__comment_, self.__parent_, self.__raw_
+
+    def __setstate__(self, state):
+        # parent sections may not be restored yet, so skip __setattr__
+        self.__dict__.update(state[0])
+        for slot, value in zip(self.__slots__, state[1:] + (None, None, None, None, None)):
+            object.__setattr__(self, slot, value)
+        for name, value in state[0].items():
+            self.__remember(name, value)
+
+    def __frozen(self, key=''):
+        """
+        settings of this section and its subsections as they are now, reusing
+        the last snapshot of those that have not changed since
+
+        _orm_lock must be held
+        """
+        node = self.__frozen_
+        if node is not None and not node.detached:
+            # changes to subsections would have cleared it
+            return node
+        # lazily read values can be converted (and added) by readers meanwhile
+        values = list(self.__dict__.items())
+        subsections = []
+        detached = False
+        for name, value in values:
+            if isinstance(value, OrmSection):
+                subsection = value.__frozen(('%s.%s' % (key, name)).lstrip('.'))
+                subsections.append((name, subsection))
+                # changes to subsections not read with this one do not clear it
+                detached = detached or subsection.detached or value.__parent_ is not self
+        if node is not None:
+            for name, subsection in subsections:
+                if node.values.get(name) is not subsection:
+                    break
+            else:
+                return node
+        node = _OrmSnapshotNode()
+        node.values = {}
+        mutable = []
+        for name, value in values:
+            if not isinstance(value, OrmSection) and type(value) not in _orm_immutable_types:
+                value = copy.deepcopy(value)
+                mutable.append((self, name, value))
+            node.values[name] = value
+        node.values.update(subsections)
+        for name, subsection in subsections:
+            mutable.extend(subsection.mutable)
+        node.mutable = tuple(mutable)
+        node.order = tuple(self.__order_)
+        node.raw = self.__raw_
+        node.convert = self.__convert_
+        node.key = key
+        node.detached = detached
+        self.__frozen_ = node
+        return node
 
     @ormclassmethod
     def get(section, name, default=None):
         try:
-            return section.__dict__[name]
-        except KeyError:
+            return section[name]
+        except ScriptionError:
             return default
 
 
@@ -2408,6 +4156,33 @@ class OrmFile(object):
 
     if `plain` is True, then only True/False/None and numbers are
     converted, everything else is a string.
+
+    if `lazy` is True, values are kept as text and converted when first
+    used.
+
+    if `cache` is True, the parsed settings are saved next to the file
+    (or in the `cache` directory, if one is given) and reused until the
+    file changes.
+
+    if `section` is given (and `cache` is not), only the defaults and that
+    section, its parents, and its subsections are read; with `index`, the
+    positions of the sections are saved next to the file so the rest of it
+    need not be read either.
+
+    `reload_if_changed()` reads the file again if it has changed, and
+    `watch()` does so from a background thread; the new settings replace
+    the old ones all at once, and `subscribe()`d callbacks are told which
+    settings changed.
+
+    `snapshot()` returns a read-only copy of the settings that other
+    threads can read without locking while the settings are changed.
+
+    if `filename` is a list of files, their settings are layered: each
+    file's settings and sections replace those of the files before it,
+    and, as usual, section settings replace the defaults, whichever file
+    they came from.  Each file is read once per process for as long as it
+    is unchanged, no matter how many layered OrmFiles use it.  Layered
+    OrmFiles cannot be saved, cached, or indexed.
     """
     _str = unicode
     _path = unicode
@@ -2419,75 +4194,38 @@ class OrmFile(object):
     _int = int
     _none = lambda s: None
 
-    def __init__(self, filename, section=None, export_to=None, types={}, encoding='utf-8', plain=False):
+    def __init__(self, filename, section=None, export_to=None, types={}, encoding='utf-8', plain=False, lazy=False, cache=False, index=False):
         # if section, only return defaults merged with section
         # if export_to, it should be a mapping, and will be populated
         # with the settings
         # if types, use those instead of the default orm types
-        for n, t in types.items():
-            if n not in (
-                    '_str', '_path', '_date', '_time', '_datetime',
-                    '_bool', '_float', '_int',
-                    ):
-                raise TypeError('OrmFile %r: invalid orm type -> %r' % (filename, n))
-            setattr(self, n, t)
-        target_sections = []
-        self._saveable = True
-        if section:
-            target_sections = section.lower().split('.')
-            self._saveable = False
+        # if lazy, convert values on first use instead of while reading
+        # if cache, reuse the settings from the last time filename was read
+        # if index, find section in filename using its saved section positions
+        self._set_types(filename, types)
+        self._layers = None
+        if not isinstance(filename, basestring):
+            self._layers = tuple(filename)
+            if not self._layers:
+                raise OrmError('OrmFile %r: no files to layer' % (filename, ))
+            if cache or index:
+                raise OrmError('OrmFile %r: layered files cannot be cached or indexed' % (filename, ))
+        self._saveable = not section and not self._layers
         self._section = section
         self._filename = filename
-        defaults = OrderedDict()
-        settings = self._settings = OrmSection(name=filename)
-        if not os.path.exists(filename):
-            open(filename, 'w').close()
-        if PY2:
-            fh = open(filename)
-        else:
-            fh = open(filename, encoding=encoding)
-        try:
-            section = None
-            for line in fh:
-                if PY2:
-                    line = line.decode(encoding)
-                line = line.strip()
-                if not line or line.startswith(('#',';')):
-                    continue
-                if line[0] == '[':
-                    # better be a section header
-                    if line[-1] != ']':
-                        raise OrmError('OrmFile %r; section headers must start and end with "[]" [got %r]' % (filename, line, ))
-                    sections = self._verify_section_header(line[1:-1])
-                    prior, section = sections[:-1], sections[-1]
-                    new_section = OrmSection(name=section)
-                    for key, value in defaults.items():
-                        setattr(new_section, key, value)
-                    prev_namespace = self
-                    for prev_name in prior:
-                        prev_namespace = prev_namespace[prev_name]
-                        for key_value in prev_namespace:
-                            key, value = key_value
-                            if not isinstance(value, OrmSection):
-                                setattr(new_section, key, value)
-                    setattr(prev_namespace, section, new_section)
-                else:
-                    # setting
-                    name, value = line.split('=', 1)
-                    name = self._verify_name(name)
-                    value = self._verify_value(value, plain=plain)
-                    if section:
-                        setattr(new_section, name, value)
-                    else:
-                        setattr(settings, name, value)
-                        defaults[name] = value
-        finally:
-            fh.close()
-        for section in target_sections:
-            settings = settings[section]
-        self._settings = settings
+        self._encoding = encoding
+        self._options = plain, lazy, cache, index
+        self._subscribers = []
+        self._watcher = None
+        self._reload_lock = threading.Lock()
+        self._snapshot = None
+        for name in self._layers or (filename, ):
+            if not os.path.exists(name):
+                open(name, 'w').close()
+        self._stamp = self._file_stamp()
+        settings = self._settings = self._load()
         if export_to is not None:
-            for name, value in settings.__dict__.items():
+            for name, value in settings:
                 if name[0] != '_':
                     export_to[name] = value
 
@@ -2523,8 +4261,10 @@ class OrmFile(object):
 
     def __getattr__(self, name):
         name = name.lower()
-        if name in self._settings.__dict__:
-            return getattr(self._settings, name)
+        # the settings may be replaced by a reload at any time
+        settings = self._settings
+        if name in settings:
+            return settings[name]
         raise OrmError("OrmFile %r: no section/default named %r" % (self._filename, name))
 
     def __getitem__(self, name):
@@ -2532,7 +4272,9 @@ class OrmFile(object):
 
     def __setattr__(self, name, value):
         if name in (
-                '_settings', '_filename', '_section', '_saveable',
+                '_settings', '_filename', '_section', '_saveable', '_encoding',
+                '_options', '_stamp', '_subscribers', '_watcher', '_reload_lock', '_snapshot',
+                '_layers',
                 '_str', '_path', '_date', '_time', '_datetime', '_bool', '_float', '_int',
                 ):
             object.__setattr__(self, name, value)
@@ -2542,11 +4284,341 @@ class OrmFile(object):
     def __setitem__(self, name, value):
         self._settings[name] = value
 
+    def _load(self):
+        "read the file, and return its settings (or those of the section asked for)"
+        filename, section, encoding = self._filename, self._section, self._encoding
+        plain, lazy, cache, index = self._options
+        settings = None
+        if self._layers:
+            settings = OrmSection(name=filename)
+            convert = None
+            if lazy:
+                convert = lambda key, value: self._convert(key, value, plain)
+                settings._OrmSection__raw_ = {}
+                settings._OrmSection__convert_ = convert
+            for layer in self._layers:
+                self._merge(settings, self._layer(layer, plain, lazy), convert)
+        elif cache:
+            cache_path, cache_key = self._cache_key(cache, encoding, plain, lazy)
+            settings = self._cache_load(cache_path, cache_key, plain)
+        if settings is None:
+            settings = OrmSection(name=filename)
+            text = None
+            if section and not cache:
+                text = self._read_sections(section.lower(), encoding, index)
+            if text is None:
+                if PY2:
+                    with open(filename) as fh:
+                        text = fh.read().decode(encoding)
+                else:
+                    with open(filename, encoding=encoding) as fh:
+                        text = fh.read()
+            self._parse(text, settings, plain, lazy)
+            if cache:
+                self._cache_save(cache_path, cache_key, settings)
+        if section:
+            for name in section.lower().split('.'):
+                settings = settings[name]
+        return settings
+
+    def _file_stamp(self, filename=None):
+        "(mtime, size, inode) of the file (or of each layered file), which change when it does"
+        if filename is None and self._layers:
+            return tuple(self._file_stamp(layer) for layer in self._layers)
+        stat = os.stat(filename or self._filename)
+        return getattr(stat, 'st_mtime_ns', stat.st_mtime), stat.st_size, stat.st_ino
+
+    def _layer(self, filename, plain, lazy):
+        """
+        settings of one of the layered files, read only if they are not in the
+        parse cache -- they are shared, so must not be changed
+        """
+        key = (
+                os.path.abspath(filename), self._file_stamp(filename), self._encoding, plain, lazy,
+                type(self), self._str, self._path, self._date, self._time, self._datetime,
+                self._bool, self._float, self._int,
+                )
+        with _orm_parse_lock:
+            settings = _orm_parse_cache.pop(key, None)
+            if settings is not None:
+                # now the most recently used
+                _orm_parse_cache[key] = settings
+                return settings
+        if PY2:
+            with open(filename) as fh:
+                text = fh.read().decode(self._encoding)
+        else:
+            with open(filename, encoding=self._encoding) as fh:
+                text = fh.read()
+        settings = OrmSection(name=filename)
+        try:
+            self._parse(text, settings, plain, lazy)
+        except OrmError:
+            exc = sys.exc_info()[1]
+            raise OrmError('%s [file %r]' % (exc, filename))
+        with _orm_parse_lock:
+            _orm_parse_cache[key] = settings
+            while len(_orm_parse_cache) > _orm_parse_cache_size:
+                _orm_parse_cache.popitem(last=False)
+        return settings
+
+    def _merge(self, settings, layer, convert):
+        """
+        add the settings and sections of layer to settings, replacing those
+        already there; values are copied, so the layer is left unchanged
+        """
+        values = settings.__dict__
+        raw = settings._OrmSection__raw_
+        order = settings._OrmSection__order_
+        layer_values = layer.__dict__
+        layer_raw = layer._OrmSection__raw_
+        names = layer._OrmSection__order_
+        if not order:
+            # nothing to replace, so only sections and mutable values need
+            # more than copying
+            order.extend(names)
+            if layer_raw:
+                raw.update(layer_raw)
+            values.update(layer_values)
+            immutable = _orm_immutable_types
+            names = [name for name, value in layer_values.items() if type(value) not in immutable]
+        for name in names:
+            if name not in values and not (raw and name in raw):
+                order.append(name)
+            if name not in layer_values:
+                # lazily read, and not yet converted
+                values.pop(name, None)
+                raw[name] = layer_raw[name]
+                continue
+            if raw:
+                raw.pop(name, None)
+            value = layer_values[name]
+            if isinstance(value, OrmSection):
+                section = values.get(name)
+                if not isinstance(section, OrmSection) or section is value:
+                    section = values[name] = OrmSection(name=name)
+                    section._OrmSection__parent_ = settings
+                    if convert is not None:
+                        section._OrmSection__raw_ = {}
+                        section._OrmSection__convert_ = convert
+                self._merge(section, value, convert)
+            else:
+                if type(value) not in _orm_immutable_types:
+                    value = copy.deepcopy(value)
+                    settings._OrmSection__remember(name, value)
+                values[name] = value
+        settings._OrmSection__inheritable_ = None
+
+    def _parse(self, text, settings, plain, lazy):
+        """
+        tokenize text in one pass, adding its values and sections to settings
+
+        sections inherit the defaults and their parent sections' values; if
+        lazy, values are stored as text for their section to convert later
+        """
+        filename = self._filename
+        # names and (immutable) values repeat a lot in big files, so convert
+        # each distinct one only once
+        names = {}
+        values = {}
+        immutable = _orm_immutable_types
+        verify_name = self._verify_name
+        convert = lambda key, value: self._convert(key, value, plain)
+        # where settings are going: the defaults, or the latest section
+        def section_target(section):
+            if lazy:
+                section._OrmSection__raw_ = {}
+                section._OrmSection__convert_ = convert
+                return section._OrmSection__raw_, section._OrmSection__order_
+            return section.__dict__, section._OrmSection__order_
+        target, order = section_target(settings)
+        section = settings
+        path = ''
+        for name, value, header, other in _orm_lines(text):
+            if name:
+                try:
+                    name = names[name]
+                except KeyError:
+                    raw, name = name, verify_name(name)
+                    names[raw] = name
+                if not lazy:
+                    try:
+                        value = values[value]
+                    except KeyError:
+                        raw, value = value, convert(path + name, value)
+                        if type(value) in immutable:
+                            values[raw] = value
+                        else:
+                            section._OrmSection__remember(name, value)
+                if name not in target:
+                    order.append(name)
+                target[name] = value
+            elif not other:
+                sections = self._verify_section_header(header)
+                prior, section_name = sections[:-1], sections[-1]
+                path = '.'.join(sections) + '.'
+                section = OrmSection(name=section_name)
+                target, order = section_target(section)
+                prev_namespace = settings
+                for prev_name in prior:
+                    prev_namespace = prev_namespace[prev_name]
+                section._OrmSection__parent_ = prev_namespace
+                # added directly, as it is not a change to the file
+                if section_name not in prev_namespace.__dict__:
+                    prev_namespace._OrmSection__order_.append(section_name)
+                prev_namespace.__dict__[section_name] = section
+                prev_namespace._OrmSection__inheritable_ = None
+            elif other[0] == '[':
+                raise OrmError('OrmFile %r; section headers must start and end with "[]" [got %r]' % (filename, other.strip(), ))
+            else:
+                raise OrmError('OrmFile %r: settings must be "name = value" [got %r]' % (filename, other.strip(), ))
+
+    def _set_types(self, filename, types):
+        for n, t in types.items():
+            if n not in (
+                    '_str', '_path', '_date', '_time', '_datetime',
+                    '_bool', '_float', '_int',
+                    ):
+                raise TypeError('OrmFile %r: invalid orm type -> %r' % (filename, n))
+            setattr(self, n, t)
+
+    def _cache_key(self, cache, encoding, plain, lazy):
+        """
+        return where the settings of this file are cached, and what they must
+        have been read with to be used
+        """
+        filename = os.path.abspath(self._filename)
+        if cache is True:
+            directory, name = os.path.split(filename)
+            path = os.path.join(directory, '.%s.cache' % name)
+        else:
+            name = hashlib.sha1(filename.encode('utf-8')).hexdigest()
+            path = os.path.join(cache, '%s.cache' % name)
+        # read before the file is, so a change while reading is noticed later
+        stat = os.stat(filename)
+        types = [
+                '%s.%s' % (t.__module__, getattr(t, '__qualname__', t.__name__))
+                for t in [type(self)] + [getattr(self, n) for n in (
+                        '_str', '_path', '_date', '_time', '_datetime',
+                        '_bool', '_float', '_int',
+                        )]]
+        key = (_orm_cache_version, filename, stat.st_mtime, stat.st_size, encoding, plain, lazy, types)
+        return path, key
+
+    def _cache_read(self, path, key):
+        """
+        return what was saved to path with key, or None if it is missing, out
+        of date, or could have been written by someone else
+        """
+        try:
+            with open(path, 'rb') as f:
+                stat = os.fstat(f.fileno())
+                if hasattr(os, 'getuid') and (stat.st_uid != os.getuid() or stat.st_mode & 0o022):
+                    # unpickling can run code, so only files nobody else can
+                    # have written are trusted
+                    scription_debug('ignoring %r: not private to this user' % (path, ))
+                    return None
+                if pickle.load(f) != key:
+                    return None
+                return pickle.load(f)
+        except Exception:
+            return None
+
+    def _cache_load(self, path, key, plain):
+        "return the cached settings, or None if they are missing or out of date"
+        settings = self._cache_read(path, key)
+        if settings is None:
+            return None
+        # lazy values need a converter again
+        convert = lambda key, value: self._convert(key, value, plain)
+        sections = [settings]
+        while sections:
+            section = sections.pop()
+            if section._OrmSection__raw_ is not None:
+                section._OrmSection__convert_ = convert
+            sections.extend(v for v in section.__dict__.values() if isinstance(v, OrmSection))
+        return settings
+
+    def _cache_save(self, path, key, data):
+        # readers never see a partial snapshot, and nobody else can change it
+        directory = os.path.dirname(path)
+        try:
+            if not os.path.isdir(directory):
+                try:
+                    os.makedirs(directory)
+                except OSError:
+                    # another thread or process got there first
+                    if not os.path.isdir(directory):
+                        raise
+            data = pickle.dumps(key, pickle.HIGHEST_PROTOCOL) + pickle.dumps(data, pickle.HIGHEST_PROTOCOL)
+            _atomic_write(path, data, private=True)
+        except Exception:
+            # values of custom types may not pickle; the file can still be read
+            scription_debug('unable to cache %r: %s' % (self._filename, sys.exc_info()[1]))
+
+    def _read_sections(self, target, encoding, index):
+        """
+        return the text of the defaults and of the sections leading to, and
+        under, target -- or None if the file cannot be split up that way
+        """
+        if '[\n'.encode(encoding) != b'[\n':
+            # headers cannot be found without decoding everything
+            return None
+        filename = os.path.abspath(self._filename)
+        directory, name = os.path.split(filename)
+        index_path = os.path.join(directory, '.%s.index' % name)
+        stat = os.stat(filename)
+        index_key = (_orm_cache_version, filename, stat.st_mtime, stat.st_size)
+        # (section name, start, end) for the defaults and each section
+        sections = index and self._cache_read(index_path, index_key)
+        with open(filename, 'rb') as fh:
+            if sections:
+                def read(start, end):
+                    fh.seek(start)
+                    return fh.read(end - start)
+            else:
+                data = fh.read()
+                read = lambda start, end: data[start:end]
+                sections = self._section_spans(data, encoding)
+                if index:
+                    self._cache_save(index_path, index_key, sections)
+            return ''.join(
+                    read(start, end).decode(encoding)
+                    for header, start, end in sections
+                    if not header
+                    or header == target
+                    or target.startswith(header + '.')
+                    or header.startswith(target + '.')
+                    )
+
+    def _section_spans(self, data, encoding, verify=True):
+        "(name, start, end) of the defaults and of each section in data"
+        spans = []
+        name, start = '', 0
+        for match in _orm_headers(data):
+            spans.append((name, start, match.start()))
+            name = match.group(1).decode(encoding)
+            if verify:
+                name = '.'.join(self._verify_section_header(name))
+            else:
+                name = name.strip().lower()
+            start = match.start()
+        spans.append((name, start, len(data)))
+        return spans
+
+    def _convert(self, key, value, plain):
+        # convert value, naming the file and key if it cannot be
+        try:
+            return self._verify_value(value, plain=plain)
+        except OrmError:
+            exc = sys.exc_info()[1]
+            raise OrmError('%s [key %r]' % (exc, key))
+
     def _verify_name(self, name):
         name = name.strip().lower()
         if not name[0].isalpha():
             raise OrmError('OrmFile %r: names must start with a letter (got %r)' % (self._filename, name, ))
-        if re.sub('\w*', '', name):
+        if not _orm_name(name):
             # illegal characters in name
             raise OrmError('OrmFile %r: names can only contain letters, digits, and the underscore [%r]' % (self._filename, name))
         return name
@@ -2554,9 +4626,9 @@ class OrmFile(object):
     def _verify_section_header(self, section):
         sections = section.strip().lower().split('.')
         current_section = sections[-1]
-        if not current_section[0].isalpha():
+        if not current_section[:1].isalpha():
             raise OrmError('OrmFile %r: names must start with a letter' % (self._filename, ))
-        if re.sub('\w*', '', current_section):
+        if not _orm_name(current_section):
             # illegal characters in section
             raise OrmError('OrmFile %r: names can only contain letters, digits, and the underscore [%r]' % (self._filename, current_section))
         if current_section in self.__dict__:
@@ -2591,60 +4663,71 @@ class OrmFile(object):
                 except ValueError:
                     pass
             return value
-        if value[0] in ('"', "'"):
-            # definitely a string
-            if value[0] != value[-1]:
-                raise OrmError('OrmFile %r: string must be quoted at both ends [%r]' % (self._filename, value))
-            start, end = 1, -1
-            if value[:3] in ('"""', "'''"):
-                if value[:3] != value[-3:] or len(value) < 6:
-                    raise OrmError('OrmFile %r: invalid string value: %r' % (self._filename, value))
-                start, end = 3, -3
-            return self._str(value[start:end])
-        elif value.startswith(('[', '(', '{')):
-            # list/tuple/dict
+        if not value:
+            return self._bool(False)
+        return self._value_kinds.get(value[0], OrmFile._inferred_value)(self, value)
+
+    def _quoted_value(self, value):
+        # definitely a string
+        if value[0] != value[-1]:
+            raise OrmError('OrmFile %r: string must be quoted at both ends [%r]' % (self._filename, value))
+        start, end = 1, -1
+        if value[:3] in ('"""', "'''"):
+            if value[:3] != value[-3:] or len(value) < 6:
+                raise OrmError('OrmFile %r: invalid string value: %r' % (self._filename, value))
+            start, end = 3, -3
+        return self._str(value[start:end])
+
+    def _literal_value(self, value):
+        # list/tuple/dict
+        try:
             return ast.literal_eval(value)
-        elif '/' in value or '\\' in value:
+        except (SyntaxError, ValueError):
+            raise OrmError('OrmFile %r: invalid literal value: %r' % (self._filename, value))
+
+    def _inferred_value(self, value):
+        if '/' in value or '\\' in value:
             # path
             return self._path(value)
         elif ':' in value and '-' in value:
             # datetime
             try:
-                date = map(int, value[:10].split('-'))
-                time = map(int, value[11:].split(':'))
+                date = [int(v) for v in value[:10].split('-')]
+                time = [int(v) for v in value[11:].split(':')]
                 return self._datetime(*(date+time))
             except ValueError:
                 raise OrmError('OrmFile %r: invalid datetime value: %r' % (self._filename, value))
         elif '-' in value:
             # date
             try:
-                date = map(int, value.split('-'))
-                return self._date(date)
-            except ValueError:
+                date = [int(v) for v in value.split('-')]
+                return self._date(*date)
+            except (TypeError, ValueError):
                 raise OrmError('OrmFile %r: invalid date value: %r' % (self._filename, value))
         elif ':' in value:
             # time
             try:
-                time = map(int, value.split(':'))
+                time = [int(v) for v in value.split(':')]
                 return self._time(*time)
             except ValueError:
                 raise OrmError('OrmFile %r: invalid time value: %r' % (self._filename, value))
         elif '.' in value:
             # float
             try:
-                value = self._float(value)
+                return self._float(value)
             except ValueError:
                 raise OrmError('OrmFile %r: invalid float value: %r' % (self._filename, value))
-        elif value.lower() == 'true':
+        lower = value.lower()
+        if lower == 'true':
             # boolean - True
             return self._bool(True)
-        elif value.lower() in ('false', ''):
+        elif lower == 'false':
             # boolean - False
             return self._bool(False)
-        elif value.lower() == 'none':
+        elif lower == 'none':
             # None
             return self._none()
-        elif any(c.isdigit() for c in value):
+        elif _orm_has_digit(value):
             # int
             try:
                 return self._int(value)
@@ -2654,8 +4737,14 @@ class OrmFile(object):
             # must be a string
             return value
 
+    # how to convert a value, by its first character
+    _value_kinds = {
+            '"': _quoted_value, "'": _quoted_value,
+            '[': _literal_value, '(': _literal_value, '{': _literal_value,
+            }
+
     @ormclassmethod
-    def save(orm, filename=None, force=False):
+    def save(orm, filename=None, force=False, patch=False):
         # quotes indicate a string
         # / or \ indicates a path
         # : or - indicates time, date, datetime (big-endian)
@@ -2667,9 +4756,39 @@ class OrmFile(object):
         # True/False/None are True/False/None
         # numbers are integer or float
         # everything else is a string
+        #
+        # saving to the file that was read does nothing if no settings have
+        # been assigned to (or, if mutable, changed in place) since it was
+        # read or saved; if `patch`, only the
+        # values of those settings are rewritten (or added), and the rest of
+        # the file, comments included, is kept as it is
+        if orm._layers:
+            raise OrmError('OrmFile %r: unable to save layered files' % (orm._filename, ))
         if not orm._saveable:
             raise OrmError('unable to save when sections specified on opening')
         filename = filename or orm._filename
+        def value_text(obj):
+            if obj in (True, False, None) or isinstance(obj, number):
+                return '%s' % (obj, )
+            elif isinstance(obj, orm._datetime):
+                if obj.second:
+                    return obj.strftime('%Y-%m-%d %H:%M:%S')
+                else:
+                    return obj.strftime('%Y-%m-%d %H:%M')
+            elif isinstance(obj, orm._date):
+                    return obj.strftime('%Y-%m-%d')
+            elif isinstance(obj, orm._time):
+                if obj.second:
+                    return obj.strftime('%H:%M:%S')
+                else:
+                    return obj.strftime('%H:%M')
+            elif isinstance(obj, orm._path) and not orm._path in basestring:
+                return '%s' % (obj, )
+            elif not isinstance(obj, basestring):
+                # list, tuple, dict, etc.
+                return '%s' % (obj, )
+            else:
+                return '"%s"' % (obj, )
         def savelines(settings, lines=None, section_name=''):
             if lines is None:
                 lines = []
@@ -2682,41 +4801,654 @@ class OrmFile(object):
                     key=lambda item: (isinstance(item[1], OrmSection)),
                     )
             for setting_name, obj in items:
-                if obj in (True, False, None) or isinstance(obj, number):
-                    lines.append('%s = %s' % (setting_name, obj))
-                elif isinstance(obj, orm._datetime):
-                    if obj.second:
-                        lines.append(obj.strftime('%%s = %Y-%m-%d %H:%M:%S') % (setting_name, ))
-                    else:
-                        lines.append(obj.strftime('%%s = %Y-%m-%d %H:%M') % (setting_name, ))
-                elif isinstance(obj, orm._date):
-                        lines.append(obj.strftime('%%s = %Y-%m-%d') % (setting_name, ))
-                elif isinstance(obj, orm._time):
-                    if obj.second:
-                        lines.append(obj.strftime('%%s = %H:%M:%S') % (setting_name, ))
-                    else:
-                        lines.append(obj.strftime('%%s = %H:%M') % (setting_name, ))
-                elif isinstance(obj, orm._path) and not orm._path in basestring:
-                    lines.append('%s = %s' % (setting_name, obj))
-                elif not isinstance(obj, basestring) and not isinstance(obj, OrmSection):
-                    # list, tuple, dict, etc.
-                    lines.append('%s = %s' % (setting_name, obj))
-                elif isinstance(obj, basestring):
-                    lines.append('%s = "%s"' % (setting_name, obj))
+                if not isinstance(obj, OrmSection):
+                    lines.append('%s = %s' % (setting_name, value_text(obj)))
                 else:
                     # at this point, it's a Section
                     savelines(obj, lines, ('%s.%s' % (section_name, setting_name)).strip('.'))
             return lines
-        lines = savelines(orm._settings)
+        # only saving to the file that was read makes its settings unchanged
+        same_file = bool(orm._filename) and os.path.realpath(filename) == os.path.realpath(orm._filename)
         if (
                 orm._filename
-                and filename != orm._filename
+                and not same_file
                 and os.path.exists(filename)
                 and not force
             ):
             raise Exception('file %r exists; use force=True to overwrite' % (filename, ))
-        with open(filename, 'w') as f:
-            f.write('\n'.join(lines))
+        # one save (or reload) of the file at a time, so an older version is
+        # never written over a newer one
+        with orm._reload_lock:
+            with _orm_lock:
+                changes, changed_sections = orm._changes()
+                taken = []
+                if same_file:
+                    # settings assigned to while saving are saved next time
+                    for section in changed_sections:
+                        taken.append((section, section._OrmSection__changed_))
+                        section._OrmSection__changed_ = None
+            if same_file and not changes and os.path.exists(filename):
+                return
+            try:
+                data = None
+                if patch and same_file:
+                    data = orm._patched(changes, value_text, savelines)
+                if data is None:
+                    data = '\n'.join(savelines(orm._settings)).encode(orm._encoding)
+                orm._replace(filename, data)
+            except Exception:
+                # still to be saved
+                with _orm_lock:
+                    for section, names in taken:
+                        if names:
+                            section._OrmSection__changed_ = names | (section._OrmSection__changed_ or set())
+                raise
+            if same_file:
+                # no need to reload what was just written
+                orm._stamp = orm._file_stamp()
+
+    def _changes(self):
+        """
+        return (section name, setting name, value) of each setting assigned to
+        (or, if mutable, changed in place) since the file was read or saved
+        (new sections are one change), and the sections with changes in them
+
+        _orm_lock must be held
+        """
+        changes = []
+        changed_sections = []
+        def path(where):
+            # where is (parent's where, name), or None for the root
+            names = []
+            while where is not None:
+                where, name = where
+                names.append(name)
+            return '.'.join(reversed(names))
+        sections = [(None, self._settings)]
+        while sections:
+            where, section = sections.pop()
+            if section._OrmSection__mutable_:
+                section._OrmSection__notice()
+            changed = section._OrmSection__changed_ or ()
+            values = section.__dict__
+            if changed:
+                changed_sections.append(section)
+                section_name = path(where)
+                for name in section._OrmSection__order_:
+                    if name in changed:
+                        value = values[name]
+                        changes.append((section_name, name, value))
+                        if isinstance(value, OrmSection):
+                            # saved whole, so its changes are saved too
+                            new_sections = [value]
+                            while new_sections:
+                                new_section = new_sections.pop()
+                                if new_section._OrmSection__mutable_:
+                                    new_section._OrmSection__notice()
+                                changed_sections.append(new_section)
+                                new_sections.extend(v for v in new_section.__dict__.values() if isinstance(v, OrmSection))
+            for name, value in values.items():
+                if isinstance(value, OrmSection) and name not in changed:
+                    sections.append(((where, name), value))
+        return changes, changed_sections
+
+    def _patched(self, changes, value_text, savelines):
+        "return the file with changes made to it, or None if it cannot be patched"
+        encoding = self._encoding
+        if '[\n'.encode(encoding) != b'[\n':
+            return None
+        try:
+            with open(self._filename, 'rb') as fh:
+                data = fh.read()
+        except EnvironmentError:
+            return None
+        spans = dict((name, (start, end)) for name, start, end in self._section_spans(data, encoding, verify=False))
+        by_section = OrderedDict()
+        for path, name, value in changes:
+            by_section.setdefault(path, []).append((name, value))
+        # (start, end, replacement) of each change to the existing text
+        edits = []
+        new_sections = []
+        for path, settings in by_section.items():
+            if path not in spans:
+                # file has changed since it was read
+                return None
+            start, end = spans[path]
+            # where each value is, and the end of the last line of the section
+            values = {}
+            last = None
+            for match in _orm_byte_lines(data, start, end):
+                name, value, header, other = match.groups()
+                if name is not None:
+                    values[self._verify_name(name.decode(encoding))] = match.span(2)
+                    last = match.end()
+                elif header is not None and last is None:
+                    last = match.end()
+            added = []
+            for name, value in settings:
+                if isinstance(value, OrmSection):
+                    section_name = ('%s.%s' % (path, name)).lstrip('.')
+                    if section_name in spans:
+                        return None
+                    savelines(value, new_sections, section_name)
+                elif name in values:
+                    value_start, value_end = values[name]
+                    old = data[value_start:value_end]
+                    text = value_text(value)
+                    if old.strip():
+                        value_start += len(old) - len(old.lstrip())
+                        value_end = value_start + len(old.strip())
+                    else:
+                        text = ' ' + text
+                        value_end = value_start
+                    edits.append((value_start, value_end, text))
+                else:
+                    added.append('%s = %s' % (name, value_text(value)))
+            if added:
+                if last is None:
+                    edits.append((start, start, '\n'.join(added) + '\n'))
+                else:
+                    line_end = data.find(b'\n', last, end)
+                    if line_end == -1:
+                        edits.append((end, end, '\n' + '\n'.join(added)))
+                    else:
+                        edits.append((line_end + 1, line_end + 1, '\n'.join(added) + '\n'))
+        pieces = []
+        done = 0
+        for start, end, text in sorted(edits, key=lambda edit: edit[:2]):
+            pieces.append(data[done:start])
+            pieces.append(text.encode(encoding))
+            done = end
+        pieces.append(data[done:])
+        if new_sections:
+            pieces.append('\n'.join(new_sections).encode(encoding))
+        return b''.join(pieces)
+
+    def _replace(self, filename, data):
+        "write data to filename so readers only ever see the old file or the new one"
+        # a symlink is kept, and the file it points to replaced
+        _atomic_write(os.path.realpath(filename), data)
+
+    @ormclassmethod
+    def reload_if_changed(orm):
+        # if the file has changed since it was read, read it again and replace
+        # the settings (including any not yet saved) with the new ones;
+        # return the dotted names of the settings and sections that changed,
+        # after passing them to the subscribers
+        with orm._reload_lock:
+            stamp = orm._file_stamp()
+            if stamp == orm._stamp:
+                return []
+            # a bad file is not read again until it changes again
+            orm._stamp = stamp
+            old, new = orm._settings, orm._load()
+            changes = orm._diff(old, new)
+            if not changes:
+                return []
+            # readers get either the old settings or the new, never a mixture
+            orm._settings = new
+            subscribers = list(orm._subscribers)
+        for callback in subscribers:
+            try:
+                callback(orm, changes)
+            except Exception:
+                logger.exception('OrmFile %r: subscriber %r failed' % (orm._filename, callback))
+        return changes
+
+    @ormclassmethod
+    def subscribe(orm, callback):
+        # call callback(orm, changes) after the file is reloaded
+        orm._subscribers.append(callback)
+
+    @ormclassmethod
+    def unsubscribe(orm, callback):
+        orm._subscribers.remove(callback)
+
+    @ormclassmethod
+    def watch(orm, interval=1.0):
+        # check the file every `interval` seconds from a background thread,
+        # and reload it if it has changed
+        if orm._watcher is not None:
+            raise OrmError('OrmFile %r: already being watched' % (orm._filename, ))
+        stop = threading.Event()
+        reload_if_changed = orm.__class__.reload_if_changed
+        def check():
+            while not stop.wait(interval):
+                try:
+                    reload_if_changed(orm)
+                except Exception:
+                    logger.exception('OrmFile %r: reload failed' % (orm._filename, ))
+        thread = Thread(target=check, name='orm-watch')
+        thread.daemon = True
+        orm._watcher = thread, stop
+        thread.start()
+
+    @ormclassmethod
+    def unwatch(orm):
+        # stop checking the file for changes
+        watcher, orm._watcher = orm._watcher, None
+        if watcher is not None:
+            thread, stop = watcher
+            stop.set()
+            if thread is not threading.current_thread():
+                thread.join()
+
+    @ormclassmethod
+    def snapshot(orm):
+        # return a read-only copy of the settings as they are now; sections
+        # that have not changed since the last snapshot are shared with it,
+        # and if none have the last snapshot itself is returned (mutable
+        # values changed in place count as changed)
+        settings = orm._settings
+        last = orm._snapshot
+        if last is not None and last[0] is settings and last[1] == _orm_changes[0]:
+            changed = [
+                    (section, name)
+                    for section, name, value in last[2]._chain[0].mutable
+                    if type(section.__dict__.get(name)) is not type(value)
+                    or section.__dict__.get(name) != value
+                    ]
+            if not changed:
+                return last[2]
+            with _orm_lock:
+                for section, name in changed:
+                    section._OrmSection__assigned(name)
+        root = settings
+        while root._OrmSection__parent_ is not None:
+            root = root._OrmSection__parent_
+        with _orm_lock:
+            changes = _orm_changes[0]
+            chain = [root._OrmSection__frozen()]
+        if orm._section:
+            for name in orm._section.lower().split('.'):
+                chain.append(chain[-1].values[name])
+        snapshot = _OrmSnapshot(orm._filename, tuple(chain))
+        orm._snapshot = settings, changes, snapshot
+        return snapshot
+
+    def _diff(self, old, new):
+        """
+        dotted names of the settings and sections that differ between the old
+        and the new settings -- settings are compared by type and value, and
+        lazily read ones by their text if neither has been used
+        """
+        while old._OrmSection__parent_ is not None:
+            old = old._OrmSection__parent_
+        while new._OrmSection__parent_ is not None:
+            new = new._OrmSection__parent_
+        # only the sections of interest, and their parents, are compared
+        target = (self._section or '').lower()
+        def wanted(path):
+            return (
+                    not target or not path or path == target
+                    or target.startswith(path + '.') or path.startswith(target + '.')
+                    )
+        changes = []
+        sections = [('', old, new)]
+        while sections:
+            path, old, new = sections.pop()
+            old_values, new_values = old.__dict__, new.__dict__
+            old_raw = old._OrmSection__raw_ or {}
+            new_raw = new._OrmSection__raw_ or {}
+            names = list(old._OrmSection__order_)
+            names.extend(n for n in new._OrmSection__order_ if n not in old_values and n not in old_raw)
+            for name in names:
+                key = ('%s.%s' % (path, name)).lstrip('.')
+                in_old = name in old_values or name in old_raw
+                in_new = name in new_values or name in new_raw
+                if in_old and in_new:
+                    if name in old_raw and name in new_raw and name not in old_values and name not in new_values:
+                        if old_raw[name] == new_raw[name]:
+                            continue
+                    else:
+                        old_value, new_value = old[name], new[name]
+                        if isinstance(old_value, OrmSection) and isinstance(new_value, OrmSection):
+                            if wanted(key):
+                                sections.append((key, old_value, new_value))
+                            continue
+                        if type(old_value) is type(new_value) and old_value == new_value:
+                            continue
+                if wanted(path):
+                    changes.append(key)
+        return changes
+
+class MappedOrmFile(OrmFile):
+    """
+    read-only OrmFile that reads values straight from the memory-mapped file
+
+    only the positions of the sections are found when the file is opened;
+    the settings of a section are found, and its values converted, as they
+    are used -- and again after the file changes
+    """
+
+    def __init__(self, filename, section=None, types={}, encoding='utf-8', plain=False):
+        # if section, only return defaults merged with section
+        # if types, use those instead of the default orm types
+        self._set_types(filename, types)
+        self._filename = filename
+        self._section = section
+        self._saveable = False
+        self._root = (section or '').lower()
+        self._encoding = encoding
+        self._plain = plain
+        self._lock = threading.Lock()
+        self._map = None
+        # (mtime, size) of the file when it was mapped
+        self._stamp = None
+        # section name -> (start, end) of its lines
+        self._sections = {}
+        # section name -> names of its subsections
+        self._subsections = {}
+        # section name -> setting name -> (start, end) of its value
+        self._keys = {}
+        # (section name, setting name) -> converted value
+        self._values = {}
+        with self._lock:
+            self._refresh()
+            if self._root not in self._sections:
+                raise ScriptionError("namespace object has nothing named %r" % section)
+
+    def __setattr__(self, name, value):
+        if name[:1] != '_':
+            raise OrmError('OrmFile %r: unable to change settings of a MappedOrmFile' % (self._filename, ))
+        object.__setattr__(self, name, value)
+
+    def __eq__(self, other):
+        if not isinstance(other, OrmFile):
+            return NotImplemented
+        return dict(iter(self)) == dict(iter(other))
+
+    def __ne__(self, other):
+        if not isinstance(other, OrmFile):
+            return NotImplemented
+        return dict(iter(self)) != dict(iter(other))
+
+    def __iter__(self):
+        items = list(self._items(self._root).items())
+        for key, value in items:
+            if not isinstance(value, _MappedOrmSection):
+                yield key, value
+        for key, value in items:
+            if isinstance(value, _MappedOrmSection):
+                yield key, value
+
+    def __getattr__(self, name):
+        if name[:1] == '_':
+            raise AttributeError('%r object has no attribute %r' % (self.__class__.__name__, name))
+        name = name.lower()
+        try:
+            return self._lookup(self._root, name)
+        except KeyError:
+            raise OrmError("OrmFile %r: no section/default named %r" % (self._filename, name))
+
+    def __getitem__(self, name):
+        try:
+            return self._lookup(self._root, name)
+        except KeyError:
+            raise ScriptionError("namespace object has nothing named %r" % name)
+
+    def _refresh(self):
+        "map the file (again) if it has changed since it was last mapped"
+        stat = os.stat(self._filename)
+        stamp = stat.st_mtime, stat.st_size
+        if stamp == self._stamp:
+            return
+        if self._map is not None:
+            self._map.close()
+            self._map = None
+        data = b''
+        if stat.st_size:
+            with open(self._filename, 'rb') as fh:
+                self._map = data = mmap.mmap(fh.fileno(), 0, access=mmap.ACCESS_READ)
+        sections = {}
+        subsections = {'': []}
+        for name, start, end in self._section_spans(data, self._encoding):
+            sections[name] = start, end
+            if name:
+                subsections.setdefault(name.rpartition('.')[0], []).append(name)
+        self._stamp = stamp
+        self._sections = sections
+        self._subsections = subsections
+        self._keys = {}
+        self._values = {}
+
+    def _section_keys(self, path):
+        "setting names of section path, and where their values are"
+        keys = self._keys.get(path)
+        if keys is None:
+            keys = OrderedDict()
+            start, end = self._sections[path]
+            for match in _orm_byte_lines(self._map or b'', start, end):
+                name, value, header, other = match.groups()
+                if name is not None:
+                    keys[self._verify_name(name.decode(self._encoding))] = match.span(2)
+                elif other is not None:
+                    raise OrmError('OrmFile %r: settings must be "name = value" [got %r]' % (self._filename, other.decode(self._encoding).strip(), ))
+            self._keys[path] = keys
+        return keys
+
+    def _value(self, path, name, span):
+        try:
+            return self._values[path, name]
+        except KeyError:
+            pass
+        key = ('%s.%s' % (path, name)).lstrip('.')
+        text = self._map[span[0]:span[1]].decode(self._encoding)
+        value = self._values[path, name] = self._convert(key, text, self._plain)
+        return value
+
+    def _lookup(self, path, name):
+        "subsection name of section path, or its setting or the nearest parent's"
+        with self._lock:
+            self._refresh()
+            if path not in self._sections:
+                raise KeyError(name)
+            if ('%s.%s' % (path, name)).lstrip('.') in self._sections:
+                return _MappedOrmSection(self, ('%s.%s' % (path, name)).lstrip('.'))
+            while True:
+                span = self._section_keys(path).get(name)
+                if span is not None:
+                    return self._value(path, name, span)
+                if not path:
+                    raise KeyError(name)
+                path = path.rpartition('.')[0]
+                if ('%s.%s' % (path, name)).lstrip('.') in self._sections:
+                    # sections are not inherited
+                    raise KeyError(name)
+
+    def _items(self, path):
+        "inherited settings, own settings, and subsections of section path, in order"
+        with self._lock:
+            self._refresh()
+            if path not in self._sections:
+                raise OrmError('OrmFile %r: section %r no longer exists' % (self._filename, path))
+            chain = [path]
+            while chain[-1]:
+                chain.append(chain[-1].rpartition('.')[0])
+            items = OrderedDict()
+            for section in reversed(chain[1:]):
+                for name, span in self._section_keys(section).items():
+                    items[name] = self._value(section, name, span)
+                # sections are not inherited
+                for name in list(items):
+                    if ('%s.%s' % (section, name)).lstrip('.') in self._sections:
+                        del items[name]
+            for name, span in self._section_keys(path).items():
+                items[name] = self._value(path, name, span)
+            for subsection in self._subsections.get(path, ()):
+                items[subsection.rpartition('.')[2]] = _MappedOrmSection(self, subsection)
+            return items
+
+    @ormclassmethod
+    def save(orm, filename=None, force=False):
+        raise OrmError('OrmFile %r: unable to save a MappedOrmFile' % (orm._filename, ))
+
+    @ormclassmethod
+    def reload_if_changed(orm):
+        raise OrmError('OrmFile %r: a MappedOrmFile always reads the current file' % (orm._filename, ))
+
+    @ormclassmethod
+    def watch(orm, interval=1.0):
+        raise OrmError('OrmFile %r: a MappedOrmFile always reads the current file' % (orm._filename, ))
+
+
+class _MappedOrmSection(object):
+    "a section of a MappedOrmFile, read as it is used"
+
+    __slots__ = '_orm', '_path'
+
+    def __init__(self, orm, path):
+        self._orm = orm
+        self._path = path
+
+    def __repr__(self):
+        return '%r' % (tuple(self), )
+
+    def __eq__(self, other):
+        if not isinstance(other, (_MappedOrmSection, OrmSection)):
+            return NotImplemented
+        return dict(iter(self)) == dict(iter(other))
+
+    def __ne__(self, other):
+        if not isinstance(other, (_MappedOrmSection, OrmSection)):
+            return NotImplemented
+        return dict(iter(self)) != dict(iter(other))
+
+    def __contains__(self, name):
+        try:
+            self._orm._lookup(self._path, name)
+            return True
+        except KeyError:
+            return False
+
+    def __iter__(self):
+        for item in self._orm._items(self._path).items():
+            yield item
+
+    def __getattr__(self, name):
+        if name[:1] != '_':
+            try:
+                return self._orm._lookup(self._path, name)
+            except KeyError:
+                pass
+        raise AttributeError('%r object has no attribute %r' % ('OrmSection', name))
+
+    def __getitem__(self, name):
+        try:
+            return self._orm._lookup(self._path, name)
+        except KeyError:
+            raise ScriptionError("namespace object has nothing named %r" % name)
+
+
+class _OrmSnapshotNode(object):
+    "settings of an OrmSection when its last snapshot was taken"
+
+    # mutable is (live section, name, copy) of the mutable values here and in
+    # subsections, so changes made to them in place can be noticed
+    __slots__ = 'values', 'order', 'raw', 'convert', 'key', 'detached', 'mutable'
+
+    def own(self, name):
+        "value of name from this section, converting it on first use"
+        values = self.values
+        if name in values:
+            return values[name]
+        raw = self.raw
+        if not raw or name not in raw:
+            raise KeyError(name)
+        return values.setdefault(name, self.convert(('%s.%s' % (self.key, name)).lstrip('.'), raw[name]))
+
+
+class _OrmSnapshot(object):
+    "read-only settings of a section, as they were when the snapshot was taken"
+
+    __slots__ = '_filename', '_chain'
+
+    def __init__(self, filename, chain):
+        # chain -> the defaults' node, ..., this section's node
+        object.__setattr__(self, '_filename', filename)
+        object.__setattr__(self, '_chain', chain)
+
+    def __setattr__(self, name, value):
+        raise OrmError('OrmFile %r: unable to change settings of a snapshot' % (self._filename, ))
+
+    def __setitem__(self, name, value):
+        raise OrmError('OrmFile %r: unable to change settings of a snapshot' % (self._filename, ))
+
+    def __repr__(self):
+        return '%r' % (tuple(self), )
+
+    def __eq__(self, other):
+        if not isinstance(other, (_OrmSnapshot, _MappedOrmSection, OrmSection)):
+            return NotImplemented
+        return dict(iter(self)) == dict(iter(other))
+
+    def __ne__(self, other):
+        if not isinstance(other, (_OrmSnapshot, _MappedOrmSection, OrmSection)):
+            return NotImplemented
+        return dict(iter(self)) != dict(iter(other))
+
+    def __contains__(self, name):
+        try:
+            self._lookup(name)
+            return True
+        except KeyError:
+            return False
+
+    def __iter__(self):
+        chain = self._chain
+        items = OrderedDict()
+        for node in chain[:-1]:
+            # sections are not inherited
+            for name in list(items):
+                if isinstance(node.values.get(name), _OrmSnapshotNode):
+                    del items[name]
+            for name in node.order:
+                value = node.own(name)
+                if not isinstance(value, _OrmSnapshotNode):
+                    items[name] = value
+        node = chain[-1]
+        for name in node.order:
+            value = node.own(name)
+            if isinstance(value, _OrmSnapshotNode):
+                value = _OrmSnapshot(self._filename, chain + (value, ))
+            items[name] = value
+        for item in items.items():
+            yield item
+
+    def __getattr__(self, name):
+        if name[:1] != '_':
+            try:
+                return self._lookup(name)
+            except KeyError:
+                pass
+        raise AttributeError('%r object has no attribute %r' % ('OrmSection', name))
+
+    def __getitem__(self, name):
+        try:
+            return self._lookup(name)
+        except KeyError:
+            raise ScriptionError("namespace object has nothing named %r" % name)
+
+    def _lookup(self, name):
+        "subsection or setting name of this section, or the nearest parent's setting"
+        chain = self._chain
+        try:
+            value = chain[-1].own(name)
+        except KeyError:
+            for node in reversed(chain[:-1]):
+                try:
+                    value = node.own(name)
+                except KeyError:
+                    continue
+                if isinstance(value, _OrmSnapshotNode):
+                    # sections are not inherited
+                    break
+                return value
+            raise KeyError(name)
+        if isinstance(value, _OrmSnapshotNode):
+            value = _OrmSnapshot(self._filename, chain + (value, ))
+        return value
+
 
 IniError = OrmError     # deprecated, will be removed by 1.0
 IniFile = OrmFile       # deprecated, will be removed by 1.0
@@ -3227,6 +5959,22 @@ def echo(*args, **kwds):
         kwds.setdefault('verbose', 0)
         print(*args, **kwds)
 
+def _echo_output(data, end='\n', file=None):
+    "echo a child's output, which is bytes if it was not decoded"
+    file = file or stdout
+    if PY2 or not isinstance(data, bytes):
+        echo(data, end=end, file=file)
+        return
+    with print_lock:
+        buffer = getattr(file, 'buffer', None)
+        if buffer is None:
+            # no binary stream underneath (e.g. io.StringIO)
+            file.write(data.decode('utf-8', 'replace') + end)
+            return
+        file.flush()
+        buffer.write(data + end.encode('ascii'))
+        buffer.flush()
+
 def error(*args, **kwds):
     with print_lock:
         returncode = kwds.pop('returncode', None)
@@ -3990,3 +6738,7 @@ class wait_and_check(object):
                 return True
         return False
     __nonzero__ = __bool__
+
+if pyver >= PY36 and not is_win:
+    from ._async_job import AsyncJob, aexecute
+    __all__ += ('AsyncJob', 'aexecute')
@@ -0,0 +1,446 @@
+"""
+asyncio versions of Job and Execute (Python 3.6+)
+
+AsyncJob uses no threads of its own, so thousands can run from one event loop:
+
+    jobs = [AsyncJob(['ping', '-c1', host]) for host in hosts]
+    await asyncio.gather(*(job.communicate(timeout=30) for job in jobs))
+
+asyncio itself, though, waits for each child from a thread of its own on
+Python 3.8 to 3.11 (and on later versions without pidfd support, i.e. Linux
+before 5.3); on 3.9 to 3.11 that can be avoided by choosing
+asyncio.PidfdChildWatcher as the child watcher before starting any jobs.
+"""
+
+import asyncio
+import codecs
+import fcntl
+import os
+import shlex
+import sys
+import termios
+import time
+
+from . import (
+        Environment, ExecuteError, FailedPassword, TimeoutError, UnableToKillJob,
+        KILL_SIGNALS, echo, empty, scription_debug, _echo_output,
+        )
+
+__all__ = 'AsyncJob', 'aexecute'
+
+
+def _acquire_tty():
+    "preexec_fn: make the pty on stdin our controlling terminal (after setsid)"
+    fcntl.ioctl(0, termios.TIOCSCTTY, 0)
+
+
+class AsyncJob(object):
+    """
+    runs a command as Job does, but from the asyncio event loop
+
+    the command starts on the first await of start(), communicate(), or
+    iteration (`async for line in job`); with pty=True stdin and stdout are a
+    pseudo-terminal (stderr is still a pipe)
+    """
+
+    name = None
+    pid = None
+    process = None
+    returncode = None
+    # signal that killed the child, if any
+    signal = None
+    # time.time() when child was started, first produced output, and exited
+    started = None
+    first_output = None
+    ended = None
+    # str (or bytes if encoding is None) of stdout and stderr from job
+    stdout = None
+    stderr = None
+    # if job has been closed
+    closed = False
+    # encoding used for stdout and stderr (None means keep as bytes)
+    encoding = 'utf-8'
+    read_size = 65536
+    # seconds allowed for the child to die after each of kill_signals
+    kill_interval = 0.5
+    # start the child in its own session, so kill() and timeouts signal its
+    # whole process group
+    new_session = True
+
+    # environment given to the child: the shared Environment mapping until
+    # someone asks for it, then a copy of its own
+    _env = None
+    _env_shared = False
+
+    @property
+    def env(self):
+        if self._env_shared:
+            self._env = dict(self._env)
+            self._env_shared = False
+        return self._env
+
+    @env.setter
+    def env(self, env):
+        self._env = env
+        self._env_shared = False
+
+    def __init__(self, args, cwd=None, pty=False, env=None, encoding='utf-8', **new_env_vars):
+        # args        -> command to run (list, or string to split shell-style)
+        # cwd         -> directory to run in
+        # pty         -> True = run with a pseudo-terminal (needed for passwords)
+        # encoding    -> decode output with encoding, or None to keep raw bytes
+        if isinstance(args, str):
+            args = shlex.split(args)
+        self.args = list(args)
+        self.name = self.args[0]
+        self.cwd = cwd
+        self.pty = pty
+        if not env or isinstance(env, Environment):
+            # an empty env means ours, as for Job
+            self._env = (env or Environment.default).overlay(**new_env_vars).mapping()
+            self._env_shared = True
+        else:
+            self.env = dict(env, **new_env_vars)
+        self.encoding = encoding
+        self.kill_signals = list(KILL_SIGNALS)
+        self._master = None
+        self._stdout = []
+        self._stderr = []
+        self._decoders = {}
+        self._readers = {}
+        self._output_arrived = None
+        self._pending = b''
+
+    def __repr__(self):
+        return '<%s %r: pid=%r, returncode=%r>' % (self.__class__.__name__, self.args, self.pid, self.returncode)
+
+    async def __aenter__(self):
+        await self.start()
+        return self
+
+    async def __aexit__(self, *exc):
+        await self.close()
+
+    def __aiter__(self):
+        return self
+
+    async def __anext__(self):
+        "lines of stdout (with their line endings) as they arrive"
+        await self.start()
+        reader = self._readers['stdout']
+        while b'\n' not in self._pending:
+            data = await reader.read(self.read_size)
+            if not data:
+                break
+            self._pending += data
+        if not self._pending:
+            self._take('stdout', b'', final=True)
+            raise StopAsyncIteration
+        line, newline, self._pending = self._pending.partition(b'\n')
+        return self._take('stdout', line + newline)
+
+    async def start(self):
+        "start the child, if not already started"
+        if self.process is not None:
+            return
+        loop = asyncio.get_event_loop()
+        self._output_arrived = asyncio.Event()
+        scription_debug('async job starting:', self.args)
+        kwds = dict(cwd=self.cwd, env=self._env, stderr=asyncio.subprocess.PIPE)
+        if self.new_session or self.pty:
+            kwds['start_new_session'] = True
+        slave = None
+        if self.pty:
+            self._master, slave = os.openpty()
+            os.set_blocking(self._master, False)
+            kwds.update(stdin=slave, stdout=slave, preexec_fn=_acquire_tty)
+        else:
+            kwds.update(stdin=asyncio.subprocess.PIPE, stdout=asyncio.subprocess.PIPE)
+        self.started = time.time()
+        try:
+            self.process = await asyncio.create_subprocess_exec(*self.args, **kwds)
+        except BaseException:
+            if self._master is not None:
+                os.close(self._master)
+                self._master = None
+            raise
+        finally:
+            if slave is not None:
+                # the child has its own copy now
+                os.close(slave)
+        self.pid = self.process.pid
+        self._readers['stderr'] = self.process.stderr
+        if self.pty:
+            reader = self._readers['stdout'] = asyncio.StreamReader()
+            def read_master():
+                try:
+                    data = os.read(self._master, self.read_size)
+                except BlockingIOError:
+                    return
+                except OSError:
+                    # EIO once the child (and everything else) has closed the pty
+                    data = b''
+                if data:
+                    reader.feed_data(data)
+                else:
+                    loop.remove_reader(self._master)
+                    reader.feed_eof()
+            loop.add_reader(self._master, read_master)
+        else:
+            self._readers['stdout'] = self.process.stdout
+
+    def _take(self, stream, data, final=False):
+        "record (and return) data from stream, decoded if needed"
+        if data and self.first_output is None:
+            self.first_output = time.time()
+        if self._output_arrived is not None:
+            self._output_arrived.set()
+        if self.encoding is not None:
+            decoder = self._decoders.get(stream)
+            if decoder is None:
+                decoder = self._decoders[stream] = codecs.getincrementaldecoder(self.encoding)()
+            data = decoder.decode(data, final)
+        if data:
+            (self._stdout if stream == 'stdout' else self._stderr).append(data)
+        return data
+
+    def _add_stderr(self, message):
+        if self.encoding is None:
+            message = message.encode('utf-8')
+        self._stderr.append(message)
+
+    async def _collect(self, stream, interactive):
+        "record stream until it ends"
+        reader = self._readers[stream]
+        if stream == 'stdout' and self._pending:
+            # left over from line iteration
+            data, self._pending = self._pending, b''
+            self._echo(stream, self._take(stream, data), interactive)
+        while True:
+            data = await reader.read(self.read_size)
+            self._echo(stream, self._take(stream, data, final=not data), interactive)
+            if not data:
+                break
+
+    def _echo(self, stream, data, interactive):
+        if interactive == 'echo' and data:
+            _echo_output(data, end='', file=(sys.stdout, sys.stderr)[stream == 'stderr'])
+            (sys.stdout, sys.stderr)[stream == 'stderr'].flush()
+
+    def get_echo(self):
+        "return the child's terminal echo status (True is on)"
+        if self._master is None:
+            return True
+        return bool(termios.tcgetattr(self._master)[3] & termios.ECHO)
+
+    def is_alive(self):
+        return self.process is not None and self.process.returncode is None
+
+    async def _wait_until(self, done, timeout):
+        """
+        wait at most timeout seconds for done() to be true, and return it; done()
+        is checked when output arrives, and otherwise after waits growing from
+        1ms to 100ms
+        """
+        loop = asyncio.get_event_loop()
+        deadline = loop.time() + timeout
+        delay = 0.001
+        while not done():
+            remaining = deadline - loop.time()
+            if remaining <= 0:
+                return False
+            self._output_arrived.clear()
+            try:
+                await asyncio.wait_for(self._output_arrived.wait(), min(delay, remaining))
+            except asyncio.TimeoutError:
+                pass
+            delay = min(delay * 2, 0.1)
+        return True
+
+    async def write(self, data):
+        "send data (str is encoded as utf-8) to the child's stdin"
+        await self.start()
+        if not isinstance(data, bytes):
+            data = data.encode('utf-8')
+        if self._master is None:
+            self.process.stdin.write(data)
+            await self.process.stdin.drain()
+            return len(data)
+        loop = asyncio.get_event_loop()
+        view = memoryview(data)
+        while view:
+            try:
+                view = view[os.write(self._master, view):]
+            except BlockingIOError:
+                writable = loop.create_future()
+                loop.add_writer(self._master, writable.set_result, None)
+                try:
+                    await writable
+                finally:
+                    loop.remove_writer(self._master)
+        return len(data)
+
+    async def _send_passwords(self, passwords, password_timeout):
+        if self._master is None:
+            # no way to see the prompt, so feed all passwords at once after the
+            # first output or a short delay
+            await self._wait_until(lambda: self.first_output is not None, 0.1)
+            await self.write(b''.join(passwords))
+            return
+        for pwd in passwords:
+            await self._wait_until(lambda: not self.get_echo() or not self.is_alive(), password_timeout)
+            if not self.is_alive():
+                raise ExecuteError('job died', process=self)
+            elif self.get_echo():
+                await self.kill()
+                raise TimeoutError('Password prompt not seen.', process=self)
+            scription_debug('writing password')
+            await self.write(pwd)
+        # wait a moment for the last password to be accepted
+        if not await self._wait_until(lambda: self.get_echo() or not self.is_alive(), 5.0):
+            if self.is_alive():
+                self._add_stderr('Invalid/too few passwords\n')
+                await self.kill()
+                raise FailedPassword(process=self)
+
+    async def communicate(self, input=None, password=None, timeout=None, password_timeout=None, interactive=None, encoding=empty):
+        '''
+        feed input and passwords to the child, and wait for it to finish;
+        returns the job
+
+        timeout and interactive have the same meaning as for Job.communicate()
+        '''
+        # input             -> data for stdin (closed afterwards unless pty)
+        # password          -> single password or tuple of passwords
+        # password_timeout  -> time allowed for successful password transmission
+        # timeout           -> time allowed for successful completion of job
+        # interactive       -> False = record only, 'echo' = echo output as we get it
+        # encoding          -> override encoding given to AsyncJob (None to keep raw bytes)
+        if timeout is not None and password_timeout is not None and password_timeout >= timeout:
+            raise ValueError('password_timeout must be less than timeout')
+        if password_timeout is None:
+            password_timeout = 90 if timeout is None else min(90, timeout / 10.0)
+        if encoding is not empty:
+            self.encoding = encoding
+        if password is None:
+            password = ()
+        elif isinstance(password, (bytes, str)):
+            password = (password, )
+        passwords = [
+                (p if isinstance(p, bytes) else p.encode('utf-8')) + b'\n'
+                for p in password
+                ]
+        collectors = []
+        async def converse():
+            if passwords:
+                await self._send_passwords(passwords, password_timeout)
+            if input is not None:
+                await self.write(input)
+            if self._master is None and self.process.stdin is not None:
+                self.process.stdin.close()
+            # asyncio.wait() leaves the collectors running if we time out
+            await asyncio.wait(collectors)
+            await self.process.wait()
+        try:
+            await self.start()
+            collectors.extend(
+                    asyncio.ensure_future(self._collect(stream, interactive))
+                    for stream in ('stdout', 'stderr')
+                    )
+            try:
+                await asyncio.wait_for(converse(), timeout)
+            except asyncio.TimeoutError:
+                scription_debug('timed out')
+                message = '\nTIMEOUT: process failed to complete in %s seconds\n' % timeout
+                self._add_stderr(message)
+                await self.kill()
+                raise TimeoutError(message.strip(), process=self)
+        finally:
+            if collectors:
+                # give output still in the pipes a moment to arrive
+                await asyncio.wait(collectors, timeout=self.kill_interval)
+                for collector in collectors:
+                    collector.cancel()
+            await self.close()
+        return self
+
+    def _signal(self, sig):
+        if self.new_session or self.pty:
+            try:
+                os.killpg(self.pid, sig)
+                return
+            except ProcessLookupError:
+                if self.process.returncode is not None:
+                    raise
+        self.process.send_signal(sig)
+
+    async def kill(self):
+        "send kill_signals, waiting kill_interval seconds after each for the child to die"
+        if self.process is None:
+            return
+        for sig in self.kill_signals:
+            try:
+                self._signal(sig)
+            except ProcessLookupError:
+                return
+            try:
+                await asyncio.wait_for(self.process.wait(), self.kill_interval)
+                return
+            except asyncio.TimeoutError:
+                pass
+        raise UnableToKillJob('Signals %s failed' % ', '.join(str(s) for s in self.kill_signals), process=self)
+
+    async def close(self, timeout=0):
+        "wait up to timeout seconds for the child to exit, then kill it; release the pty"
+        if self.closed:
+            return
+        self.closed = True
+        try:
+            if self.process is not None and self.process.returncode is None:
+                try:
+                    await asyncio.wait_for(self.process.wait(), max(timeout, 0.1))
+                except asyncio.TimeoutError:
+                    await self.kill()
+        finally:
+            if self._master is not None:
+                asyncio.get_event_loop().remove_reader(self._master)
+                os.close(self._master)
+                self._master = None
+            if self.process is not None:
+                if self.process.stdin is not None:
+                    self.process.stdin.close()
+                self.returncode = self.process.returncode
+                if self.returncode is not None:
+                    self.signal = max(0, -self.returncode)
+            self.ended = time.time()
+            for stream in ('stdout', 'stderr'):
+                if stream in self._decoders:
+                    self._take(stream, b'', final=True)
+            if self.encoding is None:
+                self.stdout = b''.join(self._stdout)
+                self.stderr = b''.join(self._stderr)
+            else:
+                self.stdout = ''.join(self._stdout).replace('\r\n', '\n')
+                self.stderr = ''.join(self._stderr).replace('\r\n', '\n')
+
+
+async def aexecute(args, cwd=None, password=None, password_timeout=None, input=None, timeout=None, pty=False, interactive=None, env=None, encoding='utf-8', **new_env_vars):
+    """
+    asyncio version of Execute: run args to completion and return the AsyncJob
+    """
+    job = AsyncJob(args, cwd=cwd, pty=pty, env=env, encoding=encoding, **new_env_vars)
+    try:
+        await job.communicate(
+                input=input, password=password, timeout=timeout,
+                password_timeout=password_timeout, interactive=interactive,
+                )
+    except BaseException as exc:
+        if getattr(exc, 'process', None) is None:
+            exc.process = job
+        if interactive is None:
+            _echo_output(job.stdout)
+            _echo_output(job.stderr)
+            echo()
+        scription_debug(exc)
+        raise
+    return job
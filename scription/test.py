@@ -4,15 +4,17 @@ import sys
 sys.path.insert(0, os.path.split(os.path.split(__file__)[0]))
 
 from aenum import version as aenum_version
+from collections import OrderedDict
 from antipathy import Path
 from scription import *
-from scription import _usage, version, empty, pocket, ormclassmethod
-from scription import pyver, PY2, PY25, PY33
+from scription import _usage, version, empty, pocket, ormclassmethod, _scheduler
+from scription import pyver, PY2, PY25, PY33, PY36
 from textwrap import dedent
 from unittest import skip, skipUnless, SkipTest, TestCase as unittest_TestCase, main
 import datetime
 import errno
 import functools
+import json
 import pty
 import re
 import scription
@@ -22,6 +24,10 @@ import tempfile
 import threading
 import time
 import warnings
+try:
+    import asyncio
+except ImportError:
+    asyncio = None
 try:
     import hypothesis
     from hypothesis import given as st # strategies as settings
@@ -2219,6 +2225,473 @@ class TestExecution(TestCase):
                 )
         self.assertEqual(command.stderr, '')
 
+    def test_bytes_mode(self):
+        "encoding=None keeps output as bytes"
+        command = Execute(
+                [sys.executable, self.mixed_file],
+                pty=False,
+                timeout=300,
+                encoding=None,
+                )
+        self.assertEqual(command.stdout, b'good night\nsweetheart!\n')
+        self.assertTrue(isinstance(command.stderr, bytes))
+        self.assertTrue(command.stderr.endswith(b"KeyError: 'the key is missing?'\n"))
+        if not is_win:
+            command = Execute([sys.executable, self.good_file], pty=True, timeout=600, encoding=None)
+            self.assertEqual(command.stdout, b'good output here!\r\n')
+            self.assertEqual(command.stderr, b'')
+
+    def test_bytes_mode_echo(self):
+        "encoding=None output is echoed as is, not as a bytes repr"
+        script = (
+                'import sys\n'
+                'from scription import Execute, TimeoutError\n'
+                'Execute([sys.executable, "-c", "print(\'hi\')"], pty=False, encoding=None, interactive="echo", timeout=300)\n'
+                'try:\n'
+                '    Execute([sys.executable, "-c", "import time; print(\'bye\'); time.sleep(30)"], pty=False, encoding=None, timeout=1)\n'
+                'except TimeoutError:\n'
+                '    pass\n'
+                )
+        command = Execute(
+                [sys.executable, '-c', script],
+                pty=False,
+                timeout=300,
+                PYTHONPATH=os.path.dirname(os.path.dirname(os.path.abspath(scription.__file__))),
+                )
+        self.assertTrue(command.stdout.startswith('hi\nbye\n'), command.stdout + command.stderr)
+        self.assertFalse("b'" in command.stdout, command.stdout)
+
+    def test_split_multibyte_character(self):
+        "characters split across reads are decoded intact"
+        command = Execute(
+                [sys.executable, '-c',
+                    'import sys, time\n'
+                    'out = getattr(sys.stdout, "buffer", sys.stdout)\n'
+                    'for i in range(3):\n'
+                    '    out.write(b"\\xc3"); out.flush(); time.sleep(0.1)\n'
+                    '    out.write(b"\\xa9"); out.flush(); time.sleep(0.1)\n'
+                    ],
+                pty=False,
+                timeout=300,
+                )
+        self.assertEqual(command.stdout, u'\xe9\xe9\xe9')
+        self.assertEqual(command.stderr, '')
+
+    def test_redirect_output(self):
+        "output can go straight to files instead of being captured"
+        out_file = os.path.join(tempdir, 'redirected_out')
+        command = Execute(
+                [sys.executable, self.mixed_file],
+                pty=False,
+                timeout=300,
+                stdout=out_file,
+                stderr=DEVNULL,
+                )
+        self.assertEqual(command.stdout, '')
+        self.assertEqual(command.stderr, '')
+        with open(out_file) as f:
+            self.assertEqual(f.read(), 'good night\nsweetheart!\n')
+        err_file = os.path.join(tempdir, 'redirected_err')
+        with open(err_file, 'w') as f:
+            command = Execute([sys.executable, self.mixed_file], pty=False, timeout=300, stderr=f)
+        self.assertEqual(command.stdout, 'good night\nsweetheart!\n')
+        self.assertEqual(command.stderr, '')
+        with open(err_file) as f:
+            self.assertTrue(f.read().endswith("KeyError: 'the key is missing?'\n"))
+        if not is_win:
+            command = Execute([sys.executable, self.mixed_file], pty=True, timeout=600, stdout=out_file, stderr=err_file)
+            self.assertEqual(command.stdout, '')
+            self.assertEqual(command.stderr, '')
+            with open(out_file) as f:
+                self.assertEqual(f.read(), 'good night\nsweetheart!\n')
+            with open(err_file) as f:
+                self.assertTrue(f.read().endswith("KeyError: 'the key is missing?'\n"))
+
+    def test_tee_output(self):
+        "output can go to files and be captured"
+        out_file = os.path.join(tempdir, 'tee_out')
+        err_file = os.path.join(tempdir, 'tee_err')
+        command = Execute(
+                [sys.executable, self.mixed_file],
+                pty=False,
+                timeout=300,
+                stdout=out_file,
+                stderr=err_file,
+                tee=True,
+                )
+        self.assertEqual(command.stdout, 'good night\nsweetheart!\n')
+        self.assertTrue(command.stderr.endswith("KeyError: 'the key is missing?'\n"))
+        with open(out_file) as f:
+            self.assertEqual(f.read(), command.stdout)
+        with open(err_file) as f:
+            self.assertEqual(f.read(), command.stderr)
+
+    if not is_win:
+        def test_resource_usage(self):
+            "resource usage and timestamps are recorded"
+            finished = []
+            Job.exit_hooks.append(finished.append)
+            try:
+                for pty in (False, True):
+                    command = Execute(
+                            [sys.executable, '-c', 'x = [0] * 10000000; print(sum(range(1000000)))'],
+                            pty=pty,
+                            timeout=300,
+                            )
+                    self.assertEqual(command.returncode, 0)
+                    self.assertTrue(command in finished)
+                    self.assertTrue(command.rusage.ru_utime + command.rusage.ru_stime > 0)
+                    self.assertTrue(command.rusage.ru_maxrss > 0)
+                    self.assertTrue(command.started <= command.first_output <= command.ended)
+            finally:
+                Job.exit_hooks.remove(finished.append)
+            command = Execute([sys.executable, '-c', 'import os; os.kill(os.getpid(), 9)'], pty=False, timeout=300)
+            self.assertEqual(command.returncode, -9)
+            self.assertEqual(command.signal, 9)
+
+    def test_job_pool(self):
+        "commands run concurrently, limited by max_workers"
+        sleeper = [sys.executable, '-c', 'import sys, time; time.sleep(1); print(sys.argv[1])']
+        start = time.time()
+        pool = Execute.map([sleeper + [str(i)] for i in range(6)], jobs=3, timeout=300)
+        self.assertEqual(len(pool), 6)
+        jobs = list(pool)
+        elapsed = time.time() - start
+        self.assertTrue(elapsed < 4, 'took %.1f seconds' % elapsed)
+        self.assertEqual(sorted(job.stdout for job in jobs), ['%d\n' % i for i in range(6)])
+        self.assertEqual(pool.failures, [])
+        # collect failures
+        pool = JobPool(max_workers=2)
+        pool.submit([sys.executable, self.good_file])
+        pool.submit([sys.executable, self.bad_file])
+        jobs = list(pool)
+        self.assertEqual(len(jobs), 2)
+        self.assertEqual(len(pool.failures), 1)
+        self.assertTrue(pool.failures[0].stderr.endswith('ValueError: uh-oh -- bad value!\n'))
+        # including commands that cannot be started
+        unrunnable = os.path.join(tempdir, 'not-executable.sh')
+        with open(unrunnable, 'w') as script:
+            script.write('#!/bin/sh\necho hi\n')
+        os.chmod(unrunnable, 0o644)
+        pool = Execute.map([['echo', 'a'], [unrunnable], ['echo', 'b']], jobs=1, timeout=300)
+        jobs = list(pool)
+        self.assertEqual([job.stdout for job in jobs], ['a\n', '', 'b\n'])
+        self.assertEqual(len(pool.failures), 1)
+        self.assertEqual(pool.failures[0].args, [unrunnable])
+        self.assertTrue(pool.failures[0].returncode is None)
+        self.assertTrue('not-executable.sh' in pool.failures[0].stderr)
+        pool = JobPool(max_workers=1, fail_fast=True)
+        pool.submit([unrunnable])
+        pool.submit(['echo', 'b'])
+        self.assertRaises(EnvironmentError, list, pool)
+        # fail fast
+        pool = JobPool(max_workers=1, fail_fast=True)
+        pool.submit([sys.executable, self.bad_file])
+        pool.submit([sys.executable, self.good_file])
+        with self.assertRaisesRegex(ExecuteError, 'returned 1'):
+            list(pool)
+
+    def test_job_pool_timeout(self):
+        pool = JobPool(max_workers=2, timeout=2)
+        for i in range(3):
+            pool.submit([sys.executable, '-c', 'import time; time.sleep(30)'])
+        start = time.time()
+        self.assertRaises(TimeoutError, list, pool)
+        self.assertTrue(time.time() - start < 10)
+
+    def test_job_pool_echo(self):
+        "echoed output is prefixed and not interleaved"
+        output = StringIO()
+        real_stdout, scription.stdout = scription.stdout, output
+        try:
+            pool = JobPool(max_workers=2, interactive='echo')
+            pool.submit([sys.executable, '-c', 'print("one\\ntwo")'], name='first')
+            pool.submit([sys.executable, '-c', 'print("three")'], name='second')
+            list(pool)
+        finally:
+            scription.stdout = real_stdout
+        lines = output.getvalue().splitlines()
+        self.assertEqual(sorted(lines), ['first: one', 'first: two', 'second: three'])
+        self.assertEqual(lines.index('first: one') + 1, lines.index('first: two'))
+
+    if not is_win:
+        def test_shell_session(self):
+            "many commands through one shell"
+            with ShellSession() as sh:
+                result = sh.run('echo hello')
+                self.assertEqual(result.stdout, 'hello\n')
+                self.assertEqual(result.stderr, '')
+                self.assertEqual(result.returncode, 0)
+                result = sh.run('printf no-newline; echo oops >&2; false')
+                self.assertEqual(result.stdout, 'no-newline')
+                self.assertEqual(result.stderr, 'oops\n')
+                self.assertEqual(result.returncode, 1)
+                sh.run('cd %s' % tempdir)
+                self.assertEqual(sh.run('pwd').stdout.strip(), os.path.realpath(tempdir))
+                for i in range(100):
+                    self.assertEqual(sh.run('echo %d' % i).stdout, '%d\n' % i)
+                self.assertRaises(AttributeError, setattr, result, 'returncode', 0)
+            self.assertEqual(sh.job.returncode, 0)
+            self.assertRaises(ExecuteError, sh.run, 'echo too late')
+
+        def test_shell_session_timeout(self):
+            sh = ShellSession()
+            start = time.time()
+            self.assertRaises(TimeoutError, sh.run, 'sleep 30', timeout=1)
+            self.assertTrue(time.time() - start < 10)
+            self.assertTrue(sh.closed)
+            self.assertRaises(ExecuteError, sh.run, 'echo dead')
+            sh = ShellSession()
+            self.assertRaises(ExecuteError, sh.run, 'exit 3')
+            self.assertEqual(sh.job.returncode, 3)
+
+    def test_expect(self):
+        "conversations with a job via expect() and sendline()"
+        script = (
+                "import sys\n"
+                "sys.stdout.write('name? '); sys.stdout.flush()\n"
+                "name = sys.stdin.readline().strip()\n"
+                "sys.stdout.write('hello, %s\\nmore? ' % name); sys.stdout.flush()\n"
+                "sys.stdin.readline()\n"
+                "sys.stdout.write('x' * 100000 + 'done\\n')\n"
+                )
+        for pty in (False, True):
+            job = Job([sys.executable, '-c', script], pty=pty)
+            try:
+                match = job.expect(['nope', r'(\w+)\? '], timeout=60)
+                self.assertEqual(match.group(1), 'name')
+                job.sendline('Ethan')
+                match = job.expect(r'hello, (\w+)', timeout=60)
+                self.assertEqual(match.group(1), 'Ethan')
+                self.assertEqual(job.read(1), '\n' if not pty else '\r')
+                self.assertRaises(TimeoutError, job.expect, 'never', timeout=0.2)
+                job.sendline()
+                # crosses many chunks, and the expect buffer limit
+                job.expect('x{10}done', timeout=60)
+                self.assertTrue(len(job.before) < job.max_expect_buffer)
+                self.assertRaises(ExecuteError, job.expect, 'never', timeout=60)
+                # unmatched output is still there to read
+                self.assertEqual(job.read(10), ('\n', '\r\n')[pty])
+                self.assertEqual(job.read(10), '')
+                job.communicate(timeout=60)
+            finally:
+                job.close()
+            self.assertEqual(job.returncode, 0)
+            self.assertTrue(job.stdout.startswith('name? '))
+            self.assertTrue(job.stdout.endswith('x' * 100000 + 'done\n'))
+
+    if not is_win:
+        def test_timeout_kills_process_group(self):
+            "grandchildren holding our pipes open do not outlive a timeout"
+            start = time.time()
+            self.assertRaises(TimeoutError, Execute, ['sh', '-c', 'sleep 60 & echo started'], timeout=1, interactive=False)
+            self.assertTrue(time.time() - start < 10)
+
+    @skipUnless(os.path.exists('/proc/self/stat'), 'needs /proc')
+    def test_kill_tree(self):
+        "kill_tree finds descendants that left the process group"
+        script = 'import os, time; os.setpgrp(); print(os.getpid()); sys.stdout.flush(); time.sleep(60)'
+        job = Job(['sh', '-c', '%s -c "import sys; %s" & wait' % (sys.executable, script)])
+        job.kill_tree = True
+        self.assertRaises(TimeoutError, job.communicate, timeout=1)
+        escapee = '/proc/%d/stat' % int(job.stdout.split()[0])
+        deadline = time.time() + 10
+        while os.path.exists(escapee) and time.time() < deadline:
+            with open(escapee) as f:
+                if f.read().rsplit(')', 1)[1].split()[0] == 'Z':
+                    break
+            time.sleep(0.01)
+        else:
+            self.assertFalse(os.path.exists(escapee))
+
+    def test_environment(self):
+        "jobs share environments instead of copying os.environ"
+        env = Environment.default.overlay(SCRIPTION_TEST='one')
+        self.assertTrue(env is Environment.default.overlay(SCRIPTION_TEST='one'))
+        mapping = env.mapping()
+        self.assertTrue(mapping is env.mapping())
+        self.assertEqual(mapping['SCRIPTION_TEST'], 'one')
+        os.environ['SCRIPTION_TEST_TOO'] = 'two'
+        try:
+            self.assertFalse(mapping is env.mapping())
+            self.assertEqual(env.mapping()['SCRIPTION_TEST_TOO'], 'two')
+        finally:
+            del os.environ['SCRIPTION_TEST_TOO']
+        self.assertFalse('SCRIPTION_TEST_TOO' in env.mapping())
+        script = 'import os; print([os.environ.get(v) for v in ("SCRIPTION_TEST", "ONLY", "HOME")])'
+        for pty in (False, True):
+            job = Execute([sys.executable, '-c', script], pty=pty, timeout=60, SCRIPTION_TEST='three')
+            self.assertEqual(job.stdout, "['three', None, %r]\n" % os.environ.get('HOME'))
+            env = Environment({'PATH': os.environ['PATH']}, ONLY='me')
+            job = Execute([sys.executable, '-c', script], pty=pty, timeout=60, env=env, SCRIPTION_TEST='four')
+            self.assertEqual(job.stdout, "['four', 'me', None]\n")
+        # an empty env means ours
+        job = Execute(['sh', '-c', 'echo HOME=$HOME'], timeout=60, env={})
+        self.assertEqual(job.stdout, 'HOME=%s\n' % os.environ.get('HOME', ''))
+        # changing one job's env changes no other
+        job = Execute([sys.executable, '-c', 'pass'], timeout=60)
+        self.assertFalse(job.env is Environment.default.mapping())
+        self.assertEqual(job.env, Environment.default.mapping())
+        job.env['SCRIPTION_TEST'] = 'five'
+        self.assertTrue(job.env['SCRIPTION_TEST'] == 'five')
+        self.assertFalse('SCRIPTION_TEST' in Environment.default.mapping())
+        job = Execute([sys.executable, '-c', 'pass'], timeout=60)
+        self.assertFalse('SCRIPTION_TEST' in job.env)
+
+    def test_job_trace(self):
+        "jobs report what they are doing to event_hooks"
+        trace_file = os.path.join(tempdir, 'trace.json')
+        with JobTrace() as trace:
+            self.assertTrue(trace in Job.event_hooks)
+            Execute([sys.executable, '-c', 'import sys; print(sys.stdin.readline().upper())'], input='hello\n', input_delay=0, timeout=60)
+            self.assertRaises(TimeoutError, Execute, [sys.executable, '-c', 'import time; time.sleep(30)'], timeout=0.5, interactive=False)
+            Execute([sys.executable, self.pty_password_file], password='Salutations!', pty=True, timeout=60)
+        self.assertFalse(trace in Job.event_hooks)
+        jobs = OrderedDict()
+        for pid, command, event in trace.events:
+            jobs.setdefault(pid, []).append(event)
+        echo, sleep, password = [[e.name for e in events] for events in jobs.values()]
+        self.assertEqual(echo[0], 'spawned')
+        self.assertEqual(echo[-1], 'closed')
+        for name in ('stdin-written', 'first-stdout-byte', 'exited'):
+            self.assertTrue(name in echo, echo)
+        for name in ('timeout-fired', 'signal-sent', 'exited'):
+            self.assertTrue(name in sleep, sleep)
+        self.assertTrue(sleep.index('timeout-fired') < sleep.index('signal-sent') < sleep.index('exited'))
+        self.assertTrue(password.index('echo-off') < password.index('password-sent'))
+        events = list(jobs.values())[0]
+        self.assertEqual([e for e in events if e.name == 'stdin-written'][0].value, 6)
+        self.assertEqual(events[-1].stdout, 7)
+        self.assertEqual(events, sorted(events, key=lambda e: e.time))
+        trace.save(trace_file)
+        with open(trace_file) as f:
+            chrome = json.load(f)['traceEvents']
+        self.assertEqual(len([e for e in chrome if e['ph'] == 'X']), 3)
+        self.assertEqual(len([e for e in chrome if e['ph'] == 'i']), len(trace.events))
+
+    def test_job_event_hooks_use_jobs(self):
+        "hooks can run jobs of their own"
+        inner = []
+        def hook(job, event):
+            if event.name in ('stdin-written', 'exited') and job.args[0] == sys.executable:
+                inner.append((event.name, Execute(['echo', event.name], timeout=10).stdout))
+                job.is_alive()
+        Job.event_hooks.append(hook)
+        try:
+            start = time.time()
+            Execute([sys.executable, '-c', 'import sys; print(sys.stdin.readline())'], input='hello\n', input_delay=0, timeout=10)
+        finally:
+            Job.event_hooks.remove(hook)
+        self.assertTrue(time.time() - start < 5)
+        self.assertEqual(sorted(inner), [('exited', 'exited\n'), ('stdin-written', 'stdin-written\n')])
+
+    def test_cached_execute(self):
+        "identical commands can reuse earlier results"
+        command = [sys.executable, '-c', 'import random; print(random.random())']
+        cache = Execute.cache
+        cache.invalidate()
+        hits, misses = cache.hits, cache.misses
+        first = Execute(command, cache=True, timeout=300)
+        second = Execute(command, cache=True, timeout=300)
+        self.assertTrue(isinstance(first, JobResult))
+        self.assertEqual(first.stdout, second.stdout)
+        self.assertEqual(first.returncode, 0)
+        self.assertEqual((cache.hits - hits, cache.misses - misses), (1, 1))
+        self.assertRaises(AttributeError, setattr, second, 'stdout', 'changed')
+        # different environment, different result
+        third = Execute(command, cache=True, timeout=300, SOME_SETTING='1')
+        self.assertNotEqual(first.stdout, third.stdout)
+        # expired
+        time.sleep(0.1)
+        fourth = Execute(command, cache=0.05, timeout=300)
+        self.assertNotEqual(first.stdout, fourth.stdout)
+        # invalidated
+        cache.invalidate(command)
+        fifth = Execute(command, cache=True, timeout=300)
+        self.assertNotEqual(fourth.stdout, fifth.stdout)
+        # failures are not kept
+        failed = Execute([sys.executable, self.bad_file], cache=True, timeout=300)
+        self.assertEqual(failed.returncode, 1)
+        self.assertEqual(len([k for k in cache._results.values() if k[1].returncode]), 0)
+        self.assertRaises(ValueError, Execute, command, cache=True, password='secret')
+
+    def test_cached_execute_on_disk(self):
+        cache = Execute.cache
+        cache.invalidate()
+        directory = cache.directory
+        cache.directory = os.path.join(tempdir, 'execute_cache')
+        try:
+            command = [sys.executable, '-c', 'import random; print(random.random())']
+            first = Execute(command, cache=True, timeout=300)
+            raw = Execute(command, cache=True, timeout=300, encoding=None)
+            cache._results.clear()
+            self.assertEqual(Execute(command, cache=True, timeout=300).stdout, first.stdout)
+            self.assertEqual(Execute(command, cache=True, timeout=300, encoding=None).stdout, raw.stdout)
+            cache.invalidate()
+            self.assertEqual(os.listdir(cache.directory), [])
+        finally:
+            cache.directory = directory
+
+    def test_cached_execute_threads(self):
+        "threads in one process can share the on-disk cache"
+        cache = Execute.cache
+        cache.invalidate()
+        directory = cache.directory
+        cache.directory = os.path.join(tempdir, 'execute_cache_threads')
+        hits, misses = cache.hits, cache.misses
+        failures = []
+        def use_cache():
+            try:
+                for i in range(50):
+                    cache.put('shared', JobResult(['true'], 0, '', ''))
+                    cache.get('shared', True)
+            except Exception:
+                failures.append(sys.exc_info()[1])
+        try:
+            threads = [threading.Thread(target=use_cache) for i in range(8)]
+            for t in threads:
+                t.start()
+            for t in threads:
+                t.join()
+            self.assertEqual(failures, [])
+            self.assertEqual(cache.hits - hits + cache.misses - misses, 400)
+            self.assertEqual(os.listdir(cache.directory), ['shared.json'])
+            cache.invalidate()
+        finally:
+            cache.directory = directory
+
+    def test_pipeline(self):
+        "stdout of each command feeds stdin of the next"
+        pipeline = Execute.pipe(
+                [sys.executable, '-c', 'print("pear\\napple\\nfig\\napple")'],
+                ['sort'],
+                ['uniq'],
+                timeout=300,
+                )
+        self.assertEqual(pipeline.stdout, 'apple\nfig\npear\n')
+        self.assertEqual(pipeline.stderr, '')
+        self.assertEqual(pipeline.returncodes, [0, 0, 0])
+        self.assertEqual(pipeline.returncode, 0)
+        pipeline = Execute.pipe(['sort'], ['uniq', '-c'], input='b\na\nb\n', timeout=300)
+        self.assertEqual(pipeline.stdout.split(), ['1', 'a', '2', 'b'])
+        pipeline = Execute.pipe(
+                [sys.executable, self.mixed_file],
+                ['cat'],
+                timeout=300,
+                encoding=None,
+                )
+        self.assertEqual(pipeline.stdout, b'good night\nsweetheart!\n')
+        self.assertTrue(pipeline.stderrs[0].endswith(b"KeyError: 'the key is missing?'\n"))
+        self.assertEqual(pipeline.stderrs[1], b'')
+        self.assertNotEqual(pipeline.returncodes[0], 0)
+        self.assertEqual(pipeline.returncode, 0)
+
+    def test_pipeline_timeout(self):
+        pipeline = Pipeline([[sys.executable, '-c', 'import time; time.sleep(30)'], ['cat']])
+        self.assertRaises(TimeoutError, pipeline.communicate, timeout=2)
+        self.assertTrue('TIMEOUT' in pipeline.stderr)
+        self.assertNotEqual(pipeline.returncodes[0], 0)
+
     def test_input_with_echo_off(self):
         try:
             command = Job(
@@ -2637,6 +3110,790 @@ class TestOrm(TestCase):
         self.assertEqual(t2.huh, 9)
         self.assertEqual(Test.huh(t2), "t2 is huhified")
 
+    def test_inferred_values(self):
+        orm_file_name = os.path.join(tempdir, 'inferred.orm')
+        with open(orm_file_name, 'w') as orm_file:
+            orm_file.write(
+                    '  when = 2021-07-31\t\n'
+                    'stamp=2021-07-31 12:45:09\r\n'
+                    'ratio = 0.75\n'
+                    'count = 33\n'
+                    'unset =\n'
+                    '; a comment\n'
+                    '[one]\n'
+                    'ratio = 0.75\n'
+                    '   # another comment\n'
+                    '[two]\n'
+                    'count = 33\n'
+                    )
+        complete = OrmFile(orm_file_name)
+        self.assertEqual(complete.when, datetime.date(2021, 7, 31))
+        self.assertEqual(complete.stamp, datetime.datetime(2021, 7, 31, 12, 45, 9))
+        self.assertEqual(complete.ratio, 0.75)
+        self.assertEqual(complete.count, 33)
+        self.assertIs(complete.unset, False)
+        self.assertEqual(complete.one.ratio, 0.75)
+        self.assertEqual(complete.two.count, 33)
+        self.assertEqual(
+                [k for k, v in complete.two],
+                ['when', 'stamp', 'ratio', 'count', 'unset'],
+                )
+        for bad in ('ratio = 0.7.5\n', '9lives = 9\n', 'who\n', '[one\n', '[9]\n'):
+            with open(orm_file_name, 'w') as orm_file:
+                orm_file.write(bad)
+            self.assertRaises(OrmError, OrmFile, orm_file_name)
+
+    def test_inherited_values(self):
+        complete = OrmFile(self.orm_file_sub)
+        postgres = complete.postgres
+        postgres91 = complete.postgres.v901
+        # values are stored once, in the section that sets them
+        self.assertEqual(list(postgres91.__dict__), ['pg_dump', 'pg_dumpall'])
+        self.assertEqual(postgres91.psql, '/usr/lib/postgresql/9.1/bin/psql')
+        self.assertEqual(postgres91['psql'], '/usr/lib/postgresql/9.1/bin/psql')
+        self.assertEqual(OrmSection.get(postgres91, 'psql'), '/usr/lib/postgresql/9.1/bin/psql')
+        self.assertTrue('psql' in postgres91)
+        # sections are not inherited
+        self.assertFalse('v903' in postgres91)
+        self.assertRaises(AttributeError, getattr, postgres91, 'v903')
+        self.assertIs(OrmSection.get(postgres91, 'v903'), None)
+        # own values win
+        postgres91.psql = '/usr/local/bin/psql'
+        self.assertEqual(postgres91.psql, '/usr/local/bin/psql')
+        self.assertEqual(postgres.v903.psql, '/usr/lib/postgresql/9.1/bin/psql')
+        self.assertEqual(
+                [k for k, v in postgres91],
+                ['psql', 'pg_dump', 'pg_dumpall'],
+                )
+        self.assertNotEqual(complete, OrmFile(self.orm_file_sub))
+        export = {}
+        OrmFile(self.orm_file_sub, section='postgres.v905', export_to=export)
+        self.assertEqual(sorted(export), ['pg_dump', 'pg_dumpall', 'psql'])
+
+    def test_lazy(self):
+        eager = OrmFile(self.orm_file)
+        complete = OrmFile(self.orm_file, lazy=True)
+        hg = complete.hg
+        self.assertEqual(hg.__dict__, {})
+        self.assertEqual(hg.when, datetime.time(12, 45))
+        self.assertEqual(hg.home, '/usr/local/bin')
+        self.assertEqual(hg.who, 'ethan')
+        # converted values are kept where they were read
+        self.assertEqual(sorted(hg.__dict__), ['home', 'when'])
+        self.assertEqual(sorted(complete._settings.__dict__), ['data_types', 'hg', 'not_used', 'who'])
+        self.assertTrue(hg.when is hg.when)
+        hg.why_not = True
+        self.assertTrue(hg.why_not)
+        self.assertEqual([k for k, v in hg], ['home', 'who', 'why', 'why_not', 'where', 'when'])
+        self.assertEqual(complete.data_types.dict, {7:8, 9:10})
+        self.assertNotEqual(complete, eager)
+        self.assertEqual(OrmFile(self.orm_file, lazy=True), eager)
+        self.assertEqual(OrmFile(self.orm_file, section='hg', lazy=True).when, datetime.time(12, 45))
+        plain = OrmFile(self.orm_file_plain, plain=True, lazy=True)
+        self.assertEqual(plain.when, 12.45)
+        self.assertEqual(plain.who, 'ethan')
+
+    def test_lazy_errors(self):
+        orm_file_name = os.path.join(tempdir, 'lazy.orm')
+        with open(orm_file_name, 'w') as orm_file:
+            orm_file.write(
+                    'ratio = 0.75\n'
+                    '[one]\n'
+                    '[one.two]\n'
+                    'ratio = 0.7.5\n'
+                    'points = [1, 2\n'
+                    )
+        complete = OrmFile(orm_file_name, lazy=True)
+        self.assertEqual(complete.ratio, 0.75)
+        self.assertEqual(complete.one.ratio, 0.75)
+        with self.assertRaisesRegex(OrmError, r"lazy.orm.*'0.7.5' \[key 'one.two.ratio'\]"):
+            complete.one.two.ratio
+        with self.assertRaisesRegex(OrmError, r"lazy.orm.*\[key 'one.two.points'\]"):
+            complete.one.two['points']
+        with self.assertRaisesRegex(OrmError, r"\[key 'one.two.ratio'\]"):
+            OrmFile(orm_file_name)
+
+    def test_cache(self):
+        class CountingOrmFile(OrmFile):
+            parsed = 0
+            def _parse(self, *args):
+                CountingOrmFile.parsed += 1
+                return super(CountingOrmFile, self)._parse(*args)
+        orm_file_name = os.path.join(tempdir, 'cached.orm')
+        with open(self.orm_file) as source:
+            with open(orm_file_name, 'w') as orm_file:
+                orm_file.write(source.read())
+        expected = OrmFile(orm_file_name)
+        cold = CountingOrmFile(orm_file_name, cache=True)
+        self.assertTrue(os.path.exists(os.path.join(tempdir, '.cached.orm.cache')))
+        warm = CountingOrmFile(orm_file_name, cache=True)
+        self.assertEqual(CountingOrmFile.parsed, 1)
+        self.assertEqual(cold._settings, expected._settings)
+        self.assertEqual(warm._settings, expected._settings)
+        self.assertEqual(warm.hg.when, datetime.time(12, 45))
+        self.assertEqual([k for k, v in warm.hg], ['home', 'who', 'why', 'why_not', 'where', 'when'])
+        # reading differently, or from a different directory, needs a new parse
+        self.assertEqual(CountingOrmFile(orm_file_name, cache=True, plain=True).why_not, True)
+        self.assertEqual(CountingOrmFile.parsed, 2)
+        cache_dir = os.path.join(tempdir, 'orm-cache')
+        self.assertEqual(CountingOrmFile(orm_file_name, cache=cache_dir, lazy=True).hg.when, datetime.time(12, 45))
+        self.assertEqual(CountingOrmFile.parsed, 3)
+        lazy = CountingOrmFile(orm_file_name, cache=cache_dir, lazy=True, section='hg')
+        self.assertEqual(CountingOrmFile.parsed, 3)
+        self.assertEqual(lazy.when, datetime.time(12, 45))
+        self.assertEqual(len(os.listdir(cache_dir)), 1)
+        # changing the file means it gets read again
+        with open(orm_file_name, 'a') as orm_file:
+            orm_file.write('set = {1, 2}\n')
+        self.assertEqual(CountingOrmFile(orm_file_name, cache=True).data_types.set, set([1, 2]))
+        self.assertEqual(CountingOrmFile.parsed, 4)
+        # as do different types, even when they cannot be cached
+        class Path(unicode):
+            pass
+        for i in range(2):
+            custom = CountingOrmFile(orm_file_name, cache=True, types={'_path': Path})
+            self.assertTrue(type(custom.home) is Path)
+        self.assertEqual(CountingOrmFile.parsed, 6)
+        # caches others could have written are not trusted
+        cache_file = os.path.join(tempdir, '.cached.orm.cache')
+        CountingOrmFile(orm_file_name, cache=True)
+        self.assertEqual(CountingOrmFile.parsed, 6)
+        if not is_win:
+            self.assertEqual(os.stat(cache_file).st_mode & 0o777, 0o600)
+            os.chmod(cache_file, 0o666)
+            CountingOrmFile(orm_file_name, cache=True)
+            self.assertEqual(CountingOrmFile.parsed, 7)
+            CountingOrmFile(orm_file_name, cache=True)
+            self.assertEqual(CountingOrmFile.parsed, 7)
+
+    def test_section_only(self):
+        orm_file_name = os.path.join(tempdir, 'targeted.orm')
+        with open(self.orm_file_sub) as source:
+            with open(orm_file_name, 'w') as orm_file:
+                orm_file.write('version = 9.1\n')
+                orm_file.write(source.read())
+                orm_file.write('\n[broken]\nratio = 0.7.5\n')
+        self.assertRaises(OrmError, OrmFile, orm_file_name)
+        for index in (False, True, True):
+            postgres = OrmFile(orm_file_name, section='postgres', index=index)
+            self.assertEqual(postgres.version, 9.1)
+            self.assertEqual(postgres.v903.pg_dump, '/usr/lib/postgres/9.3/bin/pg_dump')
+            postgres95 = OrmFile(orm_file_name, section='postgres.v905', index=index)
+            self.assertEqual(
+                    list(postgres95),
+                    [
+                        ('version', 9.1),
+                        ('psql', "/usr/lib/postgresql/9.1/bin/psql"),
+                        ('pg_dump', '/usr/lib/postgres/9.5/bin/pg_dump'),
+                        ('pg_dumpall', '/usr/lib/postgres/9.5/bin/pg_dumpall'),
+                        ])
+            # only what was asked for was read
+            root = postgres95._settings._OrmSection__parent_._OrmSection__parent_
+            self.assertEqual([k for k, v in root], ['version', 'postgres'])
+            self.assertEqual(
+                    [k for k, v in root.postgres if isinstance(v, OrmSection)],
+                    ['v905'],
+                    )
+            self.assertRaises(ScriptionError, OrmFile, orm_file_name, section='postgres.v907', index=index)
+        self.assertTrue(os.path.exists(os.path.join(tempdir, '.targeted.orm.index')))
+        # a changed file is indexed again
+        with open(orm_file_name, 'a') as orm_file:
+            orm_file.write('\n[postgres.v907]\npg_dump = /usr/lib/postgres/9.7/bin/pg_dump\n')
+        postgres97 = OrmFile(orm_file_name, section='postgres.v907', index=True)
+        self.assertEqual(postgres97.pg_dump, '/usr/lib/postgres/9.7/bin/pg_dump')
+
+    def test_mapped(self):
+        complete = OrmFile(self.orm_file)
+        mapped = MappedOrmFile(self.orm_file)
+        self.assertEqual(mapped.hg.when, datetime.time(12, 45))
+        self.assertEqual(mapped.hg.who, 'ethan')
+        self.assertEqual(mapped['data_types'].dict, {7:8, 9:10})
+        self.assertEqual(mapped.WHY_NOT, True)
+        # only the sections used have been looked at
+        self.assertEqual(sorted(mapped._keys), ['', 'data_types', 'hg'])
+        self.assertEqual(list(mapped), list(complete))
+        self.assertEqual(list(mapped.hg), list(complete.hg))
+        self.assertTrue(mapped == complete)
+        self.assertTrue(complete == mapped)
+        self.assertTrue('when' in mapped.hg)
+        self.assertFalse('hg' in mapped.hg)
+        self.assertRaises(AttributeError, getattr, mapped.hg, 'not_used')
+        self.assertRaises(OrmError, getattr, mapped, 'nothing')
+        self.assertRaises(OrmError, setattr, mapped, 'who', 'me')
+        self.assertRaises(OrmError, MappedOrmFile.save, mapped)
+        hg = MappedOrmFile(self.orm_file, section='hg')
+        self.assertEqual(list(hg), list(complete.hg))
+        postgres = MappedOrmFile(self.orm_file_sub, section='postgres')
+        self.assertEqual(postgres.v905.psql, "/usr/lib/postgresql/9.1/bin/psql")
+        self.assertEqual(postgres, OrmFile(self.orm_file_sub, section='postgres'))
+        self.assertRaises(ScriptionError, MappedOrmFile, self.orm_file_sub, section='postgres.v907')
+        orm_file_name = os.path.join(tempdir, 'mapped-empty.orm')
+        self.assertRaises(EnvironmentError, MappedOrmFile, orm_file_name)
+        open(orm_file_name, 'w').close()
+        self.assertEqual(list(MappedOrmFile(orm_file_name)), [])
+
+    def test_mapped_changes(self):
+        orm_file_name = os.path.join(tempdir, 'mapped.orm')
+        with open(orm_file_name, 'w') as orm_file:
+            orm_file.write('port = 80\n[web]\nhost = "www"\n[db]\nratio = 0.7.5\n')
+        mapped = MappedOrmFile(orm_file_name)
+        web = mapped.web
+        self.assertEqual((web.host, web.port), ('www', 80))
+        with self.assertRaisesRegex(OrmError, r"\[key 'db.ratio'\]"):
+            mapped.db.ratio
+        # same size, different time
+        with open(orm_file_name, 'w') as orm_file:
+            orm_file.write('port = 81\n[web]\nhost = "web"\n[db]\nratio = 0.7.5\n')
+        stat = os.stat(orm_file_name)
+        os.utime(orm_file_name, (stat.st_atime, stat.st_mtime + 10))
+        self.assertEqual((web.host, web.port), ('web', 81))
+        with open(orm_file_name, 'w') as orm_file:
+            orm_file.write('port = 81\n')
+        self.assertEqual(mapped.port, 81)
+        self.assertRaises(AttributeError, getattr, web, 'host')
+        self.assertRaises(OrmError, list, web)
+
+    def test_save_unchanged(self):
+        test_orm_file_name = os.path.join(tempdir, 'unchanged.orm')
+        with open(test_orm_file_name, 'w') as orm_file:
+            orm_file.write('; not from OrmFile\nwho = "ethan"\n')
+        complete = OrmFile(test_orm_file_name)
+        complete.who
+        OrmFile.save(complete)
+        with open(test_orm_file_name) as orm_file:
+            self.assertEqual(orm_file.read(), '; not from OrmFile\nwho = "ethan"\n')
+        complete.who = 'me'
+        OrmFile.save(complete)
+        with open(test_orm_file_name) as orm_file:
+            self.assertEqual(orm_file.read(), 'who = "me"')
+        # saving elsewhere always writes
+        OrmFile.save(complete, test_orm_file_name + '.copy')
+        self.assertEqual(OrmFile(test_orm_file_name + '.copy').who, 'me')
+        # and leaves changes still to be saved to the file that was read
+        complete.who = 'you'
+        complete.hosts = ['a']
+        OrmFile.save(complete, test_orm_file_name + '.copy', force=True)
+        complete.hosts.append('b')
+        OrmFile.save(complete, test_orm_file_name + '.copy', force=True)
+        OrmFile.save(complete)
+        saved = OrmFile(test_orm_file_name)
+        self.assertEqual(saved.who, 'you')
+        self.assertEqual(saved.hosts, ['a', 'b'])
+
+    def test_save_changed_in_place(self):
+        test_orm_file_name = os.path.join(tempdir, 'changed-in-place.orm')
+        for lazy in (False, True):
+            with open(test_orm_file_name, 'w') as orm_file:
+                orm_file.write('hosts = ["a", "b"]\n[web]\nports = {"http": 80}\n')
+            complete = OrmFile(test_orm_file_name, lazy=lazy)
+            complete.hosts.append('c')
+            complete.web.ports['https'] = 443
+            OrmFile.save(complete, patch=True)
+            saved = OrmFile(test_orm_file_name)
+            self.assertEqual(saved.hosts, ['a', 'b', 'c'])
+            self.assertEqual(saved.web.ports, {'http': 80, 'https': 443})
+            # and once saved, they are not changes any more
+            self.assertEqual(OrmFile._changes(complete), ([], []))
+            complete.hosts.remove('a')
+            OrmFile.save(complete)
+            self.assertEqual(OrmFile(test_orm_file_name).hosts, ['b', 'c'])
+
+    def test_save_from_threads(self):
+        test_orm_file_name = os.path.join(tempdir, 'threaded-save.orm')
+        if os.path.exists(test_orm_file_name):
+            os.remove(test_orm_file_name)
+        complete = OrmFile(test_orm_file_name)
+        complete.count = 0
+        OrmFile.save(complete)
+        if not is_win:
+            umask = os.umask(0o022)
+            os.umask(umask)
+            self.assertEqual(os.stat(test_orm_file_name).st_mode & 0o777, 0o666 & ~umask)
+        failures = []
+        def save(n):
+            for i in range(30):
+                try:
+                    complete[('thread_%d' % n)] = i
+                    OrmFile.save(complete)
+                except Exception:
+                    failures.append(sys.exc_info()[1])
+        threads = [threading.Thread(target=save, args=(n, )) for n in range(4)]
+        for thread in threads:
+            thread.start()
+        for thread in threads:
+            thread.join()
+        self.assertEqual(failures, [])
+        self.assertEqual(OrmFile(test_orm_file_name).thread_3, 29)
+        self.assertEqual([n for n in os.listdir(tempdir) if n.endswith('.tmp')], [])
+
+    @skipUnless(not is_win, 'symlinks needed')
+    def test_save_through_symlink(self):
+        test_orm_file_name = os.path.join(tempdir, 'symlinked.orm')
+        link_name = os.path.join(tempdir, 'symlink.orm')
+        with open(test_orm_file_name, 'w') as orm_file:
+            orm_file.write('who = "ethan"\n')
+        if os.path.lexists(link_name):
+            os.remove(link_name)
+        os.symlink(test_orm_file_name, link_name)
+        complete = OrmFile(link_name)
+        complete.who = 'me'
+        OrmFile.save(complete)
+        self.assertTrue(os.path.islink(link_name))
+        self.assertEqual(OrmFile(test_orm_file_name).who, 'me')
+
+    def test_save_patch(self):
+        test_orm_file_name = os.path.join(tempdir, 'patched.orm')
+        with open(test_orm_file_name, 'w') as orm_file:
+            orm_file.write(
+                    '; settings for the web\n'
+                    'name = "web"\n'
+                    'unset =\n'
+                    '\n'
+                    '[server]\n'
+                    '# the port\n'
+                    'port   =   80  \n'
+                    'host = "localhost"\n'
+                    '[server.tls]\n'
+                    'port = 443\n'
+                    '[client]\n'
+                    )
+        os.chmod(test_orm_file_name, 0o640)
+        complete = OrmFile(test_orm_file_name)
+        complete.unset = 7
+        complete.added = True
+        complete.server.port = 8080
+        complete.server.started = datetime.date(2021, 7, 31)
+        complete.client.retries = 3
+        complete.proxy = OrmSection()
+        complete.proxy.host = 'proxy'
+        OrmFile.save(complete, patch=True)
+        with open(test_orm_file_name) as orm_file:
+            self.assertEqual(
+                    orm_file.read(),
+                    '; settings for the web\n'
+                    'name = "web"\n'
+                    'unset = 7\n'
+                    'added = True\n'
+                    '\n'
+                    '[server]\n'
+                    '# the port\n'
+                    'port   =   8080  \n'
+                    'host = "localhost"\n'
+                    'started = 2021-07-31\n'
+                    '[server.tls]\n'
+                    'port = 443\n'
+                    '[client]\n'
+                    'retries = 3\n'
+                    '\n'
+                    '[proxy]\n'
+                    'host = "proxy"'
+                    )
+        self.assertEqual(os.stat(test_orm_file_name).st_mode & 0o777, 0o640)
+        self.assertEqual([n for n in os.listdir(tempdir) if n.endswith('.tmp')], [])
+        patched = OrmFile(test_orm_file_name)
+        self.assertEqual(patched.server.tls.port, 443)
+        self.assertEqual(patched.server.tls.started, datetime.date(2021, 7, 31))
+        self.assertEqual(patched.proxy.host, 'proxy')
+        # saved changes are not saved again
+        complete.server.tls.port = 8443
+        OrmFile.save(complete, patch=True)
+        with open(test_orm_file_name) as orm_file:
+            saved = orm_file.read()
+        self.assertEqual(saved.count('started'), 1)
+        self.assertEqual(saved.count('port = 8443\n'), 1)
+        self.assertEqual(OrmFile(test_orm_file_name).server.tls.port, 8443)
+
+    def test_inherited_values_saved(self):
+        test_orm_file_name = os.path.join(tempdir, 'inherited.orm')
+        complete = OrmFile(self.orm_file)
+        OrmFile.save(complete, test_orm_file_name)
+        with open(test_orm_file_name) as orm_file:
+            saved = orm_file.read()
+        # every section lists the defaults it inherits
+        self.assertEqual(saved.count('who = "ethan"'), 4)
+        self.assertEqual(complete, OrmFile(test_orm_file_name))
+
+    def test_reload_if_changed(self):
+        test_orm_file_name = os.path.join(tempdir, 'reloaded.orm')
+        def write(text):
+            with open(test_orm_file_name, 'w') as orm_file:
+                orm_file.write(text)
+        for lazy in (False, True):
+            write('who = "ethan"\n[server]\nport = 80\nhost = "localhost"\n[client]\nretries = 3\n')
+            complete = OrmFile(test_orm_file_name, lazy=lazy)
+            heard = []
+            OrmFile.subscribe(complete, lambda orm, changes: heard.append((orm, changes)))
+            self.assertEqual(OrmFile.reload_if_changed(complete), [])
+            server = complete.server
+            write('who = "ethan"\n[server]\nport = 8080\nhost = "localhost"\n[proxy]\nretries = 3\n')
+            changes = OrmFile.reload_if_changed(complete)
+            self.assertEqual(sorted(changes), ['client', 'proxy', 'server.port'])
+            self.assertEqual(heard, [(complete, changes)])
+            self.assertEqual(complete.server.port, 8080)
+            # sections already in hand keep the settings they were read with
+            self.assertEqual(server.port, 80)
+            self.assertEqual(OrmFile.reload_if_changed(complete), [])
+            # same values, different types
+            write('who = "ethan"\n[server]\nport = 8080.0\nhost = "localhost"\n[proxy]\nretries = 3\n')
+            self.assertEqual(OrmFile.reload_if_changed(complete), ['server.port'])
+            # a bad file is not read again until it changes
+            write('who is ethan\n')
+            self.assertRaises(OrmError, OrmFile.reload_if_changed, complete)
+            self.assertEqual(OrmFile.reload_if_changed(complete), [])
+            self.assertEqual(complete.who, 'ethan')
+            # saving does not cause a reload
+            write('who = "ethan"\n')
+            OrmFile.reload_if_changed(complete)
+            complete.who = 'me'
+            OrmFile.save(complete)
+            self.assertEqual(OrmFile.reload_if_changed(complete), [])
+            self.assertEqual(len(heard), 3)
+
+    def test_reload_section(self):
+        test_orm_file_name = os.path.join(tempdir, 'reloaded-section.orm')
+        def write(text):
+            with open(test_orm_file_name, 'w') as orm_file:
+                orm_file.write(text)
+        write('who = "ethan"\n[server]\nport = 80\n[server.tls]\nport = 443\n[client]\nretries = 3\n')
+        server = OrmFile(test_orm_file_name, section='server')
+        write('who = "me"\n[server]\nport = 80\n[server.tls]\nport = 8443\n[client]\nretries = 5\n')
+        self.assertEqual(sorted(OrmFile.reload_if_changed(server)), ['server.tls.port', 'who'])
+        self.assertEqual(server.who, 'me')
+        self.assertEqual(server.tls.port, 8443)
+
+    def test_snapshot(self):
+        test_orm_file_name = os.path.join(tempdir, 'snapshot.orm')
+        with open(test_orm_file_name, 'w') as orm_file:
+            orm_file.write(
+                    'who = "ethan"\n'
+                    'hosts = ["alpha", "beta"]\n'
+                    '[server]\n'
+                    'port = 80\n'
+                    '[server.tls]\n'
+                    'port = 443\n'
+                    '[client]\n'
+                    'retries = 3\n'
+                    )
+        for lazy in (False, True):
+            complete = OrmFile(test_orm_file_name, lazy=lazy)
+            snapshot = OrmFile.snapshot(complete)
+            self.assertTrue(OrmFile.snapshot(complete) is snapshot)
+            self.assertEqual(snapshot.server.tls.port, 443)
+            self.assertEqual(snapshot.client.who, 'ethan')
+            self.assertEqual(snapshot['client']['retries'], 3)
+            self.assertTrue('hosts' in snapshot.server)
+            self.assertFalse('tls' in snapshot.client)
+            self.assertRaises(AttributeError, getattr, snapshot.server.tls, 'tls')
+            self.assertEqual(snapshot, complete._settings)
+            self.assertEqual(dict(snapshot.server.tls), {'who': 'ethan', 'hosts': ['alpha', 'beta'], 'port': 443})
+            self.assertRaises(OrmError, setattr, snapshot.server, 'port', 8080)
+            complete.server.port = 8080
+            complete.hosts.append('gamma')
+            complete.client.timeout = 30.0
+            self.assertEqual(snapshot.server.port, 80)
+            self.assertEqual(snapshot.hosts, ['alpha', 'beta'])
+            self.assertFalse('timeout' in snapshot.client)
+            later = OrmFile.snapshot(complete)
+            self.assertEqual(later.server.port, 8080)
+            self.assertEqual(later.client.timeout, 30.0)
+            # unchanged sections are shared
+            self.assertTrue(later._chain[0].values['server'].values['tls'] is snapshot._chain[0].values['server'].values['tls'])
+            self.assertFalse(later._chain[0].values['client'] is snapshot._chain[0].values['client'])
+            # as are values changed in place
+            self.assertTrue(OrmFile.snapshot(complete) is later)
+            complete.hosts.append('delta')
+            self.assertEqual(later.hosts, ['alpha', 'beta', 'gamma'])
+            self.assertEqual(OrmFile.snapshot(complete).hosts, ['alpha', 'beta', 'gamma', 'delta'])
+            self.assertEqual(OrmFile.snapshot(complete).server.tls.hosts, ['alpha', 'beta', 'gamma', 'delta'])
+            # including ones first used after the snapshot was taken
+            fresh = OrmFile(test_orm_file_name, lazy=lazy)
+            snapshot = OrmFile.snapshot(fresh)
+            fresh.hosts.append('gamma')
+            self.assertEqual(snapshot.hosts, ['alpha', 'beta'])
+            self.assertEqual(OrmFile.snapshot(fresh).hosts, ['alpha', 'beta', 'gamma'])
+            # and other files are not affected
+            self.assertTrue(OrmFile.snapshot(complete) is OrmFile.snapshot(complete))
+            # sections added since reading are checked for changes too
+            complete.client.proxy = OrmSection()
+            complete.client.proxy.host = 'proxy'
+            snapshot = OrmFile.snapshot(complete)
+            complete.client.proxy.host = 'other proxy'
+            self.assertEqual(snapshot.client.proxy.host, 'proxy')
+            self.assertEqual(OrmFile.snapshot(complete).client.proxy.host, 'other proxy')
+        server = OrmFile(test_orm_file_name, section='server')
+        snapshot = OrmFile.snapshot(server)
+        self.assertEqual(snapshot.port, 80)
+        self.assertEqual(snapshot.who, 'ethan')
+        self.assertEqual(snapshot.tls.port, 443)
+
+    def test_layered(self):
+        base = os.path.join(tempdir, 'layer-base.orm')
+        site = os.path.join(tempdir, 'layer-site.orm')
+        host = os.path.join(tempdir, 'layer-host.orm')
+        with open(base, 'w') as orm_file:
+            orm_file.write(
+                    'who = "ethan"\n'
+                    'port = 80\n'
+                    'hosts = ["alpha", "beta"]\n'
+                    '[server]\n'
+                    'port = 8080\n'
+                    'workers = 4\n'
+                    '[server.tls]\n'
+                    'port = 443\n'
+                    '[client]\n'
+                    'retries = 3\n'
+                    )
+        with open(site, 'w') as orm_file:
+            orm_file.write(
+                    'who = "site"\n'
+                    '[server]\n'
+                    'workers = 16\n'
+                    '[proxy]\n'
+                    'host = "proxy"\n'
+                    )
+        with open(host, 'w') as orm_file:
+            orm_file.write(
+                    'port = 8000\n'
+                    '[server]\n'
+                    '[server.tls]\n'
+                    'cert = "/etc/host.pem"\n'
+                    )
+        for lazy in (False, True):
+            complete = OrmFile([base, site, host], lazy=lazy)
+            self.assertEqual(complete.who, 'site')
+            # later files replace earlier ones
+            self.assertEqual(complete.port, 8000)
+            self.assertEqual(complete.server.workers, 16)
+            # section settings replace defaults from any file
+            self.assertEqual(complete.server.port, 8080)
+            self.assertEqual(complete.client.port, 8000)
+            self.assertEqual(complete.server.tls.port, 443)
+            self.assertEqual(complete.server.tls.cert, '/etc/host.pem')
+            self.assertEqual(complete.server.tls.workers, 16)
+            self.assertEqual(complete.proxy.who, 'site')
+            self.assertEqual(complete.client.retries, 3)
+            self.assertEqual([k for k, v in complete], ['who', 'port', 'hosts', 'server', 'client', 'proxy'])
+            # the parsed files are shared, the settings are not
+            complete.hosts.append('gamma')
+            complete.server.workers = 1
+            again = OrmFile([base, host], lazy=lazy)
+            self.assertEqual(again.hosts, ['alpha', 'beta'])
+            self.assertEqual(again.server.workers, 4)
+            self.assertEqual(again.who, 'ethan')
+            self.assertRaises(OrmError, OrmFile.save, complete)
+        self.assertEqual(
+                sorted(k[0] for k in scription._orm_parse_cache if k[0] in (base, site, host)),
+                [base, base, host, host, site, site],
+                )
+        server = OrmFile([base, site, host], section='server')
+        self.assertEqual(server.port, 8080)
+        self.assertEqual(server.tls.cert, '/etc/host.pem')
+        self.assertRaises(OrmError, OrmFile, [base, site], cache=True)
+        # changes to any of the files are reloaded
+        complete = OrmFile([base, site, host])
+        with open(site, 'w') as orm_file:
+            orm_file.write('who = "another site"\n')
+        self.assertEqual(sorted(OrmFile.reload_if_changed(complete)), ['proxy', 'server.workers', 'who'])
+        self.assertEqual(complete.who, 'another site')
+        self.assertEqual(complete.server.workers, 4)
+        # errors name the file they are in
+        with open(host, 'w') as orm_file:
+            orm_file.write('port is 8000\n')
+        try:
+            OrmFile([base, site, host])
+        except OrmError:
+            self.assertTrue(repr(host) in str(sys.exc_info()[1]))
+        else:
+            raise AssertionError('OrmError not raised')
+
+    def test_watch(self):
+        test_orm_file_name = os.path.join(tempdir, 'watched.orm')
+        with open(test_orm_file_name, 'w') as orm_file:
+            orm_file.write('who = "ethan"\n')
+        complete = OrmFile(test_orm_file_name)
+        reloaded = threading.Event()
+        OrmFile.subscribe(complete, lambda orm, changes: reloaded.set())
+        OrmFile.watch(complete, 0.01)
+        try:
+            self.assertRaises(OrmError, OrmFile.watch, complete)
+            with open(test_orm_file_name, 'w') as orm_file:
+                orm_file.write('who = "somebody else"\n')
+            self.assertTrue(reloaded.wait(5))
+            self.assertEqual(complete.who, 'somebody else')
+        finally:
+            OrmFile.unwatch(complete)
+        self.assertTrue(complete._watcher is None)
+        mapped = MappedOrmFile(test_orm_file_name)
+        self.assertRaises(OrmError, MappedOrmFile.watch, mapped)
+
+
+@skipUnless(INCLUDE_SLOW, 'skipping slow tests')
+class TestOrmThroughput(TestCase):
+    "benchmark parsing large OrmFiles"
+
+    def test_parse_large_file(self):
+        orm_file_name = os.path.join(tempdir, 'large.orm')
+        with open(orm_file_name, 'w') as orm_file:
+            for i in range(50):
+                orm_file.write('default_%d = %d\n' % (i, i))
+            for i in range(2000):
+                orm_file.write('\n[host_%d]\n; a comment\n' % i)
+                for j in range(0, 100, 4):
+                    orm_file.write(
+                            'key_%d = "value %d"\nkey_%d = %d\nkey_%d = False\nkey_%d = /srv/%d/%d\n'
+                            % (j, j, j+1, i % 7, j+2, j+3, i % 3, j)
+                            )
+        start = time.time()
+        complete = OrmFile(orm_file_name)
+        elapsed = time.time() - start
+        self.assertEqual(complete.host_1999.key_97, 1999 % 7)
+        start = time.time()
+        complete = OrmFile(orm_file_name, lazy=True)
+        lazy = time.time() - start
+        self.assertEqual(complete.host_1999.key_97, 1999 % 7)
+        print('\nparsed 2000 sections of 150 settings in %.2f seconds (%.2f lazily)' % (elapsed, lazy), verbose=0)
+
+    def test_parse_inherited_defaults(self):
+        orm_file_name = os.path.join(tempdir, 'defaults.orm')
+        with open(orm_file_name, 'w') as orm_file:
+            for i in range(200):
+                orm_file.write('default_%d = %d\n' % (i, i))
+            for i in range(20000):
+                orm_file.write('\n[host_%d]\naddress = "10.0.%d.%d"\ndefault_7 = False\n' % (i, i // 256, i % 256))
+        start = time.time()
+        complete = OrmFile(orm_file_name)
+        elapsed = time.time() - start
+        self.assertEqual(complete.host_19999.default_199, 199)
+        print('\nparsed 20000 sections inheriting 200 defaults in %.2f seconds' % elapsed, verbose=0)
+
+    def test_section_load(self):
+        orm_file_name = os.path.join(tempdir, 'hosts.orm')
+        with open(orm_file_name, 'w') as orm_file:
+            for i in range(200):
+                orm_file.write('default_%d = %d\n' % (i, i))
+            for i in range(20000):
+                orm_file.write('\n[host_%d]\naddress = "10.0.%d.%d"\nport = %d\n' % (i, i // 256, i % 256, 8000 + i))
+        timings = []
+        for kwds in (dict(), dict(section='host_12345'), dict(section='host_12345', index=True), dict(section='host_12345', index=True)):
+            start = time.time()
+            complete = OrmFile(orm_file_name, **kwds)
+            timings.append(time.time() - start)
+        self.assertEqual(complete.port, 20345)
+        print('\nloaded one of 20000 sections in %.3f seconds; %.3f targeted, %.3f indexing, %.3f indexed' % tuple(timings), verbose=0)
+
+    def test_mapped_load(self):
+        orm_file_name = os.path.join(tempdir, 'mapped-hosts.orm')
+        with open(orm_file_name, 'w') as orm_file:
+            for i in range(200):
+                orm_file.write('default_%d = %d\n' % (i, i))
+            for i in range(20000):
+                orm_file.write('\n[host_%d]\naddress = "10.0.%d.%d"\nport = %d\n' % (i, i // 256, i % 256, 8000 + i))
+        start = time.time()
+        self.assertEqual(OrmFile(orm_file_name).host_12345.port, 20345)
+        parsed = time.time() - start
+        start = time.time()
+        mapped = MappedOrmFile(orm_file_name)
+        self.assertEqual(mapped.host_12345.port, 20345)
+        opened = time.time() - start
+        start = time.time()
+        for i in range(1000):
+            mapped.host_12345.port
+        looked_up = (time.time() - start) / 1000
+        print('\none setting of 20000 sections in %.3f seconds parsed, %.3f mapped (%.1f microseconds per lookup)' % (parsed, opened, looked_up * 1000000), verbose=0)
+
+    def test_save_one_change(self):
+        orm_file_name = os.path.join(tempdir, 'saved-hosts.orm')
+        with open(orm_file_name, 'w') as orm_file:
+            for i in range(20000):
+                orm_file.write('\n[host_%d]\naddress = "10.0.%d.%d"\nport = %d\n' % (i, i // 256, i % 256, 8000 + i))
+        complete = OrmFile(orm_file_name)
+        timings = []
+        for patch in (False, True):
+            start = time.time()
+            for i in range(10):
+                complete.host_12345.port = i
+                OrmFile.save(complete, patch=patch)
+            timings.append((time.time() - start) / 10)
+        self.assertEqual(OrmFile(orm_file_name).host_12345.port, 9)
+        print('\nsaved one change to 20000 sections in %.3f seconds, %.3f patched' % tuple(timings), verbose=0)
+
+    def test_reload_unchanged(self):
+        orm_file_name = os.path.join(tempdir, 'reloaded-hosts.orm')
+        with open(orm_file_name, 'w') as orm_file:
+            for i in range(20000):
+                orm_file.write('\n[host_%d]\naddress = "10.0.%d.%d"\nport = %d\n' % (i, i // 256, i % 256, 8000 + i))
+        start = time.time()
+        complete = OrmFile(orm_file_name)
+        parsed = time.time() - start
+        start = time.time()
+        for i in range(1000):
+            OrmFile.reload_if_changed(complete)
+        checked = (time.time() - start) / 1000
+        with open(orm_file_name, 'a') as orm_file:
+            orm_file.write('\n[host_20000]\n')
+        start = time.time()
+        self.assertEqual(OrmFile.reload_if_changed(complete), ['host_20000'])
+        reloaded = time.time() - start
+        print('\nread 20000 sections in %.3f seconds; checked for changes in %.6f, reloaded in %.3f' % (parsed, checked, reloaded), verbose=0)
+
+    def test_snapshot_one_change(self):
+        orm_file_name = os.path.join(tempdir, 'snapshot-hosts.orm')
+        with open(orm_file_name, 'w') as orm_file:
+            for i in range(20000):
+                orm_file.write('\n[host_%d]\naddress = "10.0.%d.%d"\nport = %d\n' % (i, i // 256, i % 256, 8000 + i))
+        complete = OrmFile(orm_file_name)
+        start = time.time()
+        OrmFile.snapshot(complete)
+        first = time.time() - start
+        start = time.time()
+        for i in range(1000):
+            OrmFile.snapshot(complete)
+        unchanged = (time.time() - start) / 1000
+        start = time.time()
+        for i in range(10):
+            complete.host_12345.port = i
+            snapshot = OrmFile.snapshot(complete)
+        changed = (time.time() - start) / 10
+        self.assertEqual(snapshot.host_12345.port, 9)
+        print('\nsnapshot of 20000 sections in %.3f seconds; %.6f unchanged, %.3f after one change' % (first, unchanged, changed), verbose=0)
+
+    def test_layered_load(self):
+        base = os.path.join(tempdir, 'layer-hosts.orm')
+        host = os.path.join(tempdir, 'layer-one-host.orm')
+        with open(base, 'w') as orm_file:
+            for i in range(20000):
+                orm_file.write('\n[host_%d]\naddress = "10.0.%d.%d"\nport = %d\n' % (i, i // 256, i % 256, 8000 + i))
+        with open(host, 'w') as orm_file:
+            orm_file.write('[host_12345]\nport = 80\n')
+        start = time.time()
+        OrmFile(base)
+        plain = time.time() - start
+        start = time.time()
+        OrmFile([base, host])
+        first = time.time() - start
+        start = time.time()
+        for i in range(10):
+            complete = OrmFile([base, host])
+        again = (time.time() - start) / 10
+        self.assertEqual(complete.host_12345.port, 80)
+        print('\nread 20000 sections in %.3f seconds; layered %.3f the first time, %.3f after' % (plain, first, again), verbose=0)
+
+    def test_cached_load(self):
+        orm_file_name = os.path.join(tempdir, 'cached-large.orm')
+        with open(orm_file_name, 'w') as orm_file:
+            for i in range(1000):
+                orm_file.write('\n[host_%d]\n' % i)
+                for j in range(0, 100, 2):
+                    orm_file.write('key_%d = %d.%d\nkey_%d = "value %d.%d"\n' % (j, i, j, j+1, i, j+1))
+        start = time.time()
+        OrmFile(orm_file_name, cache=True)
+        cold = time.time() - start
+        start = time.time()
+        complete = OrmFile(orm_file_name, cache=True)
+        warm = time.time() - start
+        self.assertEqual(complete.host_999.key_99, 'value 999.99')
+        print('\nloaded 100,000 settings in %.2f seconds cold, %.2f warm' % (cold, warm), verbose=0)
+
 
 class TestResponse(TestCase):
 
@@ -2751,6 +4008,15 @@ class TestResponse(TestCase):
 class TestExecutionThreads(TestCase):
     "Testing thread generation and reaping"
 
+    def setUp(self):
+        # the scheduler thread may have been left waiting by earlier jobs
+        _scheduler.join_idle()
+
+    def assertThreadsGone(self, thread_count):
+        # the scheduler thread waits for more jobs unless told not to
+        _scheduler.join_idle()
+        self.assertEqual(thread_count, threading.active_count())
+
     template = (
             "from __future__ import print_function\n"
             "import sys\n"
@@ -2778,20 +4044,20 @@ class TestExecutionThreads(TestCase):
     def test_noninteractive_process(self):
         thread_count = threading.active_count()
         job = Execute('ls -lad', pty=False)
-        self.assertEqual(thread_count, threading.active_count())
+        self.assertThreadsGone(thread_count)
         self.assertEqual(job.returncode, 0, '\n"ls -lad"\n-- stdout --\n%s\n-- stderr --\n%s' % (job.stdout, job.stderr))
 
     def test_noninteractive_pty(self):
         thread_count = threading.active_count()
         job = Execute('ls -lad', pty=True)
-        self.assertEqual(thread_count, threading.active_count())
+        self.assertThreadsGone(thread_count)
         self.assertEqual(job.returncode, 0, 'ls -lad:\n-- stdout --\n%s\n-- stderr --\n%s' % (job.stdout, job.stderr))
 
     def test_interactive_process(self):
         thread_count = threading.active_count()
         test_file = self.write_script('print(raw_input("howdy! "))')
         job = Execute([sys.executable, test_file], pty=False, timeout=300, input='Bye!\n')
-        self.assertEqual(thread_count, threading.active_count())
+        self.assertThreadsGone(thread_count)
         self.assertEqual(job.stdout.strip(), 'howdy! Bye!', '\n out: %r\n err: %r' % (job.stdout, job.stderr))
         self.assertEqual(job.returncode, 0, '-- stdout --\n%s\n-- stderr --\n%s' % (job.stdout, job.stderr))
 
@@ -2802,7 +4068,7 @@ class TestExecutionThreads(TestCase):
                 '''print(getpass('howdy!'))\n'''
                 )
         job = Execute([sys.executable, test_file], pty=True, timeout=600, password='Bye!')
-        self.assertEqual(thread_count, threading.active_count())
+        self.assertThreadsGone(thread_count)
         self.assertEqual(job.stdout.strip().replace('\n', ' '), 'howdy! Bye!', '\n out: %r\n err: %r' % (job.stdout, job.stderr))
         self.assertEqual(job.returncode, 0, '-- stdout --\n%s\n-- stderr --\n%s' % (job.stdout, job.stderr))
 
@@ -2818,7 +4084,7 @@ class TestExecutionThreads(TestCase):
                 job.communicate,
                 timeout=3,
                 )
-        self.assertEqual(thread_count, threading.active_count())
+        self.assertThreadsGone(thread_count)
         self.assertEqual(job.stderr.strip(), 'TIMEOUT: process failed to complete in 3 seconds', '\n out: %r\n err: %r' % (job.stdout, job.stderr))
         self.assertNotEqual(job.returncode, 0, '-- stdout --\n%s\n-- stderr --\n%s' % (job.stdout, job.stderr))
 
@@ -2834,7 +4100,7 @@ class TestExecutionThreads(TestCase):
                 job.communicate,
                 timeout=3,
                 )
-        self.assertEqual(thread_count, threading.active_count())
+        self.assertThreadsGone(thread_count)
         self.assertEqual(
                 job.stderr.strip(),
                 'TIMEOUT: process failed to complete in 3 seconds',
@@ -2850,7 +4116,7 @@ class TestExecutionThreads(TestCase):
                 '''time.sleep(5)\n'''
                 )
         job = Execute([sys.executable, test_file], pty=False, timeout=3)
-        self.assertEqual(thread_count, threading.active_count())
+        self.assertThreadsGone(thread_count)
         self.assertTrue('TIMEOUT: process failed to complete in 3 seconds' not in job.stdout)
         self.assertNotEqual(job.returncode, 0, '-- stdout --\n%s\n-- stderr --\n%s' % (job.stdout, job.stderr))
 
@@ -2862,11 +4128,193 @@ class TestExecutionThreads(TestCase):
                 )
         job = Job([sys.executable, test_file], pty=True)
         self.assertRaises(TimeoutError, job.communicate, timeout=3)
-        self.assertEqual(thread_count, threading.active_count())
+        self.assertThreadsGone(thread_count)
         self.assertTrue('TIMEOUT: process failed to complete in 3 seconds' not in job.stdout)
         self.assertNotEqual(job.returncode, 0, '-- stdout --\n%s\n-- stderr --\n%s' % (job.stdout, job.stderr))
 
 
+    def test_shared_timeout_thread(self):
+        "timeouts of concurrent jobs share a single thread"
+        thread_count = threading.active_count()
+        jobs = [Job([sys.executable, '-c', 'import time; time.sleep(30)'], pty=False) for i in range(5)]
+        threads = [threading.Thread(target=self.assertRaises, args=(TimeoutError, job.communicate), kwargs={'timeout': 1}) for job in jobs]
+        for t in threads:
+            t.start()
+        time.sleep(0.5)
+        schedulers = [t for t in threading.enumerate() if t.name == 'scheduler']
+        self.assertEqual(len(schedulers), 1)
+        for t in threads:
+            t.join()
+        for job in jobs:
+            self.assertNotEqual(job.returncode, 0)
+        self.assertThreadsGone(thread_count)
+
+    def test_scheduler(self):
+        "scheduled calls run in order, and cancelled calls not at all"
+        calls = []
+        done = threading.Event()
+        _scheduler.schedule(0.05, calls.append, 2)
+        _scheduler.schedule(0.01, calls.append, 1)
+        cancelled = _scheduler.schedule(0.02, calls.append, 'cancelled')
+        _scheduler.schedule(0.1, done.set)
+        cancelled.cancel()
+        done.wait(5)
+        self.assertEqual(calls, [1, 2])
+
+    def test_scheduler_join_idle(self):
+        "one scheduler thread serves a series of jobs, until join_idle stops it"
+        threads = set()
+        for i in range(5):
+            Execute([sys.executable, '-c', 'pass'], timeout=60)
+            threads.update(t for t in threading.enumerate() if t.name == 'scheduler')
+        self.assertEqual(len(threads), 1)
+        # a call still running is waited for
+        running = threading.Event()
+        release = threading.Event()
+        def slow():
+            running.set()
+            release.wait(5)
+        _scheduler.schedule(0, slow)
+        running.wait(5)
+        releaser = threading.Timer(0.2, release.set)
+        releaser.start()
+        _scheduler.join_idle()
+        self.assertTrue(release.is_set())
+        self.assertEqual([t for t in threading.enumerate() if t.name == 'scheduler'], [])
+        releaser.join()
+
+
+
+@skipUnless(pyver >= PY36 and not is_win, 'AsyncJob needs Python 3.6+')
+class TestAsyncJob(TestCase):
+    "Testing asyncio jobs"
+
+    def setUp(self):
+        self.loop = asyncio.new_event_loop()
+        asyncio.set_event_loop(self.loop)
+        # a scheduler thread left waiting by earlier jobs would skew thread counts
+        _scheduler.join_idle()
+
+    def tearDown(self):
+        asyncio.set_event_loop(None)
+        self.loop.close()
+
+    def run_until_complete(self, awaitable):
+        return self.loop.run_until_complete(awaitable)
+
+    def test_aexecute(self):
+        job = self.run_until_complete(aexecute(
+                [sys.executable, '-c', 'import sys; print(sys.stdin.read().upper()); sys.stderr.write("oops\\n"); sys.exit(3)'],
+                input='quiet',
+                ))
+        self.assertEqual(job.stdout, 'QUIET\n')
+        self.assertEqual(job.stderr, 'oops\n')
+        self.assertEqual(job.returncode, 3)
+
+    def test_bytes(self):
+        job = AsyncJob([sys.executable, '-c', 'print("caf\\xe9")'])
+        self.run_until_complete(job.communicate(timeout=60, encoding=None))
+        self.assertEqual(job.stdout, u'caf\xe9\n'.encode('utf-8'))
+        # no encoding given keeps the constructor's
+        job = AsyncJob([sys.executable, '-c', 'print("hi")'], encoding=None)
+        self.run_until_complete(job.communicate(timeout=60))
+        self.assertEqual(job.stdout, b'hi\n')
+
+    def test_env(self):
+        "changing one job's env changes no other"
+        job = AsyncJob([sys.executable, '-c', 'import os; print(os.environ.get("SCRIPTION_TEST"))'])
+        job.env['SCRIPTION_TEST'] = 'one'
+        self.run_until_complete(job.communicate(timeout=60))
+        self.assertEqual(job.stdout, 'one\n')
+        self.assertFalse('SCRIPTION_TEST' in Environment.default.mapping())
+        self.assertFalse('SCRIPTION_TEST' in AsyncJob(['true']).env)
+        # an empty env means ours
+        self.assertEqual(AsyncJob(['true'], env={}).env, Environment.default.mapping())
+
+    def test_gather(self):
+        "many jobs, one thread"
+        try:
+            os.close(os.pidfd_open(os.getpid()))
+            pidfd = True
+        except (AttributeError, OSError):
+            pidfd = False
+        if (3, 9) <= pyver < (3, 12) and pidfd:
+            # asyncio's default watcher there uses a thread per child
+            with warnings.catch_warnings():
+                warnings.simplefilter('ignore', DeprecationWarning)
+                policy = asyncio.get_event_loop_policy()
+                watcher = policy.get_child_watcher()
+                pidfd_watcher = asyncio.PidfdChildWatcher()
+                pidfd_watcher.attach_loop(self.loop)
+                policy.set_child_watcher(pidfd_watcher)
+            def restore():
+                with warnings.catch_warnings():
+                    warnings.simplefilter('ignore', DeprecationWarning)
+                    policy.set_child_watcher(watcher)
+            self.addCleanup(restore)
+        thread_count = threading.active_count()
+        running = []
+        async def count_threads():
+            await asyncio.sleep(0.5)
+            running.append(threading.active_count())
+        jobs = [AsyncJob(['sh', '-c', 'sleep 1; echo %d' % i]) for i in range(50)]
+        self.run_until_complete(asyncio.gather(
+                count_threads(),
+                *(job.communicate(timeout=60) for job in jobs)
+                ))
+        self.assertEqual([job.stdout for job in jobs], ['%d\n' % i for i in range(50)])
+        if pyver < (3, 8) or pyver >= (3, 9) and pidfd:
+            # children are waited for without threads while they run
+            self.assertEqual(running, [thread_count])
+        self.assertEqual(thread_count, threading.active_count())
+
+    def test_lines(self):
+        job = AsyncJob([sys.executable, '-c', 'import time\nfor i in range(3): print(i); time.sleep(0.05)'])
+        lines = []
+        while True:
+            try:
+                lines.append(self.run_until_complete(job.__anext__()))
+            except StopAsyncIteration:
+                break
+        self.run_until_complete(job.communicate(timeout=60))
+        self.assertEqual(lines, ['0\n', '1\n', '2\n'])
+        self.assertEqual(job.stdout, '0\n1\n2\n')
+
+    def test_password(self):
+        script = os.path.join(tempdir, 'async_password')
+        with open(script, 'w') as f:
+            f.write(
+                    "from getpass import getpass\n"
+                    "password = getpass('password: ')\n"
+                    "print('%r?' % password)\n"
+                    )
+        job = self.run_until_complete(aexecute([sys.executable, script], pty=True, password='Salutations!', timeout=60))
+        self.assertEqual(job.stdout, "password: \n'Salutations!'?\n")
+        # never turns echo back on
+        script = (
+                "import sys, termios\n"
+                "attrs = termios.tcgetattr(0)\n"
+                "attrs[3] &= ~termios.ECHO\n"
+                "termios.tcsetattr(0, termios.TCSANOW, attrs)\n"
+                "sys.stdin.readline()\n"
+                "sys.stdin.readline()\n"
+                )
+        self.assertRaises(
+                FailedPassword,
+                self.run_until_complete,
+                aexecute([sys.executable, '-c', script], pty=True, password='one', timeout=60, interactive=False),
+                )
+
+    def test_timeout(self):
+        start = time.time()
+        self.assertRaises(
+                TimeoutError,
+                self.run_until_complete,
+                aexecute(['sh', '-c', 'sleep 60 & echo started'], timeout=1, interactive=False),
+                )
+        self.assertTrue(time.time() - start < 10)
+
+
 class TestEnums(TestCase):
 
     def test_color_bitwise_or(self):
@@ -3695,6 +5143,98 @@ if not is_win:
         del skipIfPointless
 
 
+@skipUnless(INCLUDE_SLOW, 'skipping slow tests')
+class TestExecutionThroughput(TestCase):
+    "benchmark capturing large amounts of child output"
+
+    if not is_win:
+        def test_pty_password_latency(self):
+            "password exchanges take about as long as the job itself"
+            def best_of_three(script, **kwds):
+                times = []
+                for _ in range(3):
+                    start = time.time()
+                    command = Execute([sys.executable, '-c', script], pty=True, timeout=600, **kwds)
+                    times.append(time.time() - start)
+                return command, min(times)
+            command, with_password = best_of_three(
+                    "from getpass import getpass\n"
+                    "print('super secret santa soda sizzle?')\n"
+                    "password = getpass('make sure no one is watching you type!: ')\n"
+                    "print('%r?  Are you sure??' % password)",
+                    password='Salutations!',
+                    )
+            self.assertTrue("'Salutations!'?  Are you sure??" in command.stdout, command.stdout)
+            _, without_password = best_of_three("print('good output here!')")
+            print('\nwith password: %.3fs, without: %.3fs' % (with_password, without_password), verbose=0)
+            self.assertTrue(with_password - without_password < 0.2)
+
+    def test_capture_one_gib(self):
+        size = 1024 ** 3
+        start = time.time()
+        job = Execute(
+                [sys.executable, '-c',
+                    'import sys\n'
+                    'out = getattr(sys.stdout, "buffer", sys.stdout)\n'
+                    'block = b"x" * (1024 * 1024)\n'
+                    'for i in range(1024):\n'
+                    '    out.write(block)\n'
+                    ],
+                pty=False,
+                encoding=None,
+                timeout=600,
+                )
+        elapsed = time.time() - start
+        self.assertEqual(len(job.stdout), size)
+        print('\ncaptured 1 GiB in %.2f seconds (%.1f MiB/s)' % (elapsed, 1024 / elapsed), verbose=0)
+
+    def test_environment_reuse(self):
+        start = time.time()
+        for i in range(100000):
+            env = os.environ.copy()
+            env.update(SCRIPTION_BENCHMARK='1')
+        copying = time.time() - start
+        start = time.time()
+        for i in range(100000):
+            env = Environment.default.overlay(SCRIPTION_BENCHMARK='1').mapping()
+        reusing = time.time() - start
+        print('\n100,000 environments: copied in %.2f seconds, reused in %.2f' % (copying, reusing), verbose=0)
+
+
+if not is_win:
+    @skipUnless(INCLUDE_SLOW, 'skipping slow tests')
+    class TestExecutionFdLimit(TestCase):
+        "benchmark pty start-up with a large file descriptor limit"
+
+        def setUp(self):
+            import resource
+            self.limits = resource.getrlimit(resource.RLIMIT_NOFILE)
+            try:
+                with open('/proc/sys/fs/nr_open') as nr_open:
+                    hard = int(nr_open.read())
+            except (IOError, OSError, ValueError):
+                hard = 1024 * 1024
+            try:
+                resource.setrlimit(resource.RLIMIT_NOFILE, (self.limits[0], hard))
+            except (ValueError, OSError):
+                raise SkipTest('unable to raise file descriptor limit')
+
+        def tearDown(self):
+            import resource
+            resource.setrlimit(resource.RLIMIT_NOFILE, self.limits)
+
+        def test_pty_startup(self):
+            import resource
+            hard = resource.getrlimit(resource.RLIMIT_NOFILE)[1]
+            start = time.time()
+            for i in range(10):
+                job = Execute([sys.executable, '-c', 'pass'], pty=True, timeout=60)
+                self.assertEqual(job.returncode, 0)
+            elapsed = (time.time() - start) / 10
+            print('\npty Execute with fd limit of %d: %.3f seconds each' % (hard, elapsed), verbose=0)
+            self.assertTrue(elapsed < 2, 'pty Execute took %.3f seconds' % elapsed)
+
+
 class TestTrivalent(TestCase):
     "Testing Trivalent"
 